@@ -0,0 +1,117 @@
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import utils.bench_option
+import utils.calibration
+import utils.metrics
+
+
+# Synthetic logits, softmax, targets and correctness with roughly the requested accuracy
+def make_predictions(nb_sample, nb_cls, acc, rng, chunk_size=65536):
+    logit = np.empty((nb_sample, nb_cls), dtype=np.float32)
+    softmax = np.empty((nb_sample, nb_cls), dtype=np.float32)
+    for start in range(0, nb_sample, chunk_size):
+        end = min(start + chunk_size, nb_sample)
+        chunk = rng.standard_normal((end - start, nb_cls), dtype=np.float32) * 3
+        logit[start:end] = chunk
+        chunk = np.exp(chunk - chunk.max(1, keepdims=True))
+        softmax[start:end] = chunk / chunk.sum(1, keepdims=True)
+
+    pred = softmax.argmax(1)
+    target = np.where(rng.random(nb_sample) < acc, pred, rng.integers(0, nb_cls, nb_sample))
+    correct = pred == target
+    return logit, softmax, target, correct
+
+
+def streaming_metric_log(logit, softmax, target, correct, batch_size=1024):
+    metric_log = utils.metrics.Metric_Log(bins=15)
+    for start in range(0, len(target), batch_size):
+        end = min(start + batch_size, len(target))
+        nll, brier = utils.metrics.calc_nll_brier_terms(softmax[start:end], logit[start:end], target[start:end])
+        metric_log.update(softmax[start:end].max(1), softmax[start:end].argmax(1), target[start:end], nll, brier)
+    return metric_log.compute()
+
+
+# every metric of valid.validation, called as validation calls it
+BENCHMARKS = {
+    'calc_ranking_metrics': lambda logit, softmax, target, correct: utils.metrics.calc_ranking_metrics(softmax.max(1), correct),
+    'calc_aurc_eaurc': lambda logit, softmax, target, correct: utils.metrics.calc_aurc_eaurc(softmax, correct),
+    'calc_fpr_aupr': lambda logit, softmax, target, correct: utils.metrics.calc_fpr_aupr(softmax, correct),
+    'calc_ece': lambda logit, softmax, target, correct: utils.metrics.calc_ece(softmax, target, bins=15),
+    'calc_nll_brier': lambda logit, softmax, target, correct: utils.metrics.calc_nll_brier(softmax, logit, target),
+    'calc_calibration': lambda logit, softmax, target, correct: utils.calibration.calc_calibration(softmax.max(1), correct, softmax, target),
+    'Metric_Log': streaming_metric_log,
+}
+
+
+# median (and fastest) wall-clock time over repeat calls, then peak traced memory of one more call
+def run_benchmark(func, inputs, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*inputs)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(*inputs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'time': float(np.median(times)), 'min_time': min(times), 'peak_mb': peak / 2 ** 20}
+
+
+# names of the results whose median time is more than tolerance % and more than min_diff seconds slower than the
+# baseline: timings of a few ms vary by tens of % between runs of the same code
+def check_regression(results, baseline, tolerance, min_diff):
+    regressions = []
+    for key, res in results.items():
+        if key not in baseline:
+            continue
+        base_time = baseline[key]['time']
+        if res['time'] > base_time * (1 + tolerance / 100) and res['time'] - base_time > min_diff:
+            regressions.append((key, base_time, res['time']))
+    return regressions
+
+
+def main():
+    args = utils.bench_option.get_args_parser()
+    rng = np.random.default_rng(args.seed)
+    benchmarks = {name: BENCHMARKS[name] for name in (args.metrics or BENCHMARKS)}
+
+    results = {}
+    for nb_sample in args.nb_samples:
+        for nb_cls in args.nb_cls:
+            if nb_sample * nb_cls > args.max_elements:
+                print(f'Skip N={nb_sample} C={nb_cls}: more than {args.max_elements} elements')
+                continue
+            inputs = make_predictions(nb_sample, nb_cls, args.acc, rng)
+            for name, func in benchmarks.items():
+                key = f'{name}|N={nb_sample}|C={nb_cls}'
+                results[key] = run_benchmark(func, inputs, args.repeat)
+                print(f"{key}\t{results[key]['time']:.4f}s\t{results[key]['peak_mb']:.1f}MB")
+            del inputs
+
+    with open(args.save_path, 'w') as f:
+        json.dump({'meta': {'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'machine': platform.machine(),
+                            'processor': platform.processor()},
+                   'results': results}, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = check_regression(results, baseline, args.tolerance, args.min_diff)
+        for key, base_time, new_time in regressions:
+            print(f'Regression {key}: {base_time:.4f}s -> {new_time:.4f}s (+{100 * (new_time / base_time - 1):.1f}%)')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,11 @@
 # fmt:off
+import json
 import os
 from pathlib import Path
-from typing import Any, Callable, Optional, Tuple
+from typing import Any, Callable, List, Optional, Tuple
 
+import torch
+import torchvision.transforms
 from torchvision.datasets import VisionDataset
 from torchvision.datasets.utils import (
     check_integrity,
@@ -13,6 +16,55 @@ import numpy as np
 
 
 # fmt:on
+class VirtualConcat:
+    """Read-only concatenation of arrays along the first axis, without copy.
+
+    An index is mapped to the array holding it and the offset inside it, a
+    slice gathers only the rows it covers.
+
+    Args:
+        arrays (list): Arrays (e.g. memory maps) with the same trailing
+            shape and dtype.
+    """
+
+    def __init__(self, arrays: List[np.ndarray]):
+        self.arrays = arrays
+        self.offsets = np.cumsum([0] + [len(array) for array in arrays])
+        self.shape = (int(self.offsets[-1]),) + arrays[0].shape[1:]
+        self.dtype = arrays[0].dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def locate(self, index: int) -> Tuple[int, int]:
+        """The array and the offset of a (non-negative) index."""
+        array_idx = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        return array_idx, index - int(self.offsets[array_idx])
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise IndexError("VirtualConcat only supports contiguous slices")
+            pieces = []
+            while start < stop:
+                array_idx, offset = self.locate(start)
+                end = min(stop, int(self.offsets[array_idx + 1]))
+                pieces.append(self.arrays[array_idx][offset : offset + end - start])
+                start = end
+            if len(pieces) == 0:
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            return np.concatenate(pieces, axis=0)
+
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"index {index} is out of bounds for size {len(self)}")
+        array_idx, offset = self.locate(index)
+        return self.arrays[array_idx][offset]
+
+
 class CIFAR10C(VisionDataset):
     """The corrupted CIFAR-10-C Dataset.
 
@@ -83,6 +135,12 @@ class CIFAR10C(VisionDataset):
     ]
     url = "https://zenodo.org/record/2535967/files/CIFAR-10-C.tar"
     filename = "CIFAR-10-C.tar"
+    integrity_file = ".integrity.json"
+
+    # verified (path, size, mtime) and read-only memory maps, shared by
+    # every instance so a corruption file is hashed and mapped only once
+    _verified = set()
+    _arrays = {}
 
     def __init__(
         self,
@@ -116,19 +174,30 @@ class CIFAR10C(VisionDataset):
                 f"The subset '{subset}' does not exist in CIFAR-C."
             )
         self.subset = subset
-        self.severity = severity
+        self.set_severity(severity)
 
+    def set_severity(self, severity: int) -> None:
+        """Serve another severity of the same subset from the same mapping."""
         if severity not in list(range(1, 6)):
             raise ValueError(
                 "Corruptions severity should be chosen between 1 and 5 "
                 "included."
             )
+        self.severity = severity
         samples, labels = self.make_dataset(
             self.root, self.subset, self.severity
         )
 
         self.samples = samples
-        self.labels = labels.astype(np.int64)
+        self.labels = labels
+
+    @classmethod
+    def load_array(cls, path: Path) -> np.ndarray:
+        """Read-only memory map of a .npy file, opened once per process."""
+        path = str(path)
+        if path not in cls._arrays:
+            cls._arrays[path] = np.load(path, mmap_mode="r")
+        return cls._arrays[path]
 
     def make_dataset(
         self, root: Path, subset: str, severity: int
@@ -145,37 +214,39 @@ class CIFAR10C(VisionDataset):
                 images.
         Returns:
             Tuple[np.ndarray, np.ndarray]: The samples and labels of the chosen
+                subset, views of the memory-mapped files (``VirtualConcat``
+                for `all`).
         """
+        labels: np.ndarray = self.load_array(root / "labels.npy")[
+            (severity - 1) * 10000 : severity * 10000
+        ].astype(np.int64)
         if subset == "all":
             sample_arrays = []
-            labels: np.ndarray = np.load(root / "labels.npy")[
-                (severity - 1) * 10000 : severity * 10000
-            ]
             for cifar_subset in self.cifarc_subsets:
                 sample_arrays.append(
-                    np.load(root / (cifar_subset + ".npy"))[
+                    self.load_array(root / (cifar_subset + ".npy"))[
                         (severity - 1) * 10000 : severity * 10000
                     ]
                 )
-            samples = np.concatenate(sample_arrays, axis=0)
-            labels = np.tile(labels, len(self.cifarc_subsets))
+            # the label of sample i is labels[i % 10000]
+            samples = VirtualConcat(sample_arrays)
+            labels = VirtualConcat([labels] * len(self.cifarc_subsets))
 
         else:
-            samples: np.ndarray = np.load(root / (subset + ".npy"))[
-                (severity - 1) * 10000 : severity * 10000
-            ]
-            labels: np.ndarray = np.load(root / "labels.npy")[
+            # views of the memory map, no copy
+            samples: np.ndarray = self.load_array(root / (subset + ".npy"))[
                 (severity - 1) * 10000 : severity * 10000
             ]
         return samples, labels
 
     def __len__(self) -> int:
         """The number of samples in the dataset."""
-        return self.labels.shape[0]
+        return len(self.labels)
 
     def __getitem__(self, index: int) -> Any:
+        # copy the image out of the read-only memory map
         sample, target = (
-            self.samples[index],
+            np.array(self.samples[index]),
             self.labels[index],
         )
 
@@ -186,11 +257,44 @@ class CIFAR10C(VisionDataset):
         return sample, target, index
 
     def _check_integrity(self) -> bool:
-        """Check the integrity of the dataset."""
+        """Check the integrity of the dataset.
+
+        The MD5 of a file is only computed again when its size or
+        modification time changed since the last successful check, the
+        results are kept in memory and in ``integrity_file``.
+        """
+        folder = os.path.join(self.root, self.base_folder)
+        record_path = os.path.join(folder, self.integrity_file)
+        record = {}
+        if os.path.exists(record_path):
+            try:
+                with open(record_path) as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                record = {}
+
+        updated = False
         for filename, md5 in self.ctest_list:
-            fpath = os.path.join(self.root, self.base_folder, filename)
-            if not check_integrity(fpath, md5):
+            fpath = os.path.join(folder, filename)
+            if not os.path.isfile(fpath):
                 return False
+            stat = os.stat(fpath)
+            key = (fpath, stat.st_size, stat.st_mtime_ns)
+            if key in self._verified:
+                continue
+            if record.get(filename) != [stat.st_size, stat.st_mtime_ns, md5]:
+                if not check_integrity(fpath, md5):
+                    return False
+                record[filename] = [stat.st_size, stat.st_mtime_ns, md5]
+                updated = True
+            self._verified.add(key)
+
+        if updated:
+            try:
+                with open(record_path, "w") as f:
+                    json.dump(record, f)
+            except OSError:
+                pass
         return True
 
     def download(self) -> None:
@@ -201,3 +305,68 @@ class CIFAR10C(VisionDataset):
         download_and_extract_archive(
             self.url, self.root, filename=self.filename, md5=self.tgz_md5
         )
+
+
+def get_normalization(
+    transform: Optional[Callable],
+) -> Optional[Tuple[Tuple[float, ...], Tuple[float, ...]]]:
+    """Mean and std of a ``Compose([ToTensor(), Normalize(mean, std)])``
+    transform, None for any other transform."""
+    if not isinstance(transform, torchvision.transforms.Compose):
+        return None
+    steps = transform.transforms
+    if (
+        len(steps) == 2
+        and isinstance(steps[0], torchvision.transforms.ToTensor)
+        and isinstance(steps[1], torchvision.transforms.Normalize)
+    ):
+        return tuple(steps[1].mean), tuple(steps[1].std)
+    return None
+
+
+class CIFAR10CBatchLoader:
+    """Batched evaluation loader over the uint8 HWC arrays of CIFAR10C.
+
+    Contiguous blocks of ``batch_size`` images are sliced from the
+    (memory-mapped) array, copied to ``device`` as uint8 and converted /
+    normalized as a whole batch, replacing the per-image ``ToTensor`` and
+    ``Normalize`` of the DataLoader workers. Yields ``(image, target,
+    index)`` batches like a ``DataLoader`` with ``shuffle=False``.
+
+    Args:
+        dataset (CIFAR10C): The dataset, its current subset and severity
+            are read at every iteration.
+        batch_size (int): The number of images per batch.
+        mean (tuple): The per-channel mean of ``Normalize``.
+        std (tuple): The per-channel std of ``Normalize``.
+        device (torch.device, optional): The device of the model.
+            Defaults to the CPU.
+    """
+
+    def __init__(
+        self,
+        dataset: CIFAR10C,
+        batch_size: int,
+        mean: Tuple[float, ...],
+        std: Tuple[float, ...],
+        device: Optional[torch.device] = None,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = torch.device("cpu") if device is None else device
+        self.mean = torch.tensor(mean, device=self.device).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, device=self.device).view(1, -1, 1, 1)
+
+    def __len__(self) -> int:
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        samples, labels = self.dataset.samples, self.dataset.labels
+        for start in range(0, len(self.dataset), self.batch_size):
+            end = min(start + self.batch_size, len(self.dataset))
+            block = torch.from_numpy(np.array(samples[start:end]))
+            image = block.to(self.device, non_blocking=True)
+            image = image.permute(0, 3, 1, 2).float().div_(255)
+            image = image.sub_(self.mean).div_(self.std).contiguous()
+            target = torch.from_numpy(labels[start:end]).to(self.device)
+            yield image, target, torch.arange(start, end)
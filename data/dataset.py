@@ -55,6 +55,15 @@ def TestDataLoader(img_dir, transform_test, batch_size):
 
     return test_loader
 
+# OOD data loader: images of an ImageFolder, every label set to 0 (the folder classes are not the model classes)
+def OODDataLoader(img_dir, transform_test, batch_size):
+    ood_set = CustomImageFolder(img_dir, transform_test)
+    ood_set.samples = [(path, 0) for path, _ in ood_set.samples]
+    ood_set.targets = [0] * len(ood_set.samples)
+    ood_loader = DataLoader(dataset=ood_set, batch_size=batch_size, shuffle=False, num_workers=4, drop_last=False)
+
+    return ood_loader
+
 def get_loader(dataset, train_dir, val_dir, test_dir, batch_size, imb_factor, model_name):
     if dataset in ['cifar10','cifar10_LT']:
         if model_name == 'deit':
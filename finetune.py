@@ -15,6 +15,7 @@ from torch.optim.swa_utils import AveragedModel
 import data.dataset
 import utils.utils
 import utils.option
+import utils.amp
 
 import resource
 
@@ -44,6 +45,8 @@ writer = torch.utils.tensorboard.SummaryWriter(save_pth_path)
 logger = utils.utils.get_logger(save_pth_path)
 logger.info(json.dumps(vars(args), indent=4, sort_keys=True))
 os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+# the GPU when there is one, CPU nodes otherwise
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 train_loader, valid_loader, _, nb_cls = data.dataset.get_loader(args.data_name, args.train_dir, args.val_dir,
                                                                 args.test_dir,
@@ -54,10 +57,10 @@ for r in range(args.nb_run):
     logger.info(100 * '#' + '\n' + prefix)
 
     ## define model, optimizer
-    net = model.get_model.get_model(args.model_name, nb_cls, logger, args)
+    net = model.get_model.get_model(args.model_name, nb_cls, logger, args, device)
     if args.optim_name == 'fmfp' or args.optim_name == 'swa':
         net = AveragedModel(net)
-    net.load_state_dict(torch.load(os.path.join(load_path, f'best_acc_net_{r + 1}.pth')))
+    net.load_state_dict(torch.load(os.path.join(load_path, f'best_acc_net_{r + 1}.pth'), map_location=device))
     freeze_bn_layers(net)
     optimizer, cos_scheduler, swa_model, swa_scheduler = optim.get_optimizer_scheduler(args.model_name,
                                                                                        args.optim_name,
@@ -69,8 +72,10 @@ for r in range(args.nb_run):
                                                                                        swa_lr=args.swa_lr)
 
     # make logger
-    correct_log, best_acc, best_auroc, best_aurc = train_finetune.Correctness_Log(len(train_loader.dataset)), 0, 0, 1e6
+    correct_log, best_acc, best_auroc, best_aurc = train_finetune.Correctness_Log(len(train_loader.dataset), device), 0, 0, 1e6
     confidence_scores = None
+    # AMP loss scale carried over the epochs
+    scaler = utils.amp.get_grad_scaler(args.amp)
 
     # start Train
     for epoch in range(1, args.fine_tune_epochs + 2):
@@ -80,7 +85,8 @@ for r in range(args.nb_run):
             if os.path.exists(confidence_scores_path):
                 confidence_scores = np.load(confidence_scores_path)
                 logger.info('re-weighting...')
-        train_finetune.train(train_loader, net, optimizer, epoch, correct_log, logger, writer, args, confidence_scores)
+        train_finetune.train(train_loader, net, optimizer, epoch, correct_log, logger, writer, args, confidence_scores,
+                             scaler)
 
         if args.optim_name in ['swa', 'fmfp']:
             if epoch > args.swa_epoch_start:
@@ -93,11 +99,12 @@ for r in range(args.nb_run):
 
         # validation
         if epoch > args.swa_epoch_start and args.optim_name in ['swa', 'fmfp']:
-            torch.optim.swa_utils.update_bn(train_loader, swa_model, device='cuda')
-            net_val = swa_model.cuda()
+            torch.optim.swa_utils.update_bn(train_loader, swa_model, device=device)
+            net_val = swa_model.to(device)
         else:
             net_val = net
-        res = valid.validation(valid_loader, net_val)
+        res = valid.validation(valid_loader, net_val, streaming=args.streaming_valid,
+                               device_reduce=args.device_reduce)
         log = [key + ': {:.3f}'.format(res[key]) for key in res]
         msg = '################## \n ---> Validation Epoch {:d}\t'.format(epoch) + '\t'.join(log)
         logger.info(msg)
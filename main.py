@@ -13,6 +13,7 @@ import optim
 import data.dataset
 import utils.utils
 import utils.option
+import utils.amp
 
 
 
@@ -32,6 +33,26 @@ writer = torch.utils.tensorboard.SummaryWriter(save_path)
 logger = utils.utils.get_logger(save_path)
 logger.info(json.dumps(vars(args), indent=4, sort_keys=True))
 os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+# the GPU when there is one, CPU nodes otherwise
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+# log the validation of one epoch and keep the best-accuracy checkpoint, best = {'acc': ...} of the run
+def log_validation(r, epoch, res, net_val, best):
+    log = [key + ': {:.3f}'.format(res[key]) for key in res]
+    msg = '################## \n ---> Validation Epoch {:d}\t'.format(epoch) + '\t'.join(log)
+    logger.info(msg)
+
+    for key in res :
+        if r < 1:
+            writer.add_scalar('./Val/' + key, res[key], epoch)
+
+    if res['Acc.'] > best['acc'] :
+        acc = res['Acc.']
+        msg = f'Accuracy improved from {best["acc"]:.2f} to {acc:.2f}!!!'
+        logger.info(msg)
+        best['acc'] = acc
+        torch.save(net_val.state_dict(),os.path.join(save_path, f'best_acc_net_{r+1}.pth'))
+
 
 train_loader, valid_loader, _, nb_cls = data.dataset.get_loader(args.data_name, args.train_dir, args.val_dir,args.test_dir,
                                                                       args.batch_size, args.imb_factor, args.model_name)
@@ -41,12 +62,12 @@ for r in range(args.nb_run):
     logger.info(100*'#' + '\n' + prefix)
     
     ## define model, optimizer 
-    net = model.get_model.get_model(args.model_name, nb_cls, logger, args)
+    net = model.get_model.get_model(args.model_name, nb_cls, logger, args, device)
     print(net)
     if args.resume:
         if args.optim_name == 'fmfp' or args.optim_name == 'swa':
             net = AveragedModel(net)
-        net.load_state_dict(torch.load(os.path.join(save_path, f'best_acc_net_{r + 1}.pth')))
+        net.load_state_dict(torch.load(os.path.join(save_path, f'best_acc_net_{r + 1}.pth'), map_location=device))
         logger.info(f"Loading checkpoints from {save_path}")
     optimizer, cos_scheduler, swa_model, swa_scheduler = optim.get_optimizer_scheduler(args.model_name,
                                                                                         args.optim_name,
@@ -55,15 +76,29 @@ for r in range(args.nb_run):
                                                                                         args.momentum,
                                                                                         args.weight_decay,
                                                                                         max_epoch_cos = args.epochs,
-                                                                                        swa_lr = args.swa_lr)
+                                                                                        swa_lr = args.swa_lr,
+                                                                                        sam_k = args.sam_k,
+                                                                                        sam_alpha = args.sam_alpha)
 
 
     # make logger
-    correct_log, best_acc, best_auroc, best_aurc = train.Correctness_Log(len(train_loader.dataset)), 0, 0, 1e6
+    correct_log, best_acc, best_auroc, best_aurc = train.Correctness_Log(len(train_loader.dataset), device), 0, 0, 1e6
+    best = {'acc': best_acc}
+    validator = None
+    if args.async_valid:
+        # results are logged by the background thread, in epoch order
+        on_result = lambda epoch, res, net_val, r=r, best=best: log_validation(r, epoch, res, net_val, best)
+        validator = valid.Async_Validation(valid_loader, on_result, streaming=args.streaming_valid,
+                                           device_reduce=args.device_reduce)
+        # the background thread re-estimates the SWA BN statistics on its own loader, never on train_loader
+        bn_loader = torch.utils.data.DataLoader(train_loader.dataset, batch_size=args.batch_size, shuffle=True,
+                                                num_workers=4)
 
     # start Train
+    # AMP loss scale carried over the epochs
+    scaler = utils.amp.get_grad_scaler(args.amp)
     for epoch in range(1, args.epochs + 2):
-        train.train(train_loader, net, optimizer, epoch, correct_log, logger, writer, args)
+        train.train(train_loader, net, optimizer, epoch, correct_log, logger, writer, args, scaler)
 
         if args.optim_name in ['swa', 'fmfp'] :
             if epoch > args.swa_epoch_start:
@@ -75,26 +110,22 @@ for r in range(args.nb_run):
             cos_scheduler.step()
 
         # validation
-        if epoch > args.swa_epoch_start and args.optim_name in ['swa', 'fmfp'] :
-            torch.optim.swa_utils.update_bn(train_loader, swa_model, device='cuda')
-            net_val = swa_model.cuda()
+        swa_val = epoch > args.swa_epoch_start and args.optim_name in ['swa', 'fmfp']
+        if validator is not None:
+            # the BN statistics of the SWA snapshot are re-estimated by the background thread
+            validator.submit(epoch, swa_model.to(device) if swa_val else net, bn_loader if swa_val else None)
+            continue
+        if swa_val :
+            torch.optim.swa_utils.update_bn(train_loader, swa_model, device=device)
+            net_val = swa_model.to(device)
         else : 
             net_val = net
-        res = valid.validation(valid_loader, net_val)
-        log = [key + ': {:.3f}'.format(res[key]) for key in res]
-        msg = '################## \n ---> Validation Epoch {:d}\t'.format(epoch) + '\t'.join(log)
-        logger.info(msg)
-
-        for key in res :
-            if r < 1:
-                writer.add_scalar('./Val/' + key, res[key], epoch)
+        res = valid.validation(valid_loader, net_val, streaming=args.streaming_valid,
+                               device_reduce=args.device_reduce)
+        log_validation(r, epoch, res, net_val, best)
 
-        if res['Acc.'] > best_acc :
-            acc = res['Acc.']
-            msg = f'Accuracy improved from {best_acc:.2f} to {acc:.2f}!!!'
-            logger.info(msg)
-            best_acc = acc
-            torch.save(net_val.state_dict(),os.path.join(save_path, f'best_acc_net_{r+1}.pth'))
+    if validator is not None:
+        validator.close()
 
 
 
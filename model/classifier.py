@@ -30,4 +30,24 @@ class Classifier(torch.nn.Module):
         weight, bias = self.get_weight()
         cls_score = self.apply(feature, weight, bias)
 
-        return cls_score
\ No newline at end of file
+        return cls_score
+
+# Last classification layer of a model zoo network and its weight as (nb_cls, feat_dim)
+def get_classifier(net):
+    # unwrap the wrappers holding the network as .module (AveragedModel, DataParallel, utils.post_hoc.Calibrated_Net,
+    # utils.tta.TTA_Net)
+    while isinstance(getattr(net, 'module', None), torch.nn.Module):
+        net = net.module
+
+    if hasattr(net, 'head'):                                    # DeiT
+        classifier = net.head
+    elif getattr(net, 'use_cos', False):
+        classifier = net.cos_classifier if hasattr(net, 'cos_classifier') else net.classifier
+    else:
+        classifier = net.linear if hasattr(net, 'linear') else net.fc
+
+    if isinstance(classifier, Classifier):
+        weight = classifier.weight.t()
+    else:
+        weight = classifier.weight
+    return classifier, weight
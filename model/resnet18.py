@@ -60,7 +60,9 @@ class ResNet(nn.Module):
     def __init__(self, block, num_blocks, num_classes=100, use_cos=False, cos_temp=8):
         super(ResNet, self).__init__()
         self.in_planes = 64
+        # Monte-Carlo dropout on the penultimate features, active in eval mode (see utils.mc_dropout)
         self.mc_dropout = False
+        self.mc_droprate = 0.5
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3, stride=1, padding=1, bias=False)
         self.bn1 = nn.BatchNorm2d(64)
         self.layer1 = self._make_layer(block, 64, num_blocks[0], stride=1)
@@ -87,6 +89,8 @@ class ResNet(nn.Module):
         dim = out.size()[-1]
         out = F.avg_pool2d(out, dim)
         out = out.view(out.size(0), -1)
+        if self.mc_dropout:
+            out = F.dropout(out, p=self.mc_droprate, training=True)
         if self.use_cos:
             y = self.classifier(out)
         else:
@@ -14,15 +14,22 @@ def get_optimizer_scheduler(model_name,
                             momentum,
                             weight_decay,
                             max_epoch_cos = 200,
-                            swa_lr = 0.05) :
+                            swa_lr = 0.05,
+                            sam_k = 1,
+                            sam_alpha = 0.7) :
+
+    ## sam every step, or the ascent every sam_k steps (LookSAM)
+    sam_kwargs = dict(k=sam_k, alpha=sam_alpha) if sam_k > 1 else {}
+    sam_class = utils.sam.LookSAM if sam_k > 1 else utils.sam.SAM
 
     ## sgd + sam
     sgd_optimizer = torch.optim.SGD(net.parameters(), lr=lr, momentum=momentum, weight_decay=weight_decay)
-    sam_sgd = utils.sam.SAM(net.parameters(), torch.optim.SGD, lr=lr, momentum=momentum, weight_decay=weight_decay)
+    sam_sgd = sam_class(net.parameters(), torch.optim.SGD, lr=lr, momentum=momentum, weight_decay=weight_decay,
+                        **sam_kwargs)
 
     ## adamw + sam
     adamw_optimizer = torch.optim.AdamW(net.parameters(), lr=lr, weight_decay=weight_decay)
-    sam_adamw = utils.sam.SAM(net.parameters(), torch.optim.AdamW, lr=lr, weight_decay=weight_decay)
+    sam_adamw = sam_class(net.parameters(), torch.optim.AdamW, lr=lr, weight_decay=weight_decay, **sam_kwargs)
 
     ## convmixer uses adamw optimzer while cnn backbones uses sgd
     if model_name in ["convmixer", "vit_cifar"] :
@@ -1,6 +1,9 @@
 import torch
 import valid
 import os
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import utils.test_option
 import data.dataset
 import data.CIFAR10C
@@ -10,73 +13,369 @@ from torch.optim.swa_utils import AveragedModel
 import csv
 from torch.utils.data import DataLoader
 import torchvision.transforms
+import utils.bootstrap
+import utils.confidence
+import utils.calibration
+import utils.prediction_store
+import utils.post_hoc
+import utils.tta
+import utils.ood
 
-def process_results(loader, model, metrics, logger, method_name, results_storage):
-    res = valid.validation(loader, model)
-    for metric in metrics:
-        results_storage[metric].append(res[metric])
-    log = [f"{key}: {res[key]:.3f}" for key in res]
-    logger.info(f'################## \n ---> Test {method_name} results：\t' + '\t'.join(log))
+def process_results(loader, model, metrics, logger, results_storage, store=None):
+    # res and per-sample log of every confidence score
+    if args.scores != ['MSP']:
+        method_res, val_log = valid.multi_score_validation(loader, model, args.scores,
+                                                           full_calibration=args.full_calibration, return_log=True,
+                                                           store=store)
+        method_confidence = {method: val_log['scores'][:, k] for k, method in enumerate(args.scores)}
+    elif args.nb_boot > 0 or args.full_calibration:
+        res, metric_log = valid.validation(loader, model, full_calibration=args.full_calibration,
+                                           device_reduce=args.device_reduce, return_log=True, store=store)
+        method_res, val_log = {'MSP': res}, metric_log.get_log()
+        method_confidence = {'MSP': val_log['confidence']}
+    else:
+        res = valid.validation(loader, model, full_calibration=args.full_calibration, streaming=args.streaming_valid,
+                               device_reduce=args.device_reduce, store=store)
+        method_res, val_log = {'MSP': res}, None
+    method_log = {method: val_log for method in method_res}
 
+    # MC dropout scores come from their own stochastic passes (never cached) and their own predictions
+    if args.mc_dropout > 0:
+        mc_res, mc_log = valid.mc_dropout_validation(loader, model, args.mc_dropout, args.mc_droprate,
+                                                     args.mc_head_only, full_calibration=args.full_calibration,
+                                                     return_log=True)
+        for k, method in enumerate(utils.confidence.MC_SCORES):
+            method_res[method], method_log[method] = mc_res[method], mc_log
+            if args.nb_boot > 0 or args.full_calibration:
+                method_confidence[method] = mc_log['scores'][:, k]
 
-def test_cifar10c_corruptions(model, test_dir, transform_test, batch_size, metrics, logger):
+    method_ci, method_diagram = {}, {}
+    for method_name, res in method_res.items():
+        for metric in metrics:
+            results_storage[method_name][metric].append(res[metric])
+        log = [f"{key}: {res[key]:.3f}" for key in res]
+        logger.info(f'################## \n ---> Test {method_name} results：\t' + '\t'.join(log))
+        if args.full_calibration and method_name in utils.confidence.PROBABILITY_SCORES:
+            val_log = method_log[method_name]
+            method_diagram[method_name] = utils.calibration.calc_reliability_diagram(
+                method_confidence[method_name], val_log['pred'] == val_log['target'], bins=15)
+
+        if args.nb_boot > 0:
+            val_log = method_log[method_name]
+            ci = utils.bootstrap.bootstrap_ci(method_confidence[method_name], val_log['pred'] == val_log['target'],
+                                              val_log['nll'], val_log['brier'], nb_boot=args.nb_boot,
+                                              alpha=args.boot_alpha, nb_worker=args.boot_worker)
+            if method_name not in utils.confidence.PROBABILITY_SCORES:
+                ci.pop('ECE')
+            log = [f"{key}: [{ci[key][0]:.3f}, {ci[key][1]:.3f}]" for key in ci]
+            logger.info(f'---> Test {method_name} bootstrap confidence intervals：\t' + '\t'.join(log))
+            method_ci[method_name] = ci
+
+    return method_ci, method_diagram
+
+
+# Stored predictions of a TTA network are kept apart from the plain ones
+def get_store_tag():
+    return f"tta-{'-'.join(sorted(args.tta))}-{args.tta_aggregate}" if args.tta else ''
+
+
+# Prediction store of a checkpoint on a dataset (None without --pred-cache-dir), calibrated when a calibrator is given
+def get_store(checkpoint_path, dataset, calibrator=None, save_feature=False, checkpoint_hash=None):
+    if args.pred_cache_dir is None or checkpoint_path is None:
+        return None
+    store = utils.prediction_store.Prediction_Store(args.pred_cache_dir, checkpoint_path, dataset, topk=args.cache_topk,
+                                                    save_feature=save_feature, tag=get_store_tag(),
+                                                    checkpoint_hash=checkpoint_hash)
+    if calibrator is not None:
+        store = utils.post_hoc.Calibrated_Store(store, calibrator)
+    return store
+
+
+# Post-hoc calibration fitted on the validation logits, read from the prediction store when enabled
+def fit_calibrator(valid_loader, net, checkpoint_path, logger):
+    if args.pred_cache_dir is not None:
+        arrays = utils.prediction_store.Prediction_Store(args.pred_cache_dir, checkpoint_path, valid_loader.dataset,
+                                                         tag=get_store_tag()).load_or_write(valid_loader, net)
+        logit, target = arrays['logit'], arrays['target']
+    else:
+        logit, target = valid.collect_logits(valid_loader, net)
+    calibrator = utils.post_hoc.fit_post_hoc(logit, target, args.post_hoc, args.init_temp, args.lr_temp, args.iters_temp)
+    if args.post_hoc == 'temperature':
+        logger.info(f'Fitted temperature: {calibrator.log_temp.exp().item():.4f}')
+
+    return calibrator
+
+
+# OOD detection of the test set against every --ood-dir set, from stored logits and features (see utils.ood)
+# the stores live in --pred-cache-dir, or in the save path when the cache is disabled
+def test_ood(net, checkpoint_path, test_loader, logger, save_path):
+    cache_dir = args.pred_cache_dir if args.pred_cache_dir is not None else os.path.join(save_path, 'pred_cache')
+    save_feature = any(name in utils.ood.FEATURE_SCORES for name in args.ood_scores)
+    transform_test = test_loader.dataset.transform
+
+    def load_arrays(loader):
+        store = utils.prediction_store.Prediction_Store(cache_dir, checkpoint_path, loader.dataset,
+                                                        topk=args.cache_topk, save_feature=save_feature,
+                                                        tag=get_store_tag())
+        return store.load_or_write(loader, net)
+
+    scorer = utils.ood.OOD_Scorer(knn_k=args.knn_k)
+    if save_feature:
+        fit_dir = args.ood_fit_dir if args.ood_fit_dir is not None else args.train_dir
+        scorer.fit(load_arrays(data.dataset.TestDataLoader(fit_dir, transform_test, args.batch_size)))
+
+    id_scores = scorer.scores(load_arrays(test_loader), args.ood_scores)
+    ood_scores = {os.path.basename(os.path.normpath(ood_dir)): scorer.scores(
+        load_arrays(data.dataset.OODDataLoader(ood_dir, transform_test, args.batch_size)), args.ood_scores)
+        for ood_dir in args.ood_dir}
+
+    ood_results = utils.ood.ood_results(id_scores, ood_scores, args.ood_scores)
+    for ood_name, score_results in ood_results.items():
+        for score, res in score_results.items():
+            log = [f"{key}: {res[key]:.3f}" for key in res]
+            logger.info(f'---> OOD {ood_name} {score} results：\t' + '\t'.join(log))
+    return ood_results
+
+
+def test_cifar10c_corruptions(model, test_dir, transform_test, batch_size, metrics, logger, checkpoint_path=None,
+                              calibrator=None):
     cor_results_storage = {corruption: {severity: {metric: [] for metric in metrics} for severity in range(1, 6)} for
                            corruption in data.CIFAR10C.CIFAR10C.cifarc_subsets}
 
     for corruption in data.CIFAR10C.CIFAR10C.cifarc_subsets:
+        # one memory map per corruption file, every severity is a slice of it
+        corrupted_test_dataset = data.CIFAR10C.CIFAR10C(root=test_dir, transform=transform_test, subset=corruption,
+                                                        severity=1, download=True)
+        # uint8 blocks normalized batch-wise on the model device, no worker processes
+        normalization = data.CIFAR10C.get_normalization(transform_test)
+        if normalization is not None:
+            corrupted_test_loader = data.CIFAR10C.CIFAR10CBatchLoader(corrupted_test_dataset, batch_size,
+                                                                      *normalization, device=valid.get_device(model))
         for severity in range(1, 6):
             logger.info(f"Testing on corruption: {corruption}, severity: {severity}")
-            corrupted_test_dataset = data.CIFAR10C.CIFAR10C(root=test_dir, transform=transform_test, subset=corruption,
-                                                            severity=severity, download=True)
-            corrupted_test_loader = DataLoader(dataset=corrupted_test_dataset, batch_size=batch_size, shuffle=False,
-                                               num_workers=4, drop_last=False)
-            res = valid.validation(corrupted_test_loader, model)
+            corrupted_test_dataset.set_severity(severity)
+            if normalization is None:
+                corrupted_test_loader = DataLoader(dataset=corrupted_test_dataset, batch_size=batch_size,
+                                                   shuffle=False, num_workers=4, drop_last=False)
+            store = get_store(checkpoint_path, corrupted_test_dataset, calibrator)
+            res = valid.validation(corrupted_test_loader, model, full_calibration=args.full_calibration,
+                                   streaming=args.streaming_valid, device_reduce=args.device_reduce, store=store)
+            for metric in metrics:
+                cor_results_storage[corruption][severity][metric].append(res[metric])
+
+    return cor_results_storage
+
+
+_worker = {}
+
+
+# Load the model once per process, intra-op threads pinned per process; the processes are spawned and never see
+# the command line, every option they use is passed here
+# store_options: Prediction_Store keyword arguments (root, topk, tag), None without prediction store
+# valid_options: valid.validation keyword arguments
+def _init_cifar10c_worker(net, test_dir, transform_test, batch_size, nb_thread, checkpoint_path, checkpoint_hash,
+                          calibrator, store_options, valid_options):
+    torch.set_num_threads(nb_thread)
+    _worker.update({'net': net.cpu().eval(), 'test_dir': test_dir, 'transform_test': transform_test,
+                    'batch_size': batch_size, 'checkpoint_path': checkpoint_path, 'checkpoint_hash': checkpoint_hash,
+                    'calibrator': calibrator, 'store_options': store_options, 'valid_options': valid_options})
+
+
+# res of one (corruption, severity) cell of the CIFAR-10-C grid
+def _eval_cifar10c_cell(cell):
+    corruption, severity = cell
+    corrupted_test_dataset = data.CIFAR10C.CIFAR10C(root=_worker['test_dir'], transform=_worker['transform_test'],
+                                                    subset=corruption, severity=severity)
+    normalization = data.CIFAR10C.get_normalization(_worker['transform_test'])
+    if normalization is not None:
+        corrupted_test_loader = data.CIFAR10C.CIFAR10CBatchLoader(corrupted_test_dataset, _worker['batch_size'],
+                                                                  *normalization)
+    else:
+        corrupted_test_loader = DataLoader(dataset=corrupted_test_dataset, batch_size=_worker['batch_size'],
+                                           shuffle=False, num_workers=0, drop_last=False)
+    store = None
+    if _worker['store_options'] is not None:
+        store = utils.prediction_store.Prediction_Store(checkpoint_path=_worker['checkpoint_path'],
+                                                        dataset=corrupted_test_dataset,
+                                                        checkpoint_hash=_worker['checkpoint_hash'],
+                                                        **_worker['store_options'])
+        if _worker['calibrator'] is not None:
+            store = utils.post_hoc.Calibrated_Store(store, _worker['calibrator'])
+    res = valid.validation(corrupted_test_loader, _worker['net'], store=store, **_worker['valid_options'])
+    return corruption, severity, res
+
+
+# CIFAR-10-C grid on a pool of CPU processes, same output as test_cifar10c_corruptions
+def test_cifar10c_corruptions_parallel(model, test_dir, transform_test, batch_size, metrics, logger,
+                                       checkpoint_path=None, nb_worker=2, nb_thread=0, calibrator=None):
+    cor_results_storage = {corruption: {severity: {metric: [] for metric in metrics} for severity in range(1, 6)} for
+                           corruption in data.CIFAR10C.CIFAR10C.cifarc_subsets}
+    nb_thread = nb_thread if nb_thread > 0 else max(1, (os.cpu_count() or 1) // nb_worker)
+    # verify the files once here rather than in every process
+    data.CIFAR10C.CIFAR10C(root=test_dir, subset=data.CIFAR10C.CIFAR10C.cifarc_subsets[0], download=True)
+
+    cells = [(corruption, severity) for corruption in data.CIFAR10C.CIFAR10C.cifarc_subsets
+             for severity in range(1, 6)]
+    cpu_model = copy.deepcopy(model).cpu()
+    # hashed once here, the processes never read the checkpoint
+    checkpoint_hash, store_options = None, None
+    if checkpoint_path is not None and args.pred_cache_dir is not None:
+        checkpoint_hash = utils.prediction_store.hash_checkpoint(checkpoint_path)
+        store_options = {'root': args.pred_cache_dir, 'topk': args.cache_topk, 'tag': get_store_tag()}
+    valid_options = {'full_calibration': args.full_calibration, 'streaming': args.streaming_valid,
+                     'device_reduce': args.device_reduce}
+    # spawn rather than fork: the parent already started torch / OpenMP threads
+    with ProcessPoolExecutor(max_workers=nb_worker, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_cifar10c_worker,
+                             initargs=(cpu_model, test_dir, transform_test, batch_size, nb_thread, checkpoint_path,
+                                       checkpoint_hash, calibrator, store_options, valid_options)) as executor:
+        for corruption, severity, res in executor.map(_eval_cifar10c_cell, cells):
+            logger.info(f"Tested corruption: {corruption}, severity: {severity}")
             for metric in metrics:
                 cor_results_storage[corruption][severity][metric].append(res[metric])
 
     return cor_results_storage
 
 
+def load_net(r, nb_cls, logger, save_path):
+    net = model.get_model.get_model(args.model_name, nb_cls, logger, args)
+    if args.optim_name == 'fmfp' or args.optim_name == 'swa':
+        net = AveragedModel(net)
+    checkpoint_path = os.path.join(save_path, f'best_acc_net_{r + 1}.pth')
+    net.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+    net = net.cuda() if torch.cuda.is_available() else net
+    if args.tta:
+        net = utils.tta.TTA_Net(net, args.tta, args.tta_aggregate, args.tta_chunk)
+
+    return net, checkpoint_path
+
+
+def get_cifar10c_transform():
+    return torchvision.transforms.Compose([
+        torchvision.transforms.ToTensor(),
+        torchvision.transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))
+    ])
+
+
+# Every checkpoint and their averaged-softmax ensemble, each test / CIFAR-10-C batch is decoded once for all models
+def test_ensemble(test_loader, nb_cls, metrics, logger, save_path):
+    nets = [load_net(r, nb_cls, logger, save_path)[0] for r in range(args.nb_run)]
+    model_names = [f"model_{r + 1}" for r in range(args.nb_run)]
+
+    model_res, ensemble_res = valid.ensemble_validation(test_loader, nets, full_calibration=args.full_calibration)
+    for name, res in zip(model_names + ['ensemble'], model_res + [ensemble_res]):
+        log = [f"{key}: {res[key]:.3f}" for key in res]
+        logger.info(f'################## \n ---> Test {name} results：\t' + '\t'.join(log))
+    results = {
+        'MSP': {metric: utils.utils.compute_statistics([res[metric] for res in model_res]) for metric in metrics},
+        'MSP_Ensemble': {metric: {"mean": ensemble_res[metric], "std": 0.} for metric in metrics},
+    }
+    utils.utils.csv_writter(os.path.join(save_path, 'test_results.csv'), args.data_name, args.model_name, metrics,
+                            results)
+
+    if args.data_name == 'cifar10':
+        transform_test = get_cifar10c_transform()
+        cor_results_all_models = {name: {corruption: {} for corruption in data.CIFAR10C.CIFAR10C.cifarc_subsets}
+                                  for name in model_names + ['ensemble']}
+        for corruption in data.CIFAR10C.CIFAR10C.cifarc_subsets:
+            corrupted_test_dataset = data.CIFAR10C.CIFAR10C(root=args.corruption_dir, transform=transform_test,
+                                                            subset=corruption, severity=1, download=True)
+            corrupted_test_loader = data.CIFAR10C.CIFAR10CBatchLoader(
+                corrupted_test_dataset, args.batch_size, *data.CIFAR10C.get_normalization(transform_test),
+                device=valid.get_device(nets[0]))
+            for severity in range(1, 6):
+                logger.info(f"Testing on corruption: {corruption}, severity: {severity}")
+                corrupted_test_dataset.set_severity(severity)
+                model_res, ensemble_res = valid.ensemble_validation(corrupted_test_loader, nets,
+                                                                    full_calibration=args.full_calibration)
+                for name, res in zip(model_names + ['ensemble'], model_res + [ensemble_res]):
+                    cor_results_all_models[name][corruption][severity] = {metric: res[metric] for metric in metrics}
+        utils.utils.save_cifar10c_results_to_csv(save_path, metrics, cor_results_all_models)
+
+
 def test():
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    if args.tta and 'Cosine' in args.scores:
+        raise ValueError('The Cosine score reads the features of a single view, it is not available with --tta')
+    if args.tta and args.mc_head_only:
+        raise ValueError('Head-only MC dropout reads the features of a single view, it is not available with --tta')
+    if args.tta and args.ood_dir and any(name in utils.ood.FEATURE_SCORES for name in args.ood_scores):
+        raise ValueError('Mahalanobis and KNN read the features of a single view, they are not available with --tta')
+    # the log mean softmax of the views has a logsumexp of 0: Energy is constant and MaxLogit is log(MSP)
+    logit_scores = ['Energy', 'MaxLogit']
+    if args.tta and args.tta_aggregate == 'softmax' and (
+            any(name in logit_scores for name in args.scores) or
+            args.ood_dir and any(name in logit_scores for name in args.ood_scores)):
+        raise ValueError('Energy and MaxLogit need the logits of the views, use --tta-aggregate logit or other scores '
+                         'with --tta-aggregate softmax')
+    methods = args.scores + (utils.confidence.MC_SCORES if args.mc_dropout > 0 else [])
     metrics = ['Acc.', 'AUROC', 'AUPR Succ.', 'AUPR', 'FPR', 'AURC', 'EAURC', 'ECE', 'NLL', 'Brier']
-    results_storage = {metric: [] for metric in metrics}
+    if args.full_calibration:
+        metrics += ['AdaECE', 'MCE', 'RMSCE', 'CwECE']
+    results_storage = {method: {metric: [] for metric in metrics} for method in methods}
     cor_results_all_models = {}
+    ood_results_all_models = {}
+    diagrams_all_models = {}
+    ci_results = {method: {} for method in methods} if args.nb_boot > 0 else None
 
     save_path = os.path.join(args.save_dir,
                              f"{args.data_name}_{args.model_name}_{args.optim_name}-mixup_{args.mixup_weight}-crl_{args.crl_weight}")
     logger = utils.utils.get_logger(save_path)
 
+    # the loaders do not depend on the run
+    _, valid_loader, test_loader, nb_cls = data.dataset.get_loader(args.data_name, args.train_dir, args.val_dir,
+                                                                   args.test_dir, args.batch_size, args.imb_factor, args.model_name)
+    print(nb_cls)
+    if args.ensemble:
+        test_ensemble(test_loader, nb_cls, metrics, logger, save_path)
+        return
+
     for r in range(args.nb_run):
         logger.info(f'Testing model_{r + 1} ...')
-        _, valid_loader, test_loader, nb_cls = data.dataset.get_loader(args.data_name, args.train_dir, args.val_dir,
-                                                                       args.test_dir, args.batch_size, args.imb_factor, args.model_name)
-        print(nb_cls)
-        net = model.get_model.get_model(args.model_name, nb_cls, logger, args)
-        if args.optim_name == 'fmfp' or args.optim_name == 'swa':
-            net = AveragedModel(net)
-        net.load_state_dict(torch.load(os.path.join(save_path, f'best_acc_net_{r + 1}.pth')))
-        net = net.cuda()
-        process_results(test_loader, net, metrics, logger, "MSP", results_storage)
+        net, checkpoint_path = load_net(r, nb_cls, logger, save_path)
+        # OOD scores of the uncalibrated network
+        if args.ood_dir:
+            ood_results_all_models[f"model_{r + 1}"] = test_ood(net, checkpoint_path, test_loader, logger, save_path)
+        calibrator = None
+        if args.post_hoc != 'none':
+            calibrator = fit_calibrator(valid_loader, net, checkpoint_path, logger)
+        store = get_store(checkpoint_path, test_loader.dataset, calibrator,
+                          save_feature=args.cache_feature or 'Cosine' in args.scores)
+        if calibrator is not None:
+            net = utils.post_hoc.Calibrated_Net(net, calibrator)
+        method_ci, method_diagram = process_results(test_loader, net, metrics, logger, results_storage, store)
+        for method, ci in method_ci.items():
+            ci_results[method][f"model_{r + 1}"] = ci
+        if method_diagram:
+            diagrams_all_models[f"model_{r + 1}"] = method_diagram
 
         if args.data_name == 'cifar10':
-            transform_test = torchvision.transforms.Compose([
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))
-            ])
-            cor_results_storage = test_cifar10c_corruptions(net, args.corruption_dir, transform_test, args.batch_size,
-                                                            metrics, logger)
+            transform_test = get_cifar10c_transform()
+            if args.cifar10c_worker > 0:
+                cor_results_storage = test_cifar10c_corruptions_parallel(net, args.corruption_dir, transform_test,
+                                                                         args.batch_size, metrics, logger,
+                                                                         checkpoint_path, args.cifar10c_worker,
+                                                                         args.cifar10c_thread, calibrator)
+            else:
+                cor_results_storage = test_cifar10c_corruptions(net, args.corruption_dir, transform_test,
+                                                                args.batch_size, metrics, logger, checkpoint_path,
+                                                                calibrator)
             cor_results = {corruption: {
                 severity: {metric: cor_results_storage[corruption][severity][metric][0] for metric in metrics} for severity
                 in range(1, 6)} for corruption in data.CIFAR10C.CIFAR10C.cifarc_subsets}
             cor_results_all_models[f"model_{r + 1}"] = cor_results
 
-    results = {metric: utils.utils.compute_statistics(results_storage[metric]) for metric in metrics}
+    results = {method: {metric: utils.utils.compute_statistics(results_storage[method][metric]) for metric in metrics}
+               for method in methods}
     test_results_path = os.path.join(save_path, 'test_results.csv')
-    utils.utils.csv_writter(test_results_path, args.data_name, args.model_name, metrics, results)
+    utils.utils.csv_writter(test_results_path, args.data_name, args.model_name, metrics, results, ci_results)
+    if args.full_calibration:
+        utils.utils.save_reliability_diagrams_to_csv(save_path, diagrams_all_models)
     if args.data_name == 'cifar10':
         utils.utils.save_cifar10c_results_to_csv(save_path, metrics, cor_results_all_models)
+    if args.ood_dir:
+        utils.utils.save_ood_results_to_csv(save_path, utils.ood.OOD_METRICS, ood_results_all_models)
 
 if __name__ == '__main__':
     args = utils.test_option.get_args_parser()
@@ -0,0 +1,65 @@
+import pytest
+import torch
+import torch.nn as nn
+from torch.optim.swa_utils import AveragedModel, update_bn
+import valid
+
+'''
+Background validation against the synchronous validation of the same weights, with the SWA BN statistics
+re-estimated by the worker thread on its own loader.
+'''
+
+
+def make_net_loaders(nb_cls=5):
+    torch.manual_seed(0)
+    net = nn.Sequential(nn.Conv2d(3, 8, 1), nn.BatchNorm2d(8), nn.ReLU(), nn.Flatten(), nn.Linear(32, nb_cls))
+    image, target = torch.randn(256, 3, 2, 2) * 2 + 1, torch.randint(0, nb_cls, (256,))
+    train_loader = [(image[i:i + 32], target[i:i + 32], torch.arange(i, i + 32)) for i in range(0, 256, 32)]
+    image, target = torch.randn(150, 3, 2, 2), torch.randint(0, nb_cls, (150,))
+    valid_loader = [(image[i:i + 50], target[i:i + 50], torch.arange(i, i + 50)) for i in range(0, 150, 50)]
+    return net, train_loader, valid_loader
+
+
+def assert_res_close(res, reference):
+    assert res.keys() == reference.keys()
+    for key in reference:
+        assert res[key] == pytest.approx(reference[key], rel=1e-5, abs=1e-4), key
+
+
+def test_async_matches_sync():
+    net, train_loader, valid_loader = make_net_loaders()
+    swa_model = AveragedModel(net)
+    results = []
+    validator = valid.Async_Validation(valid_loader, lambda epoch, res, net_val: results.append((epoch, res)))
+
+    reference = []
+    for epoch in range(1, 4):
+        # a training step between the submissions: the snapshots hold the weights of their epoch
+        with torch.no_grad():
+            for param in net.parameters():
+                param.add_(0.1 * torch.randn_like(param))
+        net.eval()
+        reference.append(valid.validation(valid_loader, net))
+        validator.submit(epoch, net)
+
+        swa_model.update_parameters(net)
+        validator.submit(epoch, swa_model, train_loader)
+        swa_reference = AveragedModel(net)
+        swa_reference.load_state_dict(swa_model.state_dict())
+        update_bn(train_loader, swa_reference)
+        reference.append(valid.validation(valid_loader, swa_reference))
+    validator.close()
+
+    assert [epoch for epoch, _ in results] == [1, 1, 2, 2, 3, 3]
+    for (_, res), res_reference in zip(results, reference):
+        assert_res_close(res, res_reference)
+    # the BN statistics of the training copy are not touched by the worker
+    assert torch.equal(swa_model.module[1].running_mean, torch.zeros(8))
+
+
+def test_worker_error_raised():
+    net, train_loader, valid_loader = make_net_loaders()
+    validator = valid.Async_Validation(valid_loader, lambda epoch, res, net_val: None)
+    validator.submit(1, net, [(torch.randn(4, 5, 2, 2),)])
+    with pytest.raises(RuntimeError):
+        validator.join()
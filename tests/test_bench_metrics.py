@@ -0,0 +1,21 @@
+import bench_metrics
+
+'''
+Regression check of the benchmark harness: relative tolerance and absolute noise floor.
+'''
+
+
+def test_check_regression_noise_floor():
+    baseline = {'fast': {'time': 0.002}, 'slow': {'time': 1.0}, 'gone': {'time': 1.0}}
+    results = {'fast': {'time': 0.003}, 'slow': {'time': 1.2}, 'new': {'time': 5.0}}
+    # +50% on 2 ms is noise under a 10 ms floor, +20% on 1 s is not
+    assert bench_metrics.check_regression(results, baseline, 10, 0.01) == [('slow', 1.0, 1.2)]
+    assert bench_metrics.check_regression(results, baseline, 30, 0.01) == []
+    assert [key for key, _, _ in bench_metrics.check_regression(results, baseline, 10, 0.)] == ['fast', 'slow']
+
+
+def test_every_benchmark_runs():
+    inputs = bench_metrics.make_predictions(500, 7, 0.8, bench_metrics.np.random.default_rng(0))
+    for func in bench_metrics.BENCHMARKS.values():
+        res = bench_metrics.run_benchmark(func, inputs, 3)
+        assert res['min_time'] <= res['time']
@@ -0,0 +1,42 @@
+import numpy as np
+import utils.bootstrap
+import utils.calibration
+import utils.metrics
+
+'''
+Closed-form bootstrap replicates against the metrics recomputed on the resampled sets.
+'''
+
+
+def test_replicates_match_resampled_metrics():
+    rng = np.random.default_rng(0)
+    nb_sample = 1500
+    confidence = np.round(rng.uniform(0.1, 1, nb_sample), 2)
+    correct = (rng.uniform(size=nb_sample) < confidence).astype(np.float64)
+    nll, brier = rng.uniform(0, 3, nb_sample), rng.uniform(0, 2, nb_sample)
+
+    state = utils.bootstrap.get_bootstrap_state(confidence, correct, nll, brier)
+    res = utils.bootstrap._bootstrap_block(np.random.SeedSequence(5), 4, state)
+    counts = utils.bootstrap.draw_counts(np.random.default_rng(np.random.SeedSequence(5)), 4, nb_sample)
+    for b in range(4):
+        idx = np.repeat(np.arange(nb_sample), counts[b])
+        sample_confidence, sample_correct = state['confidence'][idx], state['correct'][idx]
+        aurc, eaurc, auroc, aupr_success, aupr, fpr = utils.metrics.calc_ranking_metrics(sample_confidence,
+                                                                                         sample_correct)
+        reference = {'Acc.': sample_correct.mean()*100, 'FPR': fpr*100, 'AUROC': auroc*100, 'AUPR': aupr*100,
+                     'AURC': aurc*1000, 'EAURC': eaurc*1000, 'AUPR Succ.': aupr_success*100,
+                     'ECE': utils.calibration.calc_ece(sample_confidence, sample_correct)*100,
+                     'NLL': state['nll'][idx].mean()*10, 'Brier': state['brier'][idx].mean()*100}
+        for key, value in reference.items():
+            assert np.isclose(res[key][b], value, rtol=1e-9), key
+
+
+def test_ci_independent_of_workers():
+    rng = np.random.default_rng(1)
+    confidence = rng.uniform(0.1, 1, 300)
+    correct = rng.uniform(size=300) < confidence
+    nll, brier = rng.uniform(0, 3, 300), rng.uniform(0, 2, 300)
+    ci = utils.bootstrap.bootstrap_ci(confidence, correct, nll, brier, nb_boot=50)
+    assert ci == utils.bootstrap.bootstrap_ci(confidence, correct, nll, brier, nb_boot=50, nb_worker=2)
+    for low, high in ci.values():
+        assert low <= high
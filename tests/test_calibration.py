@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import torch
+import utils.calibration
+import utils.metrics
+
+'''
+Bincount calibration errors and reliability diagram against the previous loop over the bins.
+'''
+
+
+# previous ECE loop over (lower, upper] bins, with MCE, RMSCE and the diagram from the same bins
+def reference_calibration(confidence, correct, bins=15):
+    boundaries = np.linspace(0, 1, bins + 1)
+    ece, mce, sq, accuracy, average_confidence = 0., 0., 0., np.zeros(bins), np.zeros(bins)
+    for k, (lower, upper) in enumerate(zip(boundaries[:-1], boundaries[1:])):
+        in_bin = (confidence > lower) & (confidence <= upper)
+        if in_bin.any():
+            accuracy[k], average_confidence[k] = correct[in_bin].mean(), confidence[in_bin].mean()
+            gap = abs(average_confidence[k] - accuracy[k])
+            ece, mce, sq = ece + gap * in_bin.mean(), max(mce, gap), sq + gap ** 2 * in_bin.mean()
+    return ece, mce, np.sqrt(sq), accuracy, average_confidence
+
+
+def sample(rng, nb_sample, rounding=None):
+    confidence = rng.uniform(0.05, 1, nb_sample)
+    if rounding is not None:
+        confidence = np.round(confidence, rounding)
+    correct = (rng.uniform(size=nb_sample) < confidence).astype(np.int64)
+    return confidence, correct
+
+
+@pytest.mark.parametrize('rounding', [None, 2])
+def test_calibration_errors_match_loop(rounding):
+    rng = np.random.default_rng(2)
+    for _ in range(10):
+        confidence, correct = sample(rng, rng.integers(20, 2000), rounding)
+        res, diagram = utils.calibration.calc_calibration(confidence, correct)
+        ece, mce, rmsce, accuracy, average_confidence = reference_calibration(confidence, correct)
+        np.testing.assert_allclose([res['ECE'], res['MCE'], res['RMSCE']], [ece, mce, rmsce], rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(diagram['accuracy'], accuracy, atol=1e-12)
+        np.testing.assert_allclose(diagram['confidence'], average_confidence, atol=1e-12)
+        assert diagram['count'].sum() == len(confidence)
+
+
+def test_reliability_diagram_of_confidences():
+    rng = np.random.default_rng(3)
+    confidence, correct = sample(rng, 1000, 2)
+    diagram = utils.calibration.calc_reliability_diagram(confidence, correct)
+    reference = utils.calibration.calc_calibration(confidence, correct)[1]
+    for key in reference:
+        np.testing.assert_array_equal(diagram[key], reference[key])
+
+
+def test_adaptive_bins_hold_equal_mass():
+    confidence = np.random.default_rng(4).uniform(size=1500)
+    count = np.bincount(utils.calibration.get_adaptive_bin_index(confidence, 15), minlength=15)
+    assert count.min() == count.max() == 100
+
+
+def test_ece_from_softmax_matches_loop():
+    rng = np.random.default_rng(5)
+    softmax = torch.softmax(torch.from_numpy(rng.normal(size=(1000, 10)) * 3), 1).float().numpy()
+    label = rng.integers(0, 10, 1000)
+    confidence, pred = softmax.max(1), softmax.argmax(1)
+    assert np.isclose(utils.metrics.calc_ece(softmax, label),
+                      reference_calibration(confidence.astype(np.float64), pred == label)[0], atol=1e-6)
+
+
+def test_classwise_ece_matches_loop():
+    rng = np.random.default_rng(6)
+    softmax = torch.softmax(torch.from_numpy(rng.normal(size=(700, 6)) * 2), 1).numpy()
+    label = rng.integers(0, 6, 700)
+    reference = np.mean([reference_calibration(softmax[:, k], label == k)[0] for k in range(6)])
+    assert np.isclose(utils.calibration.calc_classwise_ece(softmax, label, chunk_size=128), reference, atol=1e-12)
+
+
+def test_calibration_columns():
+    rng = np.random.default_rng(7)
+    confidence = rng.uniform(0.05, 1, (800, 4))
+    correct = rng.integers(0, 2, 800)
+    columns = utils.calibration.calc_calibration_columns(confidence, correct)
+    for k in range(4):
+        res = utils.calibration.calc_calibration(confidence[:, k], correct)[0]
+        for key in columns:
+            assert np.isclose(columns[key][k], res[key])
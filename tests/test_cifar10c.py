@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+import torch
+import torchvision.transforms
+import data.CIFAR10C
+
+'''
+CIFAR10C on a small synthetic copy of the dataset (2x2 images, same file layout): the memory-mapped arrays and the
+cached integrity check against the previous np.load of every file, the batched uint8 loader against the per-image
+transforms of a DataLoader, the virtual concatenation of subset='all' against np.concatenate, the CIFAR-10-C grid on a
+pool of processes against the sequential one on a host without CUDA.
+'''
+
+NB_PIXEL = 2
+
+
+# 20 .npy files of 5 severities x 10000 uint8 images and the md5 list of the copy
+def make_cifar10c(root):
+    folder = os.path.join(root, data.CIFAR10C.CIFAR10C.base_folder)
+    os.makedirs(folder)
+    rng = np.random.default_rng(0)
+    ctest_list = []
+    for filename, _ in data.CIFAR10C.CIFAR10C.ctest_list:
+        path = os.path.join(folder, filename)
+        if filename == 'labels.npy':
+            np.save(path, np.tile(rng.integers(0, 10, 10000), 5).astype(np.uint8))
+        else:
+            np.save(path, rng.integers(0, 256, (50000, NB_PIXEL, NB_PIXEL, 3), dtype=np.uint8))
+        with open(path, 'rb') as f:
+            ctest_list.append([filename, hashlib.md5(f.read()).hexdigest()])
+    return ctest_list
+
+
+@pytest.fixture(scope='module')
+def cifar10c_root(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('cifar10c'))
+    return root, make_cifar10c(root)
+
+
+@pytest.fixture
+def cifar10c(cifar10c_root, monkeypatch):
+    root, ctest_list = cifar10c_root
+    monkeypatch.setattr(data.CIFAR10C.CIFAR10C, 'ctest_list', ctest_list)
+    return root
+
+
+# previous make_dataset: np.load of the whole files
+def reference_samples(root, subset, severity):
+    folder = os.path.join(root, data.CIFAR10C.CIFAR10C.base_folder)
+    rows = slice((severity - 1) * 10000, severity * 10000)
+    labels = np.load(os.path.join(folder, 'labels.npy'))[rows]
+    subsets = data.CIFAR10C.CIFAR10C.cifarc_subsets if subset == 'all' else [subset]
+    samples = np.concatenate([np.load(os.path.join(folder, name + '.npy'))[rows] for name in subsets])
+    return samples, np.tile(labels, len(subsets)).astype(np.int64)
+
+
+@pytest.mark.parametrize('subset, severity', [('fog', 1), ('snow', 5)])
+def test_memory_mapped_samples_match_np_load(cifar10c, subset, severity):
+    dataset = data.CIFAR10C.CIFAR10C(cifar10c, subset=subset, severity=severity)
+    samples, labels = reference_samples(cifar10c, subset, severity)
+    np.testing.assert_array_equal(np.asarray(dataset.samples), samples)
+    np.testing.assert_array_equal(dataset.labels, labels)
+    sample, target, index = dataset[1234]
+    np.testing.assert_array_equal(sample, samples[1234])
+    assert (target, index) == (labels[1234], 1234)
+
+    dataset.set_severity(3)
+    samples, labels = reference_samples(cifar10c, subset, 3)
+    np.testing.assert_array_equal(np.asarray(dataset.samples), samples)
+    np.testing.assert_array_equal(dataset.labels, labels)
+
+
+def test_integrity_checked_once(cifar10c, monkeypatch):
+    data.CIFAR10C.CIFAR10C._verified.clear()
+    record_path = os.path.join(cifar10c, data.CIFAR10C.CIFAR10C.base_folder, data.CIFAR10C.CIFAR10C.integrity_file)
+    if os.path.exists(record_path):
+        os.remove(record_path)
+    calls = []
+    check_integrity = data.CIFAR10C.check_integrity
+    monkeypatch.setattr(data.CIFAR10C, 'check_integrity', lambda path, md5: calls.append(path) or
+                        check_integrity(path, md5))
+
+    data.CIFAR10C.CIFAR10C(cifar10c, subset='fog')
+    assert len(calls) == 20 and os.path.exists(record_path)
+    # same process, then a new process (empty memory record) reading the record file
+    data.CIFAR10C.CIFAR10C(cifar10c, subset='fog', severity=2)
+    data.CIFAR10C.CIFAR10C._verified.clear()
+    data.CIFAR10C.CIFAR10C(cifar10c, subset='fog', severity=3)
+    assert len(calls) == 20
+
+
+def test_modified_file_is_checked_again(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    monkeypatch.setattr(data.CIFAR10C.CIFAR10C, 'ctest_list', make_cifar10c(root))
+    data.CIFAR10C.CIFAR10C(root, subset='fog')
+    path = os.path.join(root, data.CIFAR10C.CIFAR10C.base_folder, 'fog.npy')
+    fog = np.load(path)
+    fog[0, 0, 0, 0] ^= 1
+    np.save(path, fog)
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+    with pytest.raises(RuntimeError):
+        data.CIFAR10C.CIFAR10C(root, subset='fog')
+
+
+def test_batch_loader_matches_dataloader(cifar10c):
+    mean, std = (0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)
+    transform = torchvision.transforms.Compose([torchvision.transforms.ToTensor(),
+                                                torchvision.transforms.Normalize(mean, std)])
+    dataset = data.CIFAR10C.CIFAR10C(cifar10c, transform=transform, subset='frost', severity=2)
+    assert data.CIFAR10C.get_normalization(transform) == (mean, std)
+    assert data.CIFAR10C.get_normalization(torchvision.transforms.ToTensor()) is None
+
+    loader = data.CIFAR10C.CIFAR10CBatchLoader(dataset, 3000, mean, std)
+    reference = torch.utils.data.DataLoader(dataset, batch_size=3000, shuffle=False)
+    assert len(loader) == len(reference) == 4
+    for (image, target, index), (image_ref, target_ref, index_ref) in zip(loader, reference):
+        torch.testing.assert_close(image, image_ref, rtol=1e-5, atol=1e-5)
+        assert torch.equal(target, target_ref) and torch.equal(index, index_ref)
+
+
+def test_all_subsets_match_concatenation(cifar10c):
+    dataset = data.CIFAR10C.CIFAR10C(cifar10c, subset='all', severity=4)
+    samples, labels = reference_samples(cifar10c, 'all', 4)
+    assert len(dataset) == len(samples) == 190000
+    np.testing.assert_array_equal(dataset.labels[:], labels)
+    for index in [0, 9999, 10000, 123456, 189999, -1]:
+        np.testing.assert_array_equal(dataset.samples[index], samples[index])
+        assert dataset.labels[index] == labels[index]
+    # slices across the files, empty slices
+    for start, stop in [(9990, 30010), (0, 190000), (50000, 50000)]:
+        np.testing.assert_array_equal(dataset.samples[start:stop], samples[start:stop])
+    with pytest.raises(IndexError):
+        dataset.samples[190000]
+    with pytest.raises(IndexError):
+        dataset.samples[0:10:2]
+    np.testing.assert_array_equal(dataset[150000][0], samples[150000])
+
+
+# Spawned worker processes import the driver script again: the md5 list of the copy is patched at its top level.
+# The model of get_model and the CIFAR-10-C grid, on a pool of processes and sequentially, without CUDA
+DRIVER_SCRIPT = '''
+import argparse
+import json
+import logging
+import sys
+
+sys.path.insert(0, {repo!r})
+import data.CIFAR10C
+
+data.CIFAR10C.CIFAR10C.ctest_list = json.load(open({ctest_path!r}))
+
+if __name__ == '__main__':
+    import numpy as np
+    import torch
+    import model.get_model
+    import test
+
+    assert not torch.cuda.is_available()
+    logger = logging.getLogger('driver')
+    args = argparse.Namespace(use_cosine=False, cos_temp=8)
+    net = model.get_model.get_model('resnet32', 10, logger, args)
+    assert all(param.device.type == 'cpu' for param in net.parameters())
+
+    test.args = argparse.Namespace(pred_cache_dir=None, full_calibration=False, streaming_valid=False,
+                                   device_reduce=False)
+    torch.manual_seed(0)
+    net = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(3 * {nb_pixel} ** 2, 10)).eval()
+    metrics = ['Acc.', 'AUROC', 'ECE', 'NLL']
+    transform = test.get_cifar10c_transform()
+    sequential = test.test_cifar10c_corruptions(net, {root!r}, transform, 5000, metrics, logger)
+    parallel = test.test_cifar10c_corruptions_parallel(net, {root!r}, transform, 5000, metrics, logger, nb_worker=2,
+                                                       nb_thread=1)
+    for corruption in data.CIFAR10C.CIFAR10C.cifarc_subsets:
+        for severity in range(1, 6):
+            for metric in metrics:
+                np.testing.assert_allclose(parallel[corruption][severity][metric],
+                                           sequential[corruption][severity][metric], rtol=1e-5, atol=1e-5)
+    print('ok')
+'''
+
+
+def test_cifar10c_driver_without_cuda(cifar10c_root, tmp_path):
+    root, ctest_list = cifar10c_root
+    ctest_path = tmp_path / 'ctest_list.json'
+    ctest_path.write_text(json.dumps(ctest_list))
+    script = tmp_path / 'driver.py'
+    script.write_text(DRIVER_SCRIPT.format(repo=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                           ctest_path=str(ctest_path), root=root, nb_pixel=NB_PIXEL))
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    proc = subprocess.run([sys.executable, str(script)], env=env, capture_output=True, text=True, timeout=600)
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.strip().endswith('ok')
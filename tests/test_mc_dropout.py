@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import model.wrn
+import utils.confidence
+import utils.mc_dropout
+import valid
+
+'''
+Monte-Carlo dropout: the scores of the stacked samples against a loop over the samples, the replicated-batch
+forward against the head-only sampling of the same masks, the dropout sites switched on and off.
+'''
+
+
+# ResNet18-like: dropout on the penultimate features behind the mc_dropout flag, BN in the backbone
+class Feature_Dropout_Net(nn.Module):
+    def __init__(self, nb_cls=5):
+        super(Feature_Dropout_Net, self).__init__()
+        torch.manual_seed(0)
+        self.mc_dropout, self.mc_droprate = False, 0.5
+        self.body = nn.Sequential(nn.Flatten(), nn.Linear(12, 16), nn.BatchNorm1d(16), nn.ReLU())
+        self.linear = nn.Linear(16, nb_cls)
+
+    def forward(self, x):
+        out = self.body(x)
+        if self.mc_dropout:
+            out = F.dropout(out, p=self.mc_droprate, training=True)
+        return self.linear(out)
+
+
+def make_loader(nb_sample=200, nb_cls=5):
+    torch.manual_seed(1)
+    image, target = torch.randn(nb_sample, 3, 2, 2), torch.randint(0, nb_cls, (nb_sample,))
+    return [(image[i:i + 50], target[i:i + 50], torch.arange(i, i + 50)) for i in range(0, nb_sample, 50)]
+
+
+# previous scores: one softmax per sample of every image
+def reference_mc_scores(logit_samples):
+    logit_samples = logit_samples.double().numpy()
+    scores = []
+    for b in range(logit_samples.shape[1]):
+        probs = []
+        for t in range(logit_samples.shape[0]):
+            z = logit_samples[t, b] - logit_samples[t, b].max()
+            probs.append(np.exp(z) / np.exp(z).sum())
+        probs = np.array(probs)
+        mean = probs.mean(0)
+        predictive_entropy = -(mean * np.log(mean)).sum()
+        expected_entropy = np.mean([-(p * np.log(p)).sum() for p in probs])
+        scores.append([mean.max(), -predictive_entropy, -(predictive_entropy - expected_entropy)])
+    return np.array(scores)
+
+
+def test_mc_scores_match_loop():
+    torch.manual_seed(0)
+    logit_samples = torch.randn(7, 30, 6) * 3
+    log_mean, scores = utils.confidence.mc_confidence_scores(logit_samples)
+    np.testing.assert_allclose(scores.numpy(), reference_mc_scores(logit_samples), rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(log_mean.exp(), F.softmax(logit_samples, dim=2).mean(0))
+
+
+def test_replicated_batch_matches_head_only():
+    net, loader = Feature_Dropout_Net(), make_loader()
+    # the features of the replicated batch and the replicated features take the same masks from the same seed
+    torch.manual_seed(2)
+    full, full_log = valid.mc_dropout_validation(loader, net, nb_mc=8, return_log=True)
+    torch.manual_seed(2)
+    head, head_log = valid.mc_dropout_validation(loader, net, nb_mc=8, head_only=True, return_log=True)
+    np.testing.assert_allclose(full_log['scores'], head_log['scores'], rtol=1e-5, atol=1e-6)
+    for name in utils.confidence.MC_SCORES:
+        for key in full[name]:
+            assert full[name][key] == pytest.approx(head[name][key], rel=1e-5, abs=1e-4, nan_ok=True), (name, key)
+    assert not net.mc_dropout and not net.training
+
+    # the samples differ, the mutual information is positive
+    assert (full_log['scores'][:, 2] < 0).all()
+
+
+def test_no_dropout_matches_validation():
+    net, loader = Feature_Dropout_Net(), make_loader()
+    res, val_log = valid.mc_dropout_validation(loader, net, nb_mc=4, droprate=0., head_only=True, return_log=True)
+    reference = valid.validation(loader, net)
+    for key in reference:
+        assert res['MC_MSP'][key] == pytest.approx(reference[key], rel=1e-5, abs=1e-4), key
+    np.testing.assert_allclose(val_log['scores'][:, 2], 0, atol=1e-5)
+
+
+def test_dropout_sites():
+    net = model.wrn.WideResNet(10, 3, False, 8, 1, dropRate=0.3)
+    assert utils.mc_dropout.enable_mc_dropout(net) == 3
+    assert all(not module.training for module in net.modules() if isinstance(module, nn.BatchNorm2d))
+    assert all(module.training for module in net.modules() if getattr(module, 'droprate', 0) > 0)
+    running_mean = [module.running_mean.clone() for module in net.modules() if isinstance(module, nn.BatchNorm2d)]
+    utils.mc_dropout.mc_logits(net, torch.randn(3, 3, 8, 8), 4)
+    after = [module.running_mean for module in net.modules() if isinstance(module, nn.BatchNorm2d)]
+    assert all(torch.equal(a, b) for a, b in zip(running_mean, after))
+
+    utils.mc_dropout.disable_mc_dropout(net)
+    assert not any(module.training for module in net.modules())
+    net = Feature_Dropout_Net()
+    assert utils.mc_dropout.enable_mc_dropout(net, 0.2) == 1 and net.mc_dropout and net.mc_droprate == 0.2
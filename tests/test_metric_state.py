@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+import torch
+import utils.metric_state
+import utils.metrics
+import valid
+
+'''
+Merged Metric_State shards against one Metric_Log over the whole set.
+'''
+
+
+# (confidence, pred, target, nll, brier), confidences rounded to produce ties
+def sample(rng, nb_sample, nb_cls=5, rounding=2):
+    confidence = rng.uniform(0.2, 1, nb_sample)
+    confidence = np.round(confidence, rounding) if rounding is not None else confidence
+    pred, target = rng.integers(0, nb_cls, nb_sample), rng.integers(0, nb_cls, nb_sample)
+    target = np.where(rng.uniform(size=nb_sample) < confidence, pred, target)
+    return confidence, pred, target, rng.uniform(0, 3, nb_sample), rng.uniform(0, 2, nb_sample)
+
+
+def test_merge_runs_matches_stable_sort():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        runs = []
+        for nb_sample in rng.integers(0, 40, 2):
+            confidence = np.round(rng.uniform(size=nb_sample), 1)
+            order = np.argsort(-confidence, kind='stable')
+            runs.append((confidence[order], (rng.uniform(size=nb_sample) < 0.5)[order]))
+        confidence, correct = utils.metric_state.merge_runs(*runs[0], *runs[1])
+        all_confidence = np.concatenate([runs[0][0], runs[1][0]])
+        order = np.argsort(-all_confidence, kind='stable')
+        np.testing.assert_array_equal(confidence, all_confidence[order])
+        np.testing.assert_array_equal(correct, np.concatenate([runs[0][1], runs[1][1]])[order])
+
+
+@pytest.mark.parametrize('full_calibration', [False, True])
+def test_merged_shards_match_metric_log(full_calibration):
+    rng = np.random.default_rng(1)
+    columns = sample(rng, 3000)
+    metric_log = utils.metrics.Metric_Log(full_calibration=full_calibration)
+    metric_log.update(*columns)
+    reference = metric_log.compute()
+
+    bounds = [0, 700, 701, 1900, 3000]
+    states = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        state = utils.metric_state.Metric_State(full_calibration=full_calibration)
+        # several batches per shard
+        for batch_start in range(start, end, 256):
+            state.update(*[column[batch_start:min(batch_start + 256, end)] for column in columns])
+        states.append(state)
+    # associative: ((s0 + s1) + (s2 + s3))
+    merged = states[0].merge(states[1]).merge(states[2].merge(states[3]))
+
+    res = merged.compute()
+    assert res.keys() == reference.keys()
+    for key in reference:
+        assert np.isclose(res[key], reference[key], rtol=1e-12, atol=1e-12), key
+
+
+def test_state_dict_round_trip(tmp_path):
+    rng = np.random.default_rng(2)
+    state = utils.metric_state.Metric_State(full_calibration=True)
+    state.update(*sample(rng, 500))
+    state.save(tmp_path / 'state.npz')
+    assert utils.metric_state.Metric_State.load(tmp_path / 'state.npz').compute() == state.compute()
+
+
+def test_sketch_within_error_bound():
+    rng = np.random.default_rng(3)
+    columns = sample(rng, 5000, rounding=None)
+    exact = utils.metric_state.Metric_State()
+    sketch = utils.metric_state.Metric_State(sketch_bins=256)
+    exact.update(*columns)
+    sketch.update(*columns)
+    bound = sketch.error_bound()
+    exact_res, sketch_res = exact.compute(), sketch.compute()
+    assert abs(exact_res['AUROC'] - sketch_res['AUROC']) <= bound['AUROC'] + 1e-9
+    assert abs(exact_res['AURC'] - sketch_res['AURC']) <= bound['AURC'] + 1e-9
+    assert exact_res['ECE'] == pytest.approx(sketch_res['ECE'])
+
+
+def test_validation_state_matches_validation():
+    torch.manual_seed(0)
+    net = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(12, 5))
+    image, target = torch.randn(300, 3, 2, 2), torch.randint(0, 5, (300,))
+    loader = [(image[i:i + 64], target[i:i + 64], torch.arange(i, min(i + 64, 300))) for i in range(0, 300, 64)]
+    reference = valid.streaming_validation(loader, net, full_calibration=True)
+    state = valid.validation_state(loader[:2], net, full_calibration=True)
+    state.merge(valid.validation_state(loader[2:], net, full_calibration=True))
+    res = state.compute()
+    for key in reference:
+        assert res[key] == pytest.approx(reference[key], rel=1e-6), key
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import torch
+from sklearn import metrics
+import utils.metrics
+
+'''
+Ranking metrics, NLL and Brier score against the implementations they replaced: sklearn's curves, the python loop
+over the sorted samples and the dense one-hot matrix.
+'''
+
+
+# previous AURC, EAURC: risk of every prefix of the samples sorted by descending confidence
+def reference_aurc_eaurc(confidence, correct):
+    sort_values = sorted(zip(confidence, correct), key=lambda x: x[0], reverse=True)
+    risk, error = [], 0
+    for i, (_, is_correct) in enumerate(sort_values):
+        error += is_correct == 0
+        risk.append(error / (i + 1))
+    r = risk[-1]
+    aurc = sum(risk) / len(risk)
+    return aurc, aurc - (r + (1 - r) * np.log(1 - r))
+
+
+# previous AUROC, AUPR Succ., AUPR, FPR from sklearn
+def reference_curves(confidence, correct):
+    fpr, tpr, _ = metrics.roc_curve(correct, confidence)
+    precision, recall, _ = metrics.precision_recall_curve(correct, confidence)
+    return (metrics.auc(fpr, tpr), metrics.auc(recall, precision),
+            metrics.average_precision_score(1 - correct, -confidence), fpr[np.argmin(np.abs(tpr - 0.95))])
+
+
+def sample(rng, nb_sample, rounding=None):
+    confidence = rng.uniform(0.05, 1, nb_sample)
+    if rounding is not None:
+        confidence = np.round(confidence, rounding)
+    correct = (rng.uniform(size=nb_sample) < confidence).astype(np.int64)
+    return confidence, correct
+
+
+@pytest.mark.parametrize('rounding', [None, 2, 1])
+def test_ranking_metrics_match_sklearn(rounding):
+    rng = np.random.default_rng(0)
+    for _ in range(10):
+        confidence, correct = sample(rng, rng.integers(20, 2000), rounding)
+        aurc, eaurc, auroc, aupr_success, aupr, fpr = utils.metrics.calc_ranking_metrics(confidence, correct)
+        np.testing.assert_allclose([aurc, eaurc], reference_aurc_eaurc(confidence, correct), rtol=1e-10)
+        np.testing.assert_allclose([auroc, aupr_success, aupr, fpr], reference_curves(confidence, correct),
+                                   rtol=1e-10, atol=1e-12)
+
+
+
+# previous NLL and Brier score: log-softmax of the whole set and a dense one-hot matrix
+def reference_nll_brier(softmax, logit, label):
+    brier = np.mean(np.sum((softmax - np.eye(logit.shape[1])[label]) ** 2, axis=1))
+    log_softmax = torch.log_softmax(torch.tensor(logit, dtype=torch.float64), dim=1)
+    return -log_softmax[torch.arange(len(label)), torch.from_numpy(label)].mean().item(), brier
+
+
+def test_nll_brier_match_one_hot():
+    rng = np.random.default_rng(2)
+    logit = rng.normal(size=(1000, 7)) * 3
+    softmax = torch.softmax(torch.from_numpy(logit), 1).numpy()
+    label = rng.integers(0, 7, 1000)
+    np.testing.assert_allclose(utils.metrics.calc_nll_brier(softmax, logit, label, chunk_size=300),
+                               reference_nll_brier(softmax, logit, label), rtol=1e-12)
+
+
+def test_ranking_metrics_columns():
+    rng = np.random.default_rng(3)
+    confidence = np.round(rng.uniform(0.05, 1, (500, 3)), 2)
+    correct = rng.integers(0, 2, 500)
+    columns = utils.metrics.calc_ranking_metrics_columns(confidence, correct)
+    for k in range(3):
+        np.testing.assert_allclose(columns[k], utils.metrics.calc_ranking_metrics(confidence[:, k], correct))
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import torch
+from sklearn import metrics
+import utils.confidence
+import utils.ood
+import utils.prediction_store
+
+'''
+OOD detection: the one-sort metrics against sklearn, the scores of stored predictions against the scores of the
+logits and a per-sample loop over the fit features.
+'''
+
+
+# previous metrics from sklearn, ID samples are the positives
+def reference_ood_metrics(id_score, ood_score):
+    score = np.r_[id_score, ood_score]
+    is_id = np.r_[np.ones(len(id_score)), np.zeros(len(ood_score))]
+    fpr, tpr, _ = metrics.roc_curve(is_id, score)
+    return [metrics.roc_auc_score(is_id, score) * 100, metrics.average_precision_score(is_id, score) * 100,
+            metrics.average_precision_score(1 - is_id, -score) * 100, fpr[np.argmin(np.abs(tpr - 0.95))] * 100]
+
+
+@pytest.mark.parametrize('decimals', [None, 1])
+def test_ood_metrics_match_sklearn(decimals):
+    rng = np.random.default_rng(0)
+    id_score, ood_score = rng.normal(1, 1, 700), rng.normal(0, 1, 400)
+    if decimals is not None:
+        # ties between and within the sets
+        id_score, ood_score = id_score.round(decimals), ood_score.round(decimals)
+    res = utils.ood.ood_metrics(id_score, ood_score)
+    np.testing.assert_allclose([res[name] for name in utils.ood.OOD_METRICS],
+                               reference_ood_metrics(id_score, ood_score), rtol=1e-8, atol=1e-8)
+
+
+def make_arrays(nb_sample, nb_cls=4, dim=6, shift=0., seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    target = torch.randint(0, nb_cls, (nb_sample,), generator=generator)
+    feature = torch.randn(nb_sample, dim, generator=generator) + shift
+    feature[:, :nb_cls] += 3 * torch.nn.functional.one_hot(target, nb_cls)
+    logit = feature[:, :nb_cls] * 2
+    return {'target': target.numpy(), 'stats': utils.prediction_store.logit_stats(logit, target).numpy(),
+            'logit': logit.numpy(), 'feature': feature.numpy()}
+
+
+# previous feature scores: one sample at a time against the fit features
+def reference_feature_scores(fit_arrays, arrays, k):
+    feature, target = fit_arrays['feature'].astype(np.float64), fit_arrays['target']
+    class_mean = np.stack([feature[target == c].mean(0) for c in range(target.max() + 1)])
+    centered = feature - class_mean[target]
+    precision = np.linalg.pinv(centered.T @ centered / len(target))
+    bank = feature / np.linalg.norm(feature, axis=1, keepdims=True)
+    scores = []
+    for x in arrays['feature'].astype(np.float64):
+        mahalanobis = min((x - mean) @ precision @ (x - mean) for mean in class_mean)
+        distance = np.sort(np.linalg.norm(bank - x / np.linalg.norm(x), axis=1))[k - 1]
+        scores.append([-mahalanobis, -distance])
+    return np.array(scores)
+
+
+def test_scores_match_reference():
+    fit_arrays, arrays = make_arrays(500), make_arrays(300, shift=0.5, seed=1)
+    scorer = utils.ood.OOD_Scorer(fit_arrays, knn_k=5, chunk_size=128)
+    scores = scorer.scores(arrays, utils.ood.OOD_SCORES)
+
+    logit = torch.from_numpy(arrays['logit'])
+    reference = utils.confidence.get_confidence_scores(logit, ['MSP', 'Energy', 'MaxLogit']).numpy()
+    np.testing.assert_allclose(scores[:, :3], reference, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(scores[:, 3:], reference_feature_scores(fit_arrays, arrays, 5), rtol=1e-3, atol=1e-3)
+
+    with pytest.raises(ValueError):
+        utils.ood.OOD_Scorer().scores(arrays, ['MSP', 'KNN'])
+
+
+def test_ood_results_layout():
+    id_scores, ood_scores = np.random.default_rng(0).normal(size=(50, 2)), {'svhn': np.zeros((30, 2))}
+    results = utils.ood.ood_results(id_scores, ood_scores, ['MSP', 'Energy'])
+    assert list(results) == ['svhn'] and list(results['svhn']) == ['MSP', 'Energy']
+    assert results['svhn']['Energy'] == utils.ood.ood_metrics(id_scores[:, 1], ood_scores['svhn'][:, 1])
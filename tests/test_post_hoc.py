@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.optim.swa_utils import AveragedModel
+import model.classifier
+import utils.post_hoc
+import utils.prediction_store
+import utils.tta
+import valid
+
+'''
+Post-hoc calibration: the Newton fit of the temperature against the L-BFGS fit of the log-temperature it replaced,
+validation through a Calibrated_Store against the live Calibrated_Net, the classifier behind the wrappers.
+'''
+
+
+# previous fit: full-batch L-BFGS on the log-temperature
+def reference_temperature(logit, target, init_temp=1.5):
+    log_temp = nn.Parameter(torch.tensor(float(np.log(init_temp))))
+    optimizer = torch.optim.LBFGS([log_temp], lr=0.1, max_iter=500, tolerance_grad=1e-9, tolerance_change=1e-12,
+                                  line_search_fn='strong_wolfe')
+
+    def closure():
+        optimizer.zero_grad()
+        loss = F.cross_entropy(logit.double() / log_temp.double().exp(), target)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return log_temp.exp().item()
+
+
+@pytest.mark.parametrize('scale', [0.3, 4.])
+def test_temperature_matches_lbfgs(scale):
+    torch.manual_seed(0)
+    nb_sample, nb_cls = 5000, 20
+    target = torch.randint(0, nb_cls, (nb_sample,))
+    logit = torch.randn(nb_sample, nb_cls) + 2 * F.one_hot(target, nb_cls)
+    logit = logit * scale
+    calibrator = utils.post_hoc.fit_post_hoc(logit.numpy(), target.numpy(), 'temperature', max_iter=100)
+    assert calibrator.log_temp.exp().item() == pytest.approx(reference_temperature(logit, target), rel=1e-4)
+
+
+def make_net_data(nb_sample=300, nb_cls=6):
+    torch.manual_seed(0)
+    net = nn.Sequential(nn.Flatten(), nn.Linear(12, 16), nn.ReLU(), nn.Linear(16, nb_cls))
+    image, target = torch.randn(nb_sample, 3, 2, 2) * 3, torch.randint(0, nb_cls, (nb_sample,))
+    dataset = torch.utils.data.TensorDataset(image, target, torch.arange(nb_sample))
+    loader = [(image[i:i + 64], target[i:i + 64], torch.arange(i, min(i + 64, nb_sample)))
+              for i in range(0, nb_sample, 64)]
+    return net, dataset, loader
+
+
+@pytest.mark.parametrize('method', ['temperature', 'vector', 'matrix'])
+def test_calibrated_store_matches_calibrated_net(tmp_path, method):
+    net, dataset, loader = make_net_data()
+    checkpoint = tmp_path / 'net.pth'
+    torch.save(net.state_dict(), checkpoint)
+    with torch.no_grad():
+        logit = torch.cat([net(image) for image, _, _ in loader])
+    calibrator = utils.post_hoc.fit_post_hoc(logit.numpy(), dataset.tensors[1].numpy(), method, max_iter=20)
+    calibrated_net = utils.post_hoc.Calibrated_Net(net, calibrator)
+
+    store = utils.post_hoc.Calibrated_Store(
+        utils.prediction_store.Prediction_Store(str(tmp_path / 'cache'), str(checkpoint), dataset), calibrator)
+    for full_calibration in [False, True]:
+        reference = valid.validation(loader, calibrated_net, full_calibration=full_calibration)
+        res = valid.validation(loader, calibrated_net, full_calibration=full_calibration, store=store)
+        for key in reference:
+            assert res[key] == pytest.approx(reference[key], rel=1e-5, abs=1e-4), key
+
+    scores = ['MSP', 'MaxLogit', 'Energy', 'Entropy', 'Margin']
+    live = valid.multi_score_validation(loader, calibrated_net, scores)
+    stored = valid.multi_score_validation(loader, calibrated_net, scores, store=store)
+    for name in scores:
+        for key in live[name]:
+            assert stored[name][key] == pytest.approx(live[name][key], rel=1e-5, abs=1e-4, nan_ok=True), (name, key)
+
+
+def test_classifier_behind_wrappers():
+    net = model.classifier.Classifier(4, 3, 8)
+    wrapped = nn.Sequential()
+    wrapped.fc = nn.Linear(4, 3)
+    wrapped = utils.tta.TTA_Net(AveragedModel(wrapped), ['flip'])
+    wrapped = utils.post_hoc.Calibrated_Net(wrapped, utils.post_hoc.Post_Hoc_Calibration(3))
+    classifier, weight = model.classifier.get_classifier(wrapped)
+    assert classifier is wrapped.module.module.module.fc and weight is classifier.weight
+
+    cosine = nn.Module()
+    cosine.use_cos, cosine.classifier = True, net
+    averaged = AveragedModel(cosine)
+    classifier, weight = model.classifier.get_classifier(averaged)
+    assert classifier is averaged.module.classifier and weight.shape == (3, 4)
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import utils.prediction_store
+import valid
+
+'''
+Prediction store: validation from the stored predictions against the live passes, reuse and invalidation.
+'''
+
+
+class Counting_Net(nn.Module):
+    def __init__(self, nb_cls=6):
+        super(Counting_Net, self).__init__()
+        torch.manual_seed(0)
+        self.body = nn.Sequential(nn.Flatten(), nn.Linear(12, 16), nn.ReLU())
+        self.fc = nn.Linear(16, nb_cls)
+        self.nb_forward = 0
+
+    def forward(self, x):
+        self.nb_forward += 1
+        return self.fc(self.body(x))
+
+
+def make_data(nb_sample=200, nb_cls=6):
+    torch.manual_seed(1)
+    image, target = torch.randn(nb_sample, 3, 2, 2) * 3, torch.randint(0, nb_cls, (nb_sample,))
+    dataset = torch.utils.data.TensorDataset(image, target, torch.arange(nb_sample))
+    loader = [(image[i:i + 64], target[i:i + 64], torch.arange(i, min(i + 64, nb_sample)))
+              for i in range(0, nb_sample, 64)]
+    return dataset, loader
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    path = tmp_path / 'net.pth'
+    torch.save(Counting_Net().state_dict(), path)
+    return str(path)
+
+
+def assert_res_close(res, reference):
+    for key in reference:
+        assert res[key] == pytest.approx(reference[key], rel=1e-5, abs=1e-4, nan_ok=True), key
+
+
+@pytest.mark.parametrize('full_calibration', [False, True])
+def test_stored_validation_matches_live(tmp_path, checkpoint, full_calibration):
+    net, (dataset, loader) = Counting_Net(), make_data()
+    reference = valid.validation(loader, net, full_calibration=full_calibration)
+    store = utils.prediction_store.Prediction_Store(str(tmp_path / 'cache'), checkpoint, dataset, save_feature=True)
+    assert_res_close(valid.validation(loader, net, full_calibration=full_calibration, store=store), reference)
+
+    scores = ['MSP', 'MaxLogit', 'Energy', 'Entropy', 'Margin', 'Cosine']
+    live = valid.multi_score_validation(loader, net, scores, full_calibration=full_calibration)
+    stored = valid.multi_score_validation(loader, net, scores, full_calibration=full_calibration, store=store)
+    for name in scores:
+        assert_res_close(stored[name], live[name])
+
+
+def test_topk_store_matches_dense(tmp_path, checkpoint):
+    net, (dataset, loader) = Counting_Net(), make_data()
+    reference = valid.validation(loader, net)
+    store = utils.prediction_store.Prediction_Store(str(tmp_path / 'cache'), checkpoint, dataset, topk=2)
+    assert_res_close(valid.validation(loader, net, store=store), reference)
+
+
+def test_store_is_reused(tmp_path, checkpoint):
+    net, (dataset, loader) = Counting_Net(), make_data()
+    store = utils.prediction_store.Prediction_Store(str(tmp_path / 'cache'), checkpoint, dataset)
+    first = store.load_or_write(loader, net)
+    nb_forward = net.nb_forward
+    second = utils.prediction_store.Prediction_Store(str(tmp_path / 'cache'), checkpoint, dataset).load_or_write(
+        loader, net)
+    assert net.nb_forward == nb_forward == len(loader)
+    for name in first:
+        np.testing.assert_array_equal(first[name], second[name])
+
+
+def test_store_invalidation(tmp_path, checkpoint):
+    net, (dataset, loader) = Counting_Net(), make_data()
+    root = str(tmp_path / 'cache')
+    store = utils.prediction_store.Prediction_Store(root, checkpoint, dataset, topk=2)
+    store.load_or_write(loader, net)
+    # a larger top-k or the features need a new pass, a smaller top-k does not
+    assert utils.prediction_store.Prediction_Store(root, checkpoint, dataset, topk=1).is_valid()
+    assert not utils.prediction_store.Prediction_Store(root, checkpoint, dataset, topk=3).is_valid()
+    assert not utils.prediction_store.Prediction_Store(root, checkpoint, dataset, topk=2, save_feature=True).is_valid()
+    assert not utils.prediction_store.Prediction_Store(root, checkpoint, dataset).is_valid()
+    # another inference mode, another dataset or another checkpoint is another store
+    assert utils.prediction_store.Prediction_Store(root, checkpoint, dataset, topk=2, tag='tta').key != store.key
+    assert utils.prediction_store.Prediction_Store(root, checkpoint, make_data(100)[0], topk=2).key != store.key
+    torch.save(nn.Linear(2, 2).state_dict(), checkpoint)
+    assert utils.prediction_store.Prediction_Store(root, checkpoint, dataset, topk=2).key != store.key
+
+
+def test_checkpoint_hashed_once(checkpoint, monkeypatch):
+    calls = []
+    hash_file = utils.prediction_store.hash_file
+    monkeypatch.setattr(utils.prediction_store, 'hash_file', lambda path: calls.append(path) or hash_file(path))
+    dataset = make_data()[0]
+    keys = {utils.prediction_store.Prediction_Store('cache', checkpoint, dataset).key for _ in range(5)}
+    assert len(keys) == 1 and len(calls) <= 1
@@ -0,0 +1,26 @@
+import sys
+import pytest
+import utils.test_option
+
+'''
+Options the --ensemble evaluation does not run are rejected rather than silently ignored.
+'''
+
+
+def parse(monkeypatch, argv):
+    monkeypatch.setattr(sys, 'argv', ['test.py'] + argv)
+    return utils.test_option.get_args_parser()
+
+
+def test_ensemble_defaults_accepted(monkeypatch):
+    assert parse(monkeypatch, ['--ensemble', '--full-calibration']).ensemble
+
+
+@pytest.mark.parametrize('argv', [['--post-hoc', 'temperature'], ['--scores', 'MSP', 'Energy'], ['--mc-dropout', '4'],
+                                  ['--tta', 'flip'], ['--nb-boot', '100'], ['--pred-cache-dir', 'cache'],
+                                  ['--cifar10c-worker', '2'], ['--ood-dir', 'svhn']])
+def test_ensemble_rejects_ignored_options(monkeypatch, capsys, argv):
+    assert not parse(monkeypatch, argv).ensemble
+    with pytest.raises(SystemExit):
+        parse(monkeypatch, ['--ensemble'] + argv)
+    assert argv[0] in capsys.readouterr().err
@@ -0,0 +1,200 @@
+import logging
+import types
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import optim
+import train
+import utils.split_bn
+
+'''
+Training-step equivalences: split-BN fused forward against separate forwards, the device-resident correctness log
+against the previous numpy log, the CRL pairings against a loop over the pairs, loss-scaled SAM / LookSAM against
+the fp32 step.
+'''
+
+
+def small_net():
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Conv2d(3, 8, 3, padding=1), nn.BatchNorm2d(8), nn.ReLU(), nn.AdaptiveAvgPool2d(1),
+                         nn.Flatten(), nn.Linear(8, 16), nn.BatchNorm1d(16), nn.ReLU(), nn.Linear(16, 5))
+
+
+def flat_grad(net):
+    return torch.cat([p.grad.flatten() for p in net.parameters()])
+
+
+def test_split_batch_norm_matches_separate_forwards():
+    net_split, net_separate = small_net().train(), small_net().train()
+    x = torch.randn(24, 3, 6, 6)
+    with utils.split_bn.split_batch_norm(net_split, [16, 8]):
+        output_split = net_split(x)
+    output_separate = torch.cat([net_separate(x[:16]), net_separate(x[16:])])
+    output_split.pow(2).sum().backward()
+    output_separate.pow(2).sum().backward()
+
+    torch.testing.assert_close(output_split, output_separate)
+    torch.testing.assert_close(flat_grad(net_split), flat_grad(net_separate))
+    for buffer_split, buffer_separate in zip(net_split.buffers(), net_separate.buffers()):
+        torch.testing.assert_close(buffer_split, buffer_separate)
+    assert all('forward' not in module.__dict__ for module in net_split.modules())
+
+
+def test_fused_split_bn_mixup_matches_separate():
+    x, y = torch.randn(16, 3, 6, 6), torch.randint(0, 5, (16,))
+    cls_criterion = nn.CrossEntropyLoss()
+    mixup_criterion = train.Mixup_Criterion(10., cls_criterion)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    mixup_data = mixup_criterion.get_mixup_data(x, y)
+
+    res = {}
+    for mode in ['separate', 'fused-split-bn']:
+        net = small_net().train()
+        args = types.SimpleNamespace(mixup_forward=mode)
+        output, loss_ce, loss_mixup = train.forward_clean_mixup(args, net, x, y, cls_criterion, mixup_criterion,
+                                                                mixup_data)
+        (loss_ce + loss_mixup).backward()
+        res[mode] = (output, loss_ce, loss_mixup, flat_grad(net), torch.cat([b.float().flatten() for b in net.buffers()]))
+    for separate, fused in zip(res['separate'], res['fused-split-bn']):
+        torch.testing.assert_close(separate, fused)
+
+
+# previous log: float64 numpy counts, normalized over the whole log at every batch
+class Reference_Correctness_Log(object):
+    def __init__(self, n_data):
+        self.correctness = np.zeros((n_data))
+        self.max_correctness = 1
+
+    def update(self, data_idx, correctness):
+        self.correctness[data_idx] += correctness.cpu().numpy()
+
+    def max_correctness_update(self, epoch):
+        if epoch > 1:
+            self.max_correctness += 1
+
+    def _normalize(self, data):
+        data_min = self.correctness.min()
+        data_max = float(self.max_correctness)
+        return (data - data_min) / (data_max - data_min)
+
+    def get_target_margin(self, idx1, idx2):
+        idx1, idx2 = idx1.cpu().numpy(), idx2.cpu().numpy()
+        correctness_norm = self._normalize(self.correctness)
+        target1, target2 = correctness_norm[idx1], correctness_norm[idx2]
+        target = np.array(target1 > target2, dtype='float') + np.array(target1 < target2, dtype='float') * (-1)
+        return torch.from_numpy(target).float(), torch.from_numpy(abs(target1 - target2)).float()
+
+
+def test_correctness_log_matches_numpy_log():
+    nb_sample, batch_size = 100, 16
+    correct_log, reference = train.Correctness_Log(nb_sample, device='cpu'), Reference_Correctness_Log(nb_sample)
+    generator = torch.Generator().manual_seed(0)
+    for epoch in range(1, 6):
+        correct_log.max_correctness_update(epoch)
+        reference.max_correctness_update(epoch)
+        # every sample once per epoch, in shuffled batches
+        order = torch.randperm(nb_sample, generator=generator)
+        for start in range(0, nb_sample, batch_size):
+            image_idx = order[start:start + batch_size]
+            pair = torch.randint(0, nb_sample, (2, 40), generator=generator)
+            target, margin = correct_log.get_target_margin(pair[0], pair[1])
+            reference_target, reference_margin = reference.get_target_margin(pair[0], pair[1])
+            torch.testing.assert_close(target, reference_target)
+            torch.testing.assert_close(margin, reference_margin)
+
+            correct = torch.rand(len(image_idx), generator=generator) < 0.7
+            correct_log.update(image_idx, correct)
+            reference.update(image_idx.numpy(), correct)
+            assert int(correct_log.min_correctness()) == reference.correctness.min()
+    np.testing.assert_array_equal(correct_log.correctness.numpy(), reference.correctness)
+
+
+# previous ranking loss: one pair at a time
+def reference_crl(output, image_idx, correct_log, pairs):
+    conf = torch.softmax(output, dim=1).max(1)[0]
+    losses = []
+    for i, j in pairs:
+        target, margin = correct_log.get_target_margin(image_idx[i:i + 1], image_idx[j:j + 1])
+        conf_j = conf[j] + margin / (target + 1e-7)
+        losses.append(torch.clamp(-target * (conf[i] - conf_j), min=0))
+    return torch.cat(losses).mean()
+
+
+@pytest.mark.parametrize('pairing', ['roll', 'all', 'sampled'])
+def test_crl_pairings_match_loop(pairing):
+    torch.manual_seed(0)
+    nb_sample, batch_size = 40, 12
+    correct_log = train.Correctness_Log(nb_sample, device='cpu')
+    for epoch in range(1, 4):
+        correct_log.max_correctness_update(epoch)
+        correct_log.update(torch.arange(nb_sample), torch.rand(nb_sample) < 0.6)
+    output, image_idx = torch.randn(batch_size, 5, requires_grad=True), torch.randperm(nb_sample)[:batch_size]
+    criterion = train.CRL_Criterion(pairing, nb_pair=3)
+
+    torch.manual_seed(1)
+    pair_i, pair_j, _, _ = criterion.get_target_margin(image_idx, correct_log)
+    torch.manual_seed(1)
+    loss = criterion(output, image_idx, correct_log)
+    if pairing == 'roll':
+        pairs = [(i, (i + 1) % batch_size) for i in range(batch_size)]
+    elif pairing == 'all':
+        pairs = [(i, j) for i in range(batch_size) for j in range(i + 1, batch_size)]
+    else:
+        pairs = list(zip(pair_i.tolist(), pair_j.tolist()))
+        assert len(pairs) == batch_size * 3 and all(i != j for i, j in pairs)
+    assert list(zip(pair_i.tolist(), pair_j.tolist())) == pairs
+
+    reference = reference_crl(output, image_idx, correct_log, pairs)
+    torch.testing.assert_close(loss, reference)
+    grad, = torch.autograd.grad(loss, output)
+    torch.testing.assert_close(grad, torch.autograd.grad(reference, output)[0])
+
+
+class Writer(object):
+    def add_scalar(self, *args):
+        pass
+
+
+def run_train(net, loader, optim_name, scaler=None, sam_k=1, epochs=2):
+    optimizer = optim.get_optimizer_scheduler('resnet18', optim_name, net, 0.1, 0.9, 5e-4, sam_k=sam_k)[0]
+    args = types.SimpleNamespace(mixup_forward='separate', mixup_beta=10., mixup_weight=1., crl_weight=1.,
+                                 optim_name=optim_name, crl_pairs='roll', crl_nb_pair=4, amp='none')
+    correct_log = train.Correctness_Log(sum(len(batch[1]) for batch in loader))
+    np.random.seed(0)
+    torch.manual_seed(0)
+    for epoch in range(1, epochs + 1):
+        train.train(loader, net, optimizer, epoch, correct_log, logging.getLogger(), Writer(), args, scaler)
+    return torch.cat([p.detach().flatten() for p in net.parameters()])
+
+
+def make_loader(scale=1.):
+    torch.manual_seed(1)
+    x, y = torch.randn(128, 3, 6, 6) * scale, torch.randint(0, 5, (128,))
+    return [(x[i:i + 32], y[i:i + 32], torch.arange(i, i + 32)) for i in range(0, 128, 32)]
+
+
+cpu_grad_scaler = pytest.mark.skipif(not hasattr(torch.amp, 'GradScaler'), reason='needs torch.amp.GradScaler (CPU)')
+
+
+@cpu_grad_scaler
+@pytest.mark.parametrize('optim_name, sam_k', [('baseline', 1), ('sam', 1), ('sam', 3)])
+def test_loss_scaling_keeps_fp32_weights(optim_name, sam_k):
+    # a power of two scale is exact: the scaled step gives the fp32 weights bit for bit
+    reference = run_train(small_net(), make_loader(), optim_name, sam_k=sam_k)
+    scaler = torch.amp.GradScaler('cpu', init_scale=1024.)
+    scaled = run_train(small_net(), make_loader(), optim_name, scaler, sam_k=sam_k)
+    assert torch.equal(reference, scaled)
+    assert scaler.get_scale() == 1024.
+
+
+@cpu_grad_scaler
+@pytest.mark.parametrize('optim_name', ['baseline', 'sam'])
+def test_overflow_skips_steps(optim_name):
+    net = small_net()
+    initial = torch.cat([p.detach().flatten() for p in net.parameters()])
+    scaler = torch.amp.GradScaler('cpu', init_scale=2. ** 127, growth_interval=1000)
+    weights = run_train(net, make_loader(1e4), optim_name, scaler, epochs=1)
+    assert torch.equal(initial, weights)
+    assert scaler.get_scale() == 2. ** 123
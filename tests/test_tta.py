@@ -0,0 +1,48 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import utils.tta
+
+'''
+Batched test-time augmentation against a loop over the views and the samples, one forward per image.
+'''
+
+
+# previous aggregation: every view of every sample forwarded alone
+def reference_tta(net, x, views, aggregate):
+    outputs = []
+    for i in range(x.size(0)):
+        image = x[i:i + 1]
+        output = torch.cat([net(f(image)) for f in utils.tta.get_view_functions(views, x.size(-1))])
+        if aggregate == 'softmax':
+            outputs.append(torch.log(F.softmax(output, dim=1).mean(0)))
+        else:
+            outputs.append(output.mean(0))
+    return torch.stack(outputs)
+
+
+@pytest.mark.parametrize('views', [['flip'], ['crop'], ['flip', 'crop', 'scale']])
+@pytest.mark.parametrize('aggregate', ['softmax', 'logit'])
+def test_tta_matches_view_loop(views, aggregate):
+    torch.manual_seed(0)
+    net = nn.Sequential(nn.Conv2d(3, 4, 3, padding=1), nn.ReLU(), nn.Flatten(), nn.Linear(4 * 8 * 8, 5)).eval()
+    x = torch.randn(13, 3, 8, 8)
+    # chunks of 3 samples at most, the last one incomplete
+    tta_net = utils.tta.TTA_Net(net, views, aggregate, chunk_size=3 * len(utils.tta.get_view_functions(views, 8)))
+    with torch.no_grad():
+        torch.testing.assert_close(tta_net(x), reference_tta(net, x, views, aggregate), rtol=1e-5, atol=1e-5)
+
+
+def test_views():
+    x = torch.arange(2 * 3 * 8 * 8, dtype=torch.float32).view(2, 3, 8, 8)
+    functions = utils.tta.get_view_functions(['flip', 'crop'], 8)
+    assert len(functions) == 10
+    torch.testing.assert_close(functions[0](x), x)
+    # shift by (-1, 1): row i, column j of the view is row i + 1, column j - 1 of the image, zero outside
+    expected = torch.zeros_like(x)
+    expected[..., :7, 1:] = x[..., 1:, :7]
+    torch.testing.assert_close(functions[2](x), expected)
+    torch.testing.assert_close(functions[7](x), torch.flip(expected, dims=[-1]))
+    for factor in [0.9, 1.1]:
+        assert utils.tta.zoom(x, factor).shape == x.shape
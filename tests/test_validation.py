@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+import utils.calibration
+import utils.metrics
+import valid
+
+'''
+The streaming validation paths against the full-log valid.validation.
+'''
+
+
+def make_net_loader(nb_sample=300, nb_cls=6):
+    torch.manual_seed(0)
+    net = nn.Sequential(nn.Flatten(), nn.Linear(12, 16), nn.ReLU(), nn.Linear(16, nb_cls))
+    image, target = torch.randn(nb_sample, 3, 2, 2) * 3, torch.randint(0, nb_cls, (nb_sample,))
+    loader = [(image[i:i + 64], target[i:i + 64], torch.arange(i, min(i + 64, nb_sample)))
+              for i in range(0, nb_sample, 64)]
+    return net, loader
+
+
+def assert_res_close(res, reference):
+    assert res.keys() == reference.keys()
+    for key in reference:
+        assert res[key] == pytest.approx(reference[key], rel=1e-5, abs=1e-4), key
+
+
+@pytest.mark.parametrize('full_calibration', [False, True])
+def test_streaming_matches_validation(full_calibration):
+    net, loader = make_net_loader()
+    reference = valid.validation(loader, net, full_calibration=full_calibration)
+    assert_res_close(valid.validation(loader, net, full_calibration=full_calibration, streaming=True), reference)
+    res, metric_log = valid.validation(loader, net, full_calibration=full_calibration, return_log=True)
+    assert_res_close(res, reference)
+    assert len(metric_log.get_log()['confidence']) == 300
+
+
+@pytest.mark.parametrize('full_calibration', [False, True])
+def test_device_reduce_matches_validation(full_calibration):
+    net, loader = make_net_loader()
+    reference = valid.validation(loader, net, full_calibration=full_calibration)
+    assert_res_close(valid.validation(loader, net, full_calibration=full_calibration, device_reduce=True), reference)
+
+
+def test_reduce_batch_matches_host_terms():
+    torch.manual_seed(1)
+    output, target = torch.randn(50, 4) * 2, torch.randint(0, 4, (50,))
+    packed, softmax = valid.reduce_batch(output, target)
+    softmax_reference = torch.softmax(output.double(), 1)
+    confidence, pred = softmax_reference.max(1)
+    nll = torch.nn.functional.cross_entropy(output.double(), target, reduction='none')
+    brier = (softmax_reference - torch.eye(4, dtype=torch.float64)[target]).pow(2).sum(1)
+    reference = torch.stack([confidence, pred.double(), target.double(), nll, brier], 1)
+    np.testing.assert_allclose(packed.double().numpy(), reference.numpy(), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(softmax.double().numpy(), softmax_reference.numpy(), rtol=1e-5, atol=1e-7)
+
+
+def test_device_classwise_statistics_match_host():
+    torch.manual_seed(2)
+    softmax, target = torch.softmax(torch.randn(200, 5) * 2, 1), torch.randint(0, 5, (200,))
+    conf_sum, acc_sum = valid.classwise_bin_statistics(softmax, target)
+    _, conf_reference, acc_reference = utils.calibration.get_classwise_bin_statistics(softmax.numpy(), target.numpy())
+    np.testing.assert_allclose(conf_sum.numpy(), conf_reference, rtol=1e-6)
+    np.testing.assert_array_equal(acc_sum.numpy(), acc_reference)
+
+
+def test_multi_score_matches_single_score():
+    net, loader = make_net_loader()
+    method_res, val_log = valid.multi_score_validation(loader, net, ['MSP', 'Energy', 'Margin'], return_log=True)
+    assert_res_close(method_res['MSP'], valid.validation(loader, net))
+
+    logit = torch.cat([net(image) for image, _, _ in loader]).detach()
+    target = torch.cat([target for _, target, _ in loader]).numpy()
+    correct = logit.argmax(1).numpy() == target
+    energy = torch.logsumexp(logit, 1).numpy()
+    np.testing.assert_allclose(val_log['scores'][:, 1], energy, rtol=1e-5)
+    aurc, eaurc, auroc, aupr_success, aupr, fpr = utils.metrics.calc_ranking_metrics(val_log['scores'][:, 1], correct)
+    assert method_res['Energy']['AUROC'] == pytest.approx(auroc*100)
+    assert method_res['Energy']['AURC'] == pytest.approx(aurc*1000)
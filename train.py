@@ -1,4 +1,6 @@
 import utils.utils
+import utils.split_bn
+import utils.amp
 import torch.nn as nn
 import torch
 import numpy as np
@@ -17,47 +19,67 @@ class Mixup_Criterion(nn.Module):
         mixed_image = beta * image + (1 - beta) * shuffled_image
         return mixed_image, shuffled_target, beta
 
-    def forward(self, image, target, net):
-        mixed_image, shuffled_target, beta = self.get_mixup_data(image, target)
+    def mixup_loss(self, pred_mixed, target, shuffled_target, beta):
+        return beta * self.cls_criterion(pred_mixed, target) + (1 - beta) * self.cls_criterion(pred_mixed, shuffled_target)
+
+    # mixup_data: reuse a draw of get_mixup_data
+    def forward(self, image, target, net, mixup_data=None):
+        if mixup_data is None:
+            mixup_data = self.get_mixup_data(image, target)
+        mixed_image, shuffled_target, beta = mixup_data
         pred_mixed = net(mixed_image)
-        loss_mixup = beta * self.cls_criterion(pred_mixed, target) + (1 - beta) * self.cls_criterion(pred_mixed, shuffled_target)
-        return loss_mixup
+        return self.mixup_loss(pred_mixed, target, shuffled_target, beta)
 
 class Correctness_Log(object):
-    def __init__(self, n_data):
-        self.correctness = np.zeros((n_data))
+    '''
+    Per-sample count of correct predictions, an int32 tensor on the training device.
+    Counts only grow, so their minimum is tracked with a histogram of the counts updated by every batch: a batch
+    gathers its own rows only, without a pass over the whole log nor a host round-trip.
+    Every sample is expected once per epoch (the histogram covers counts up to max_correctness + 1).
+    '''
+
+    def __init__(self, n_data, device=None):
+        self.device = torch.device(device if device is not None else 'cuda' if torch.cuda.is_available() else 'cpu')
+        self.correctness = torch.zeros(n_data, dtype=torch.int32, device=self.device)
         self.max_correctness = 1
+        self.histogram = torch.zeros(self.max_correctness + 2, dtype=torch.int64, device=self.device)
+        self.histogram[0] = n_data
 
     # correctness update
     def update(self, data_idx, correctness):
-        self.correctness[data_idx] += correctness.cpu().numpy()
+        data_idx = data_idx.to(self.device, non_blocking=True)
+        old = self.correctness[data_idx]
+        new = old + correctness.view(-1).to(self.device, torch.int32)
+        self.correctness[data_idx] = new
+        ones = torch.ones_like(old, dtype=torch.int64)
+        self.histogram.index_add_(0, old.long(), -ones).index_add_(0, new.long(), ones)
 
     def max_correctness_update(self, epoch):
         if epoch > 1:
             self.max_correctness += 1
+        if len(self.histogram) < self.max_correctness + 2:
+            self.histogram = torch.cat([self.histogram, self.histogram.new_zeros(self.max_correctness + 2 -
+                                                                                 len(self.histogram))])
+
+    # smallest count, first non-empty bin of the histogram (0-dim tensor, no sync)
+    def min_correctness(self):
+        return self.histogram.ne(0).int().argmax()
 
     # correctness normalize (0 ~ 1) range
     def _normalize(self, data):
-        data_min = self.correctness.min()
-        data_max = float(self.max_correctness)
-
-        return (data - data_min) / (data_max - data_min)
+        data_min = self.min_correctness()
+        return (data - data_min).float() / (self.max_correctness - data_min).float()
 
     # get target & margin
     def get_target_margin(self, idx1, idx2):
-        idx1 = idx1.cpu().numpy()
-        idx2 = idx2.cpu().numpy()
-        correctness_norm = self._normalize(self.correctness)
-
-        target1, target2 = correctness_norm[idx1], correctness_norm[idx2]
+        correctness1 = self.correctness[idx1.to(self.device, non_blocking=True)]
+        correctness2 = self.correctness[idx2.to(self.device, non_blocking=True)]
 
         # 1 for idx1 > idx2, 0 for idx1 = idx2, -1 for idx1 < idx2
-        target = np.array(target1 > target2, dtype='float') + np.array(target1 < target2, dtype='float') * (-1)
-        target = torch.from_numpy(target).float().cuda()
+        target = torch.sign(correctness1 - correctness2).float()
 
         # calc margin
-        margin = abs(target1 - target2)
-        margin = torch.from_numpy(margin).float().cuda()
+        margin = (self._normalize(correctness1) - self._normalize(correctness2)).abs()
 
         return target, margin
 
@@ -68,43 +90,91 @@ class CRL_Criterion(nn.Module):
     ICML 2020
     http://proceedings.mlr.press/v119/moon20a/moon20a.pdf
     code borrows from: https://github.com/daintlab/confidence-aware-learning/blob/master/crl_utils.py
+
+    pairing: samples ranked against each other in the batch
+        roll: every sample with the next one (B pairs)
+        all: every pair of samples (B * (B - 1) / 2 pairs)
+        sampled: every sample with nb_pair random other samples (B * nb_pair pairs)
     '''
 
-    def __init__(self):
+    def __init__(self, pairing='roll', nb_pair=4):
         super().__init__()
         self.rank_criterion = torch.nn.MarginRankingLoss(margin=0)
-
-    def forward(self, output, image_idx, correct_log):
+        self.pairing = pairing
+        self.nb_pair = nb_pair
+
+    # batch positions (i, j) of the ranked pairs
+    def get_pairs(self, batch_size, device):
+        position = torch.arange(batch_size, device=device)
+        if self.pairing == 'roll':
+            return position, torch.roll(position, -1)
+        elif self.pairing == 'all':
+            pair = torch.triu_indices(batch_size, batch_size, offset=1, device=device)
+            return pair[0], pair[1]
+        # random offset in [1, B - 1]: never paired with itself
+        offset = torch.randint(1, batch_size, (batch_size, self.nb_pair), device=device)
+        return position.repeat_interleave(self.nb_pair), ((position.view(-1, 1) + offset) % batch_size).view(-1)
+
+    # pairs and ranking target:
+    # 1 for image_idx[i] > image_idx[j]
+    # 0 for image_idx[i] = image_idx[j]
+    # -1 for image_idx[i] < image_idx[j]
+    def get_target_margin(self, image_idx, correct_log):
+        image_idx = image_idx.to(correct_log.device, non_blocking=True)
+        pair_i, pair_j = self.get_pairs(len(image_idx), image_idx.device)
+        rank_target, rank_margin = correct_log.get_target_margin(image_idx[pair_i], image_idx[pair_j])
+        return pair_i, pair_j, rank_target, rank_margin
+
+    # target_margin: reuse the output of get_target_margin
+    def forward(self, output, image_idx, correct_log, target_margin=None):
         conf, _ = F.softmax(output, dim=1).max(dim=1)
-        conf_roll, image_idx_roll = torch.roll(conf, -1), torch.roll(image_idx, -1)
-
-        # ranking target:
-        # 1 for image_idx > image_idx_roll
-        # 0 for image_idx = image_idx_roll
-        # -1 for image_idx < image_idx_roll
-        rank_target, rank_margin = correct_log.get_target_margin(image_idx, image_idx_roll)
-        conf_roll = conf_roll + rank_margin / (rank_target + 1e-7)
-        ranking_loss = self.rank_criterion(conf, conf_roll, rank_target)
+        pair_i, pair_j, rank_target, rank_margin = target_margin if target_margin is not None else \
+            self.get_target_margin(image_idx, correct_log)
+        conf_j = conf[pair_j] + rank_margin / (rank_target + 1e-7)
+        ranking_loss = self.rank_criterion(conf[pair_i], conf_j, rank_target)
         return ranking_loss
 
 
-def compute_loss(args, net, image, target, image_idx, correct_log, cls_criterion, mixup_criterion, rank_criterion):
-    output = net(image)
-    loss_ce = cls_criterion(output, target)
-    mixup_criterion.get_mixup_data(image, target)
-    loss_mixup = mixup_criterion(image, target, net)
-    loss_crl = rank_criterion(output, image_idx, correct_log)
+# clean and mixup forwards: separate, or fused into one forward of the concatenated batches (logits split back),
+# 'fused-split-bn' keeps one BN pass per half as the separate forwards do (see utils.split_bn)
+def forward_clean_mixup(args, net, image, target, cls_criterion, mixup_criterion, mixup_data):
+    if args.mixup_forward == 'separate':
+        output = net(image)
+        return output, cls_criterion(output, target), mixup_criterion(image, target, net, mixup_data)
+
+    mixed_image, shuffled_target, beta = mixup_data
+    batch_size = image.size(0)
+    with utils.split_bn.split_batch_norm(net, [batch_size, batch_size], enabled=args.mixup_forward == 'fused-split-bn'):
+        output, pred_mixed = net(torch.cat([image, mixed_image])).split(batch_size)
+    return output, cls_criterion(output, target), mixup_criterion.mixup_loss(pred_mixed, target, shuffled_target, beta)
+
+
+# batch_cache: mixup draw and CRL targets of the batch, filled by the first call and reused by the next ones
+# (the second SAM pass evaluates the same loss at the perturbed weights)
+def compute_loss(args, net, image, target, image_idx, correct_log, cls_criterion, mixup_criterion, rank_criterion,
+                 batch_cache=None):
+    batch_cache = batch_cache if batch_cache is not None else {}
+    if 'mixup' not in batch_cache:
+        batch_cache['mixup'] = mixup_criterion.get_mixup_data(image, target)
+    if 'rank' not in batch_cache:
+        batch_cache['rank'] = rank_criterion.get_target_margin(image_idx, correct_log)
+    output, loss_ce, loss_mixup = forward_clean_mixup(args, net, image, target, cls_criterion, mixup_criterion,
+                                                      batch_cache['mixup'])
+    loss_crl = rank_criterion(output, image_idx, correct_log, batch_cache['rank'])
     loss = loss_ce + args.mixup_weight * loss_mixup + args.crl_weight * loss_crl
     return loss, loss_ce, loss_mixup, loss_crl, output
 
 
-def train(train_loader, net, optimizer, epoch, correct_log, logger, writer, args):
+# scaler: AMP GradScaler shared by the epochs (see utils.amp), a new one when None
+def train(train_loader, net, optimizer, epoch, correct_log, logger, writer, args, scaler=None):
     net.train()
+    device = next(net.parameters()).device
+    scaler = scaler if scaler is not None else utils.amp.get_grad_scaler(args.amp)
 
     ## define criterion
     cls_criterion = torch.nn.CrossEntropyLoss()
     mixup_criterion = Mixup_Criterion(beta=args.mixup_beta, cls_criterion=cls_criterion)
-    rank_criterion = CRL_Criterion()
+    rank_criterion = CRL_Criterion(args.crl_pairs, args.crl_nb_pair)
 
     train_log = {
         'Top1 Acc.': utils.utils.AverageMeter(),
@@ -119,26 +189,39 @@ def train(train_loader, net, optimizer, epoch, correct_log, logger, writer, args
     msg = '####### --- Training Epoch {:d} --- #######'.format(epoch)
     logger.info(msg)
     for i, (image, target, image_idx) in enumerate(train_loader):
-        image, target = image.cuda(), target.long().cuda()
-        loss, loss_ce, loss_mixup, loss_crl, output = compute_loss(args,
-                                                                   net,
-                                                                   image,
-                                                                   target,
-                                                                   image_idx,
-                                                                   correct_log,
-                                                                   cls_criterion,
-                                                                   mixup_criterion,
-                                                                   rank_criterion)
+        image, target = image.to(device), target.long().to(device)
+        batch_cache = {}
+        with utils.amp.autocast(args.amp, device):
+            loss, loss_ce, loss_mixup, loss_crl, output = compute_loss(args,
+                                                                       net,
+                                                                       image,
+                                                                       target,
+                                                                       image_idx,
+                                                                       correct_log,
+                                                                       cls_criterion,
+                                                                       mixup_criterion,
+                                                                       rank_criterion,
+                                                                       batch_cache)
         optimizer.zero_grad()
-        loss.backward()
+        scaler.scale(loss).backward()
         if args.optim_name in ['sam', 'fmfp']:
-
-            optimizer.first_step(zero_grad=True)
-            compute_loss(args, net, image, target, image_idx, correct_log, cls_criterion, mixup_criterion,
-                         rank_criterion)[0].backward()
-            optimizer.second_step(zero_grad=True)
+            # the ascent reads the gradient norm: unscaled first, both SAM steps skipped on overflow
+            scaler.unscale_(optimizer)
+            if utils.amp.found_inf(scaler, optimizer):
+                optimizer.zero_grad()
+            elif not optimizer.is_sharpness_step():
+                # LookSAM between two ascents: the stored direction, no second pass
+                optimizer.reuse_step(zero_grad=True)
+            else:
+                optimizer.first_step(zero_grad=True)
+                with utils.amp.autocast(args.amp, device):
+                    loss_sam = compute_loss(args, net, image, target, image_idx, correct_log, cls_criterion,
+                                            mixup_criterion, rank_criterion, batch_cache)[0]
+                scaler.scale(loss_sam).backward()
+                optimizer.second_step(zero_grad=True, scaler=scaler)
         else:
-            optimizer.step()
+            scaler.step(optimizer)
+        scaler.update()
         prec, correct = utils.utils.accuracy(output, target)
         correct_log.update(image_idx, correct)
         for param_group in optimizer.param_groups:
@@ -1,4 +1,5 @@
 import utils.utils
+import utils.amp
 import torch.nn as nn
 import torch
 import numpy as np
@@ -9,10 +10,11 @@ import os
 
 def compute_confidence_scores(net, train_loader):
     net.eval()  # Set the model to evaluation mode
+    device = next(net.parameters()).device
     confidence_scores = np.zeros(len(train_loader.dataset))
     with torch.no_grad():
         for i, (image, target, image_idx) in enumerate(train_loader):
-            image = image.cuda()
+            image = image.to(device)
             output = net(image)
             softmax_scores = F.softmax(output, dim=1)
             max_scores, _ = softmax_scores.max(dim=1)
@@ -43,43 +45,62 @@ class Mixup_Criterion(nn.Module):
 
 
 class Correctness_Log(object):
-    def __init__(self, n_data):
-        self.correctness = np.zeros((n_data))
+    '''
+    Per-sample count of correct predictions, an int32 tensor on the training device.
+    Counts only grow, so their minimum is tracked with a histogram of the counts updated by every batch: a batch
+    gathers its own rows only, without a pass over the whole log nor a host round-trip.
+    Every sample is expected once per epoch (the histogram covers counts up to max_correctness + 1).
+    '''
+
+    def __init__(self, n_data, device=None):
+        self.device = torch.device(device if device is not None else 'cuda' if torch.cuda.is_available() else 'cpu')
+        self.correctness = torch.zeros(n_data, dtype=torch.int32, device=self.device)
         self.max_correctness = 1
+        self.histogram = torch.zeros(self.max_correctness + 2, dtype=torch.int64, device=self.device)
+        self.histogram[0] = n_data
 
     # correctness update
     def update(self, data_idx, correctness):
-        self.correctness[data_idx] += correctness.cpu().numpy()
-
+        data_idx = data_idx.to(self.device, non_blocking=True)
+        old = self.correctness[data_idx]
+        new = old + correctness.view(-1).to(self.device, torch.int32)
+        self.correctness[data_idx] = new
+        ones = torch.ones_like(old, dtype=torch.int64)
+        self.histogram.index_add_(0, old.long(), -ones).index_add_(0, new.long(), ones)
+
+    # grow (or shrink) to new_size samples, repeating the log as np.resize does
     def resize(self, new_size):
-        self.correctness = np.resize(self.correctness, new_size)
+        nb_repeat = -(-new_size // len(self.correctness))
+        self.correctness = self.correctness.repeat(nb_repeat)[:new_size]
+        ones = torch.ones_like(self.correctness, dtype=torch.int64)
+        self.histogram.zero_().index_add_(0, self.correctness.long(), ones)
 
     def max_correctness_update(self, epoch):
         if epoch > 1:
             self.max_correctness += 1
+        if len(self.histogram) < self.max_correctness + 2:
+            self.histogram = torch.cat([self.histogram, self.histogram.new_zeros(self.max_correctness + 2 -
+                                                                                 len(self.histogram))])
+
+    # smallest count, first non-empty bin of the histogram (0-dim tensor, no sync)
+    def min_correctness(self):
+        return self.histogram.ne(0).int().argmax()
 
     # correctness normalize (0 ~ 1) range
     def _normalize(self, data):
-        data_min = self.correctness.min()
-        data_max = float(self.max_correctness)
-
-        return (data - data_min) / (data_max - data_min)
+        data_min = self.min_correctness()
+        return (data - data_min).float() / (self.max_correctness - data_min).float()
 
     # get target & margin
     def get_target_margin(self, idx1, idx2):
-        idx1 = idx1.cpu().numpy()
-        idx2 = idx2.cpu().numpy()
-        correctness_norm = self._normalize(self.correctness)
-
-        target1, target2 = correctness_norm[idx1], correctness_norm[idx2]
+        correctness1 = self.correctness[idx1.to(self.device, non_blocking=True)]
+        correctness2 = self.correctness[idx2.to(self.device, non_blocking=True)]
 
         # 1 for idx1 > idx2, 0 for idx1 = idx2, -1 for idx1 < idx2
-        target = np.array(target1 > target2, dtype='float') + np.array(target1 < target2, dtype='float') * (-1)
-        target = torch.from_numpy(target).float().cuda()
+        target = torch.sign(correctness1 - correctness2).float()
 
         # calc margin
-        margin = abs(target1 - target2)
-        margin = torch.from_numpy(margin).float().cuda()
+        margin = (self._normalize(correctness1) - self._normalize(correctness2)).abs()
 
         return target, margin
 
@@ -145,7 +166,11 @@ def compute_loss(args, net, image, target, image_idx, correct_log, cls_criterion
     return loss, loss_ce, loss_mixup, loss_crl, output
 
 
-def train(train_loader, net, optimizer, epoch, correct_log, logger, writer, args, confidence_scores=None):
+# scaler: AMP GradScaler shared by the epochs (see utils.amp), a new one when None
+def train(train_loader, net, optimizer, epoch, correct_log, logger, writer, args, confidence_scores=None,
+          scaler=None):
+    device = next(net.parameters()).device
+    scaler = scaler if scaler is not None else utils.amp.get_grad_scaler(args.amp)
 
     ## define criterion
     cls_criterion = torch.nn.CrossEntropyLoss()
@@ -172,27 +197,35 @@ def train(train_loader, net, optimizer, epoch, correct_log, logger, writer, args
     msg = '####### --- Training Epoch {:d} --- #######'.format(epoch)
     logger.info(msg)
     for i, (image, target, image_idx) in enumerate(train_loader):
-        image, target = image.cuda(), target.long().cuda()
-        loss, loss_ce, loss_mixup, loss_crl, output = compute_loss(args,
-                                                                   net,
-                                                                   image,
-                                                                   target,
-                                                                   image_idx,
-                                                                   correct_log,
-                                                                   cls_criterion_confidence,
-                                                                   mixup_criterion,
-                                                                   rank_criterion,
-                                                                   confidence_scores)
+        image, target = image.to(device), target.long().to(device)
+        with utils.amp.autocast(args.amp, device):
+            loss, loss_ce, loss_mixup, loss_crl, output = compute_loss(args,
+                                                                       net,
+                                                                       image,
+                                                                       target,
+                                                                       image_idx,
+                                                                       correct_log,
+                                                                       cls_criterion_confidence,
+                                                                       mixup_criterion,
+                                                                       rank_criterion,
+                                                                       confidence_scores)
         optimizer.zero_grad()
-        loss.backward()
+        scaler.scale(loss).backward()
         if args.optim_name in ['sam', 'fmfp']:
-
-            optimizer.first_step(zero_grad=True)
-            compute_loss(args, net, image, target, image_idx, correct_log, cls_criterion, mixup_criterion,
-                         rank_criterion)[0].backward()
-            optimizer.second_step(zero_grad=True)
+            # the ascent reads the gradient norm: unscaled first, both SAM steps skipped on overflow
+            scaler.unscale_(optimizer)
+            if utils.amp.found_inf(scaler, optimizer):
+                optimizer.zero_grad()
+            else:
+                optimizer.first_step(zero_grad=True)
+                with utils.amp.autocast(args.amp, device):
+                    loss_sam = compute_loss(args, net, image, target, image_idx, correct_log, cls_criterion,
+                                            mixup_criterion, rank_criterion)[0]
+                scaler.scale(loss_sam).backward()
+                optimizer.second_step(zero_grad=True, scaler=scaler)
         else:
-            optimizer.step()
+            scaler.step(optimizer)
+        scaler.update()
         prec, correct = utils.utils.accuracy(output, target)
         correct_log.update(image_idx, correct)
         for param_group in optimizer.param_groups:
@@ -0,0 +1,37 @@
+import torch
+
+'''
+Automatic mixed precision for the training loops.
+    fp16: autocast to float16 and a GradScaler (CUDA only)
+    bf16: autocast to bfloat16 on CUDA or CPU, same exponent range as float32 so no loss scaling
+With SAM the scaled gradients are unscaled before the ascent (its step size reads the gradient norm), and both SAM
+steps are skipped when their gradients overflow, see train.train.
+'''
+
+AMP_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast(amp, device):
+    device_type = torch.device(device).type
+    if amp == 'fp16' and device_type != 'cuda':
+        raise ValueError('fp16 autocast needs a CUDA device, use bf16 on CPU')
+    return torch.autocast(device_type, dtype=AMP_DTYPES.get(amp), enabled=amp != 'none')
+
+
+# loss scaling for fp16 only, a disabled scaler is a no-op (scale returns the loss, step calls optimizer.step)
+# torch.amp.GradScaler from torch 2.3, torch.cuda.amp.GradScaler before
+def get_grad_scaler(amp):
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=amp == 'fp16')
+    return torch.cuda.amp.GradScaler(enabled=amp == 'fp16')
+
+
+# whether the gradients unscaled by scaler.unscale_(optimizer) overflowed: the same inf / nan test GradScaler.step
+# applies before skipping the step, one synchronization
+def found_inf(scaler, optimizer):
+    if not scaler.is_enabled():
+        return False
+    grads = [p.grad for group in optimizer.param_groups for p in group['params'] if p.grad is not None]
+    if not grads:
+        return False
+    return not bool(torch.stack([torch.isfinite(grad).all() for grad in grads]).all())
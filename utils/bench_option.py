@@ -0,0 +1,28 @@
+import argparse
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description='Microbenchmark of the metrics used in validation',
+                                     add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--nb-samples', default=[10000, 100000, 1000000, 10000000], type=int, nargs='+',
+                        help='Nb of samples N of the synthetic predictions')
+    parser.add_argument('--nb-cls', default=[10, 100, 1000, 8142], type=int, nargs='+',
+                        help='Nb of classes C of the synthetic predictions')
+    parser.add_argument('--max-elements', default=100000000, type=int,
+                        help='Skip the (N, C) cells whose softmax has more elements than this')
+    parser.add_argument('--repeat', default=5, type=int,
+                        help='Nb of timed calls per metric, the median is compared with the baseline')
+    parser.add_argument('--acc', default=0.8, type=float, help='Accuracy of the synthetic predictions')
+    parser.add_argument('--seed', default=0, type=int, help='Random seed')
+    parser.add_argument('--metrics', default=None, type=str, nargs='+', help='Metrics to run, all by default')
+
+    ## baseline + regression check
+    parser.add_argument('--save-path', default='./bench_metrics.json', type=str, help='Where to write the JSON results')
+    parser.add_argument('--baseline', default=None, type=str, help='JSON baseline to compare with')
+    parser.add_argument('--tolerance', default=10.0, type=float,
+                        help='Flag metrics more than this percentage slower than the baseline')
+    parser.add_argument('--min-diff', default=0.01, type=float,
+                        help='Noise floor: never flag a slowdown of less than this many seconds')
+
+    return parser.parse_args()
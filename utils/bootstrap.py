@@ -0,0 +1,138 @@
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import utils.calibration
+
+'''
+Bootstrap confidence intervals of the failure-prediction metrics.
+The samples are sorted by descending confidence once; a replicate is a row of resampling counts over that order,
+so every metric of a block of replicates comes from weighted cumulative sums over the same presorted arrays.
+'''
+
+_state = {}
+
+
+def _init_worker(state):
+    _state.update(state)
+
+
+# Presorted arrays shared by every replicate
+def get_bootstrap_state(confidence, correct, nll, brier, bins=15):
+    confidence = np.asarray(confidence, dtype=np.float64)
+    order = np.argsort(-confidence, kind='stable')
+    sort_confidence = confidence[order]
+    nb_sample = len(confidence)
+
+    # last index of each group of tied confidences / of each non-empty equal-width bin
+    bin_idx = utils.calibration.get_bin_index(sort_confidence, bins)
+    return {
+        'confidence': sort_confidence,
+        'correct': np.asarray(correct, dtype=np.float64)[order],
+        'nll': np.asarray(nll, dtype=np.float64)[order],
+        'brier': np.asarray(brier, dtype=np.float64)[order],
+        'threshold_idx': np.r_[np.flatnonzero(np.diff(sort_confidence)), nb_sample - 1],
+        'bin_end_idx': np.r_[np.flatnonzero(np.diff(bin_idx)), nb_sample - 1],
+        # harmonic numbers, harmonic[k] = 1 + 1/2 + ... + 1/k
+        'harmonic': np.r_[0, np.cumsum(1. / np.arange(1, nb_sample + 1))],
+    }
+
+
+# Resampling counts (block_size, N) of one block of replicates
+def draw_counts(rng, block_size, nb_sample):
+    idx = rng.integers(0, nb_sample, size=(block_size, nb_sample))
+    idx += np.arange(block_size)[:, None] * nb_sample
+
+    return np.bincount(idx.ravel(), minlength=block_size * nb_sample).reshape(block_size, nb_sample)
+
+
+# All metrics of a block of replicates, rows are replicates
+def _bootstrap_block(seed, block_size, state=None):
+    state = _state if state is None else state
+    nb_sample = len(state['confidence'])
+    weight = draw_counts(np.random.default_rng(seed), block_size, nb_sample).astype(np.float64)
+
+    correct, threshold_idx, bin_end_idx = state['correct'], state['threshold_idx'], state['bin_end_idx']
+    cum_count = np.cumsum(weight, axis=1)
+    cum_correct = np.cumsum(weight * correct, axis=1)
+    cum_error = cum_count - cum_correct
+
+    # acc, nll, brier
+    acc = cum_correct[:, -1] / nb_sample
+    nll = weight @ state['nll'] / nb_sample
+    brier = weight @ state['brier'] / nb_sample
+
+    # aurc: every copy of a sample adds its own risk, sum_j (E + j * e) / (C + j) over the w copies
+    prev_count = (cum_count - weight).astype(np.int64)
+    prev_error = cum_error - weight * (1 - correct)
+    error = 1 - correct
+    harmonic_gap = state['harmonic'][cum_count.astype(np.int64)] - state['harmonic'][prev_count]
+    aurc = np.sum(error * weight + (prev_error - error * prev_count) * harmonic_gap, axis=1) / nb_sample
+    r = cum_error[:, -1] / nb_sample
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eaurc = aurc - (r + (1 - r) * np.log(1 - r))
+
+    # roc & precision-recall curves at every distinct confidence
+    tps, count = cum_correct[:, threshold_idx], cum_count[:, threshold_idx]
+    fps = count - tps
+    zeros = np.zeros((block_size, 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpr = np.hstack([zeros, tps]) / tps[:, -1:]
+        fpr = np.hstack([zeros, fps]) / fps[:, -1:]
+        auroc = np.sum(np.diff(fpr, axis=1) * (tpr[:, 1:] + tpr[:, :-1]), axis=1) / 2
+        fpr_in_tpr_95 = fpr[np.arange(block_size), np.argmin(np.abs(tpr - 0.95), axis=1)]
+
+        precision = np.where(count > 0, tps / count, 1.)
+        recall = np.hstack([zeros, tps / tps[:, -1:]])
+        precision = np.hstack([np.ones((block_size, 1)), precision])
+        aupr_success = np.sum(np.diff(recall, axis=1) * (precision[:, 1:] + precision[:, :-1]), axis=1) / 2
+
+        err_tps = fps[:, -1:] - np.hstack([zeros, fps[:, :-1]])[:, ::-1]
+        err_count = nb_sample - np.hstack([zeros, count[:, :-1]])[:, ::-1]
+        err_precision = np.where(err_count > 0, err_tps / err_count, 0.)
+        err_recall = np.hstack([zeros, err_tps / fps[:, -1:]])
+        aupr_err = np.sum(np.diff(err_recall, axis=1) * err_precision, axis=1)
+
+    # ece: equal-width bins are contiguous in the presorted order
+    cum_conf = np.cumsum(weight * state['confidence'], axis=1)
+    bin_conf_sum = np.diff(np.hstack([zeros, cum_conf[:, bin_end_idx]]), axis=1)
+    bin_acc_sum = np.diff(np.hstack([zeros, cum_correct[:, bin_end_idx]]), axis=1)
+    ece = np.sum(np.abs(bin_conf_sum - bin_acc_sum), axis=1) / nb_sample
+
+    return {
+        'Acc.': acc*100,
+        'FPR' : fpr_in_tpr_95*100,
+        'AUROC': auroc*100,
+        'AUPR': aupr_err*100,
+        'AURC': aurc*1000,
+        'EAURC': eaurc*1000,
+        'AUPR Succ.': aupr_success*100,
+        'ECE' : ece*100,
+        'NLL' : nll*10,
+        'Brier' : brier*100
+    }
+
+
+# (low, high) percentile interval of every metric from nb_boot replicates, blocks spread over nb_worker processes
+def bootstrap_ci(confidence, correct, nll, brier, nb_boot=1000, alpha=0.05, nb_worker=1, seed=0,
+                 max_block_elements=2 ** 23, bins=15):
+    state = get_bootstrap_state(confidence, correct, nll, brier, bins=bins)
+    nb_sample = len(state['confidence'])
+
+    block_size = int(np.clip(max_block_elements // nb_sample, 1, nb_boot))
+    block_sizes = [min(block_size, nb_boot - start) for start in range(0, nb_boot, block_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(block_sizes))
+
+    if nb_worker > 1:
+        # spawn rather than fork: the parent already started torch / OpenMP threads
+        with ProcessPoolExecutor(max_workers=nb_worker, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(state,)) as executor:
+            blocks = list(executor.map(_bootstrap_block, seeds, block_sizes))
+    else:
+        blocks = [_bootstrap_block(s, b, state) for s, b in zip(seeds, block_sizes)]
+
+    ci = {}
+    for key in blocks[0]:
+        values = np.concatenate([block[key] for block in blocks])
+        ci[key] = tuple(np.nanpercentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)]))
+
+    return ci
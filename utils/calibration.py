@@ -0,0 +1,131 @@
+import numpy as np
+
+# Equal-width bin of each confidence, bins are (lower, upper] as in the original ECE loop
+def get_bin_index(confidence, bins=15):
+    bin_boundaries = np.linspace(0, 1, bins + 1)
+    bin_idx = np.digitize(confidence, bin_boundaries, right=True) - 1
+
+    return np.clip(bin_idx, 0, bins - 1)
+
+# Equal-mass bin of each confidence, every bin holds about N / bins samples
+def get_adaptive_bin_index(confidence, bins=15):
+    bin_boundaries = np.quantile(confidence, np.linspace(0, 1, bins + 1))
+
+    return np.digitize(confidence, bin_boundaries[1:-1], right=True)
+
+# Count, sum of confidence and sum of correctness per bin
+def get_bin_statistics(bin_idx, confidence, correct, bins=15):
+    count = np.bincount(bin_idx, minlength=bins)
+    conf_sum = np.bincount(bin_idx, weights=confidence, minlength=bins)
+    acc_sum = np.bincount(bin_idx, weights=correct, minlength=bins)
+
+    return count, conf_sum, acc_sum
+
+# ECE, MCE, RMSCE from the per-bin statistics
+def calibration_errors(count, conf_sum, acc_sum, nb_sample):
+    non_empty = count > 0
+    gap = np.abs(conf_sum[non_empty] - acc_sum[non_empty]) / count[non_empty]
+    prop_in_bin = count[non_empty] / nb_sample
+
+    ece = np.sum(gap * prop_in_bin)
+    mce = gap.max() if len(gap) > 0 else 0.
+    rmsce = np.sqrt(np.sum(gap ** 2 * prop_in_bin))
+
+    return ece, mce, rmsce
+
+# Reliability diagram: accuracy and average confidence per equal-width bin
+def reliability_diagram(count, conf_sum, acc_sum, bins=15):
+    bin_boundaries = np.linspace(0, 1, bins + 1)
+    safe_count = np.maximum(count, 1)
+
+    return {
+        'bin_lower': bin_boundaries[:-1],
+        'bin_upper': bin_boundaries[1:],
+        'count': count,
+        'accuracy': np.where(count > 0, acc_sum / safe_count, 0.),
+        'confidence': np.where(count > 0, conf_sum / safe_count, 0.),
+    }
+
+# Reliability diagram of per-sample confidences
+def calc_reliability_diagram(confidence, correct, bins=15):
+    confidence = np.asarray(confidence, dtype=np.float64)
+    correct = np.asarray(correct, dtype=np.float64)
+
+    return reliability_diagram(*get_bin_statistics(get_bin_index(confidence, bins), confidence, correct, bins), bins)
+
+# ECE
+def calc_ece(confidence, correct, bins=15):
+    confidence = np.asarray(confidence, dtype=np.float64)
+    correct = np.asarray(correct, dtype=np.float64)
+    bin_stats = get_bin_statistics(get_bin_index(confidence, bins), confidence, correct, bins)
+
+    return calibration_errors(*bin_stats, len(confidence))[0]
+
+# Count, sum of probability and sum of onehot label per (class, bin) for a chunk of softmax
+def get_classwise_bin_statistics(softmax, label, bins=15):
+    nb_cls = softmax.shape[1]
+    softmax = np.asarray(softmax, dtype=np.float64)
+    onehot = np.asarray(label)[:, None] == np.arange(nb_cls)
+    flat_idx = (np.arange(nb_cls) * bins + get_bin_index(softmax, bins)).ravel()
+
+    count = np.bincount(flat_idx, minlength=nb_cls * bins)
+    conf_sum = np.bincount(flat_idx, weights=softmax.ravel(), minlength=nb_cls * bins)
+    acc_sum = np.bincount(flat_idx, weights=onehot.ravel(), minlength=nb_cls * bins)
+
+    return count, conf_sum, acc_sum
+
+# Classwise ECE from the per-(class, bin) statistics, averaged over classes
+def classwise_calibration_error(conf_sum, acc_sum, nb_sample, nb_cls):
+    return np.abs(conf_sum - acc_sum).reshape(nb_cls, -1).sum(1).mean() / nb_sample
+
+# Classwise ECE, one bincount over (class, bin) per chunk
+def calc_classwise_ece(softmax, label, bins=15, chunk_size=1024):
+    nb_cls = softmax.shape[1]
+    conf_sum, acc_sum = np.zeros(nb_cls * bins), np.zeros(nb_cls * bins)
+
+    for start in range(0, len(label), chunk_size):
+        end = min(start + chunk_size, len(label))
+        _, chunk_conf_sum, chunk_acc_sum = get_classwise_bin_statistics(softmax[start:end], label[start:end], bins)
+        conf_sum += chunk_conf_sum
+        acc_sum += chunk_acc_sum
+
+    return classwise_calibration_error(conf_sum, acc_sum, len(label), nb_cls)
+
+# ECE, AdaECE, MCE, RMSCE (+ classwise ECE with softmax & label) and the reliability diagram
+def calc_calibration(confidence, correct, softmax=None, label=None, bins=15):
+    confidence = np.asarray(confidence, dtype=np.float64)
+    correct = np.asarray(correct, dtype=np.float64)
+
+    bin_stats = get_bin_statistics(get_bin_index(confidence, bins), confidence, correct, bins)
+    ece, mce, rmsce = calibration_errors(*bin_stats, len(confidence))
+
+    ada_bin_stats = get_bin_statistics(get_adaptive_bin_index(confidence, bins), confidence, correct, bins)
+    ada_ece = calibration_errors(*ada_bin_stats, len(confidence))[0]
+
+    res = {'ECE': ece, 'AdaECE': ada_ece, 'MCE': mce, 'RMSCE': rmsce}
+    if softmax is not None and label is not None:
+        res['CwECE'] = calc_classwise_ece(softmax, label, bins)
+
+    return res, reliability_diagram(*bin_stats, bins)
+
+# ECE, AdaECE, MCE, RMSCE of every column of an (N, K) confidence matrix, one bincount for all columns
+def calc_calibration_columns(confidence, correct, bins=15):
+    confidence = np.asarray(confidence, dtype=np.float64)
+    correct = np.broadcast_to(np.asarray(correct, dtype=np.float64)[:, None], confidence.shape)
+    nb_sample, nb_col = confidence.shape
+    col_offset = np.arange(nb_col) * bins
+
+    bin_stats = get_bin_statistics((get_bin_index(confidence, bins) + col_offset).ravel(), confidence.ravel(),
+                                   correct.ravel(), nb_col * bins)
+    ada_bin_idx = np.stack([get_adaptive_bin_index(confidence[:, k], bins) for k in range(nb_col)], axis=1)
+    ada_bin_stats = get_bin_statistics((ada_bin_idx + col_offset).ravel(), confidence.ravel(), correct.ravel(),
+                                       nb_col * bins)
+
+    res = {'ECE': [], 'AdaECE': [], 'MCE': [], 'RMSCE': []}
+    for k in range(nb_col):
+        ece, mce, rmsce = calibration_errors(*[stat[k * bins:(k + 1) * bins] for stat in bin_stats], nb_sample)
+        ada_ece = calibration_errors(*[stat[k * bins:(k + 1) * bins] for stat in ada_bin_stats], nb_sample)[0]
+        for key, value in zip(['ECE', 'AdaECE', 'MCE', 'RMSCE'], [ece, ada_ece, mce, rmsce]):
+            res[key].append(value)
+
+    return {key: np.array(value) for key, value in res.items()}
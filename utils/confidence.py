@@ -0,0 +1,68 @@
+import math
+import torch
+import torch.nn.functional as F
+
+'''
+Confidence scores of a batch, higher means more confident.
+Every score takes the logits, Cosine also needs the penultimate features and the (nb_cls, feat_dim) classifier weight.
+'''
+
+# maximum softmax probability
+def msp(logit, feature=None, weight=None):
+    return F.softmax(logit, dim=1).max(1)[0]
+
+def max_logit(logit, feature=None, weight=None):
+    return logit.max(1)[0]
+
+# negative free energy, logsumexp of the logits
+def energy(logit, feature=None, weight=None):
+    return torch.logsumexp(logit, dim=1)
+
+# negative entropy of the softmax
+def entropy(logit, feature=None, weight=None):
+    log_softmax = F.log_softmax(logit, dim=1)
+    return (log_softmax.exp() * log_softmax).sum(1)
+
+# gap between the two largest softmax probabilities
+def margin(logit, feature=None, weight=None):
+    top2 = F.softmax(logit, dim=1).topk(2, dim=1)[0]
+    return top2[:, 0] - top2[:, 1]
+
+# largest cosine similarity between the feature and the class weights
+def cosine(logit, feature=None, weight=None):
+    return torch.mm(F.normalize(feature.float(), dim=1), F.normalize(weight.float(), dim=1).t()).max(1)[0]
+
+
+CONFIDENCE_SCORES = {
+    'MSP': msp,
+    'MaxLogit': max_logit,
+    'Energy': energy,
+    'Entropy': entropy,
+    'Margin': margin,
+    'Cosine': cosine,
+}
+
+# scores in [0, 1] on which calibration is measured
+PROBABILITY_SCORES = ['MSP', 'Margin', 'MC_MSP']
+
+# scores of Monte-Carlo dropout samples, see mc_confidence_scores
+MC_SCORES = ['MC_MSP', 'MC_Entropy', 'MC_MI']
+
+
+# (B, K) matrix of the requested scores
+def get_confidence_scores(logit, score_names, feature=None, weight=None):
+    logit = logit.float()
+    return torch.stack([CONFIDENCE_SCORES[name](logit, feature, weight) for name in score_names], dim=1)
+
+
+# (T, B, C) logits of T stochastic passes -> log of the mean softmax (B, C) and the (B, 3) MC_SCORES:
+# max of the mean softmax, negative predictive entropy, negative mutual information
+def mc_confidence_scores(logit_samples):
+    log_softmax = F.log_softmax(logit_samples.float(), dim=2)
+    log_mean = torch.logsumexp(log_softmax, dim=0) - math.log(logit_samples.size(0))
+
+    predictive_entropy = -(log_mean.exp() * log_mean).sum(1)
+    expected_entropy = -(log_softmax.exp() * log_softmax).sum(2).mean(0)
+    mutual_information = predictive_entropy - expected_entropy
+    scores = torch.stack([log_mean.exp().max(1)[0], -predictive_entropy, -mutual_information], dim=1)
+    return log_mean, scores
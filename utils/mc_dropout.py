@@ -0,0 +1,54 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+'''
+Monte-Carlo dropout: dropout stays active at test time while BN uses its running statistics.
+The T stochastic passes of a batch are one forward of the batch replicated T times (dropout masks are drawn per
+element, so every replica is an independent sample); the head-only variant samples dropout on the penultimate
+features of one deterministic backbone pass and runs only the classifier T times.
+'''
+
+
+# Dropout active, everything else (BN) in eval mode
+# nn.Dropout modules (VGG, DeiT), blocks calling F.dropout(training=self.training) (WRN, DenseNet) and the
+# penultimate-feature dropout of ResNet18 (mc_dropout flag); returns the nb of active dropout sites
+def enable_mc_dropout(net, droprate=0.5):
+    net.eval()
+    nb_site = 0
+    for module in net.modules():
+        if isinstance(module, nn.Dropout) and module.p > 0:
+            module.train()
+            nb_site += 1
+        elif getattr(module, 'droprate', 0) > 0:
+            # only the flag read by F.dropout, the BN children stay in eval mode
+            module.training = True
+            nb_site += 1
+        elif hasattr(module, 'mc_dropout'):
+            module.mc_dropout, module.mc_droprate = True, droprate
+            nb_site += 1
+    return nb_site
+
+
+def disable_mc_dropout(net):
+    for module in net.modules():
+        if hasattr(module, 'mc_dropout'):
+            module.mc_dropout = False
+    net.eval()
+
+
+# (T, B, C) logits of T stochastic passes, at most chunk_size images per forward
+def mc_logits(net, image, nb_mc, chunk_size=2048):
+    step = max(1, chunk_size // nb_mc)
+    samples = []
+    for start in range(0, image.size(0), step):
+        chunk = image[start:start + step]
+        repeated = chunk.unsqueeze(0).expand(nb_mc, *chunk.shape).reshape(-1, *chunk.shape[1:])
+        samples.append(net(repeated).float().view(nb_mc, chunk.size(0), -1))
+    return torch.cat(samples, dim=1)
+
+
+# (T, B, C) logits of the classifier on T dropout samples of the (B, D) penultimate features
+def head_mc_logits(classifier, feature, nb_mc, droprate=0.5):
+    repeated = feature.unsqueeze(0).expand(nb_mc, *feature.shape).reshape(-1, feature.size(1))
+    return classifier(F.dropout(repeated, p=droprate, training=True)).float().view(nb_mc, feature.size(0), -1)
@@ -0,0 +1,229 @@
+import numpy as np
+import utils.metrics
+import utils.calibration
+
+'''
+Mergeable, serializable metric state for sharded / multi-process evaluation.
+Every shard builds a Metric_State from its per-sample scalars, states are merged with merge() (associative) and
+compute() returns the same res dict as valid.validation.
+
+Ranking metrics (AUROC, AUPR, FPR, AURC, EAURC) come from
+  - sketch_bins=0: the (confidence, correctness) runs sorted by descending confidence, merged linearly (merge_runs).
+    Exact: merging the shards in dataset order reproduces the tie order of valid.validation.
+  - sketch_bins>0: a histogram of the confidence over sketch_bins equal-width bins of [0, 1] (count, nb of correct
+    predictions, sum of confidence per bin). Memory is fixed; samples of one sketch bin are treated as tied, so
+      |AUROC error| <= 1/2 * sum_b correct_b * wrong_b / (nb_correct * nb_wrong)
+    and AURC assumes the wrong predictions are evenly spread inside a bin, its error is at most the gap to the
+    orderings putting them first or last (see error_bound()). FPR and AUPR are read on the sketch thresholds and
+    AdaECE uses equal-mass bins snapped to the sketch bin edges.
+Acc., NLL, Brier, ECE, MCE, RMSCE and classwise ECE are exact in both modes (counts, sums and equal-width histograms).
+'''
+
+
+# Harmonic number H(n) = 1 + 1/2 + ... + 1/n without a table of size n (asymptotic expansion above 64)
+def harmonic(n):
+    n = np.asarray(n, dtype=np.float64)
+    small = np.r_[0, np.cumsum(1. / np.arange(1, 65))]
+    safe_n = np.maximum(n, 1)
+    large = np.log(safe_n) + np.euler_gamma + 1 / (2 * safe_n) - 1 / (12 * safe_n ** 2) + 1 / (120 * safe_n ** 4)
+
+    return np.where(n <= 64, small[np.minimum(n, 64).astype(np.int64)], large)
+
+
+# Merge of two runs sorted by descending confidence without re-sorting, the first run goes first on ties (as a stable
+# sort of the concatenation): every sample is placed at its rank in its own run plus the samples of the other run
+# ranked before it (searchsorted of sorted keys, each search starts from the previous one)
+def merge_runs(confidence, correct, other_confidence, other_correct):
+    position = np.arange(len(confidence)) + np.searchsorted(-other_confidence, -confidence, side='left')
+    other_position = np.arange(len(other_confidence)) + np.searchsorted(-confidence, -other_confidence, side='right')
+    merged_confidence = np.empty(len(confidence) + len(other_confidence), dtype=np.float64)
+    merged_correct = np.empty(len(merged_confidence), dtype=bool)
+    merged_confidence[position], merged_correct[position] = confidence, correct
+    merged_confidence[other_position], merged_correct[other_position] = other_confidence, other_correct
+    return merged_confidence, merged_correct
+
+
+class Metric_State(object):
+    def __init__(self, bins=15, sketch_bins=0, full_calibration=False):
+        self.bins = bins
+        self.sketch_bins = sketch_bins
+        self.full_calibration = full_calibration
+        self.nb_sample, self.nb_correct, self.nll_sum, self.brier_sum = 0, 0, 0., 0.
+        self.bin_count, self.bin_conf_sum, self.bin_acc_sum = np.zeros(bins), np.zeros(bins), np.zeros(bins)
+        self.cls_conf_sum, self.cls_acc_sum = None, None
+        if sketch_bins > 0:
+            self.sketch_count = np.zeros(sketch_bins)
+            self.sketch_correct = np.zeros(sketch_bins)
+            self.sketch_conf_sum = np.zeros(sketch_bins)
+        else:
+            self.confidence, self.correct = np.zeros(0), np.zeros(0, dtype=bool)
+        # batches not yet merged into the sorted run, sorted once by _flush
+        self._pending = []
+
+    # batch update with per-sample scalars, same arguments as utils.metrics.Metric_Log.update
+    def update(self, confidence, pred, target, nll, brier):
+        self._pending.append((np.asarray(confidence, dtype=np.float64), np.asarray(pred) == np.asarray(target),
+                              np.sum(nll), np.sum(brier)))
+
+    def _flush(self):
+        if len(self._pending) > 0:
+            confidence, correct, nll_sum, brier_sum = zip(*self._pending)
+            self._pending = []
+            self.merge(self._from_samples(np.concatenate(confidence), np.concatenate(correct), np.sum(nll_sum),
+                                          np.sum(brier_sum)))
+
+    # (class, bin) histogram of classwise ECE, see utils.calibration.get_classwise_bin_statistics
+    def update_classwise(self, conf_sum, acc_sum):
+        if self.cls_conf_sum is None:
+            self.cls_conf_sum, self.cls_acc_sum = np.zeros(len(conf_sum)), np.zeros(len(acc_sum))
+        self.cls_conf_sum += conf_sum
+        self.cls_acc_sum += acc_sum
+
+    def _from_samples(self, confidence, correct, nll_sum, brier_sum):
+        state = Metric_State(self.bins, self.sketch_bins, self.full_calibration)
+        state.nb_sample, state.nb_correct = len(correct), int(correct.sum())
+        state.nll_sum, state.brier_sum = float(nll_sum), float(brier_sum)
+        bin_idx = utils.calibration.get_bin_index(confidence, self.bins)
+        state.bin_count, state.bin_conf_sum, state.bin_acc_sum = \
+            utils.calibration.get_bin_statistics(bin_idx, confidence, correct, self.bins)
+        if self.sketch_bins > 0:
+            sketch_idx = np.clip((confidence * self.sketch_bins).astype(np.int64), 0, self.sketch_bins - 1)
+            state.sketch_count, state.sketch_conf_sum, state.sketch_correct = \
+                utils.calibration.get_bin_statistics(sketch_idx, confidence, correct, self.sketch_bins)
+        else:
+            order = np.argsort(-confidence, kind='stable')
+            state.confidence, state.correct = confidence[order], correct[order]
+        return state
+
+    # state of utils.metrics.Metric_Log (e.g. from valid.validation(..., return_log=True))
+    @classmethod
+    def from_metric_log(cls, metric_log, sketch_bins=0):
+        log = metric_log.get_log()
+        state = cls(metric_log.bins, sketch_bins, metric_log.full_calibration)
+        state.update(log['confidence'], log['pred'], log['target'], log['nll'], log['brier'])
+        if metric_log.cls_conf_sum is not None:
+            state.update_classwise(metric_log.cls_conf_sum, metric_log.cls_acc_sum)
+        return state
+
+    # merge the state of the next shard into this one (shards in dataset order for the exact tie order)
+    def merge(self, other):
+        if (self.bins, self.sketch_bins) != (other.bins, other.sketch_bins):
+            raise ValueError('Metric states with different bins cannot be merged')
+        self._flush()
+        other._flush()
+        self.nb_sample += other.nb_sample
+        self.nb_correct += other.nb_correct
+        self.nll_sum += other.nll_sum
+        self.brier_sum += other.brier_sum
+        self.bin_count = self.bin_count + other.bin_count
+        self.bin_conf_sum = self.bin_conf_sum + other.bin_conf_sum
+        self.bin_acc_sum = self.bin_acc_sum + other.bin_acc_sum
+        if other.cls_conf_sum is not None:
+            self.update_classwise(other.cls_conf_sum, other.cls_acc_sum)
+        if self.sketch_bins > 0:
+            self.sketch_count = self.sketch_count + other.sketch_count
+            self.sketch_correct = self.sketch_correct + other.sketch_correct
+            self.sketch_conf_sum = self.sketch_conf_sum + other.sketch_conf_sum
+        else:
+            self.confidence, self.correct = merge_runs(self.confidence, self.correct, other.confidence, other.correct)
+        return self
+
+    # plain dict of numpy arrays / numbers, e.g. for np.savez or pickle
+    def state_dict(self):
+        self._flush()
+        return {key: value for key, value in vars(self).items() if value is not None and key != '_pending'}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        state = {key: value.item() if isinstance(value, np.ndarray) and value.ndim == 0 else value
+                 for key, value in state.items()}
+        metric_state = cls(int(state['bins']), int(state['sketch_bins']), bool(state['full_calibration']))
+        for key, value in state.items():
+            setattr(metric_state, key, value)
+        return metric_state
+
+    def save(self, path):
+        np.savez(path, **self.state_dict())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            return cls.from_state_dict(dict(state))
+
+    # (count, nb of correct, sum of confidence) of the non-empty sketch bins, by descending confidence
+    def _sketch_groups(self):
+        non_empty = np.flatnonzero(self.sketch_count)[::-1]
+        return self.sketch_count[non_empty], self.sketch_correct[non_empty], self.sketch_conf_sum[non_empty]
+
+    # AURC of the sketch, wrong predictions evenly spread (or first / last) inside every bin
+    def _sketch_aurc(self, placement='even'):
+        count, correct, _ = self._sketch_groups()
+        error = count - correct
+        prev_count, prev_error = np.cumsum(count) - count, np.cumsum(error) - error
+        end = prev_count + count
+        if placement == 'even':
+            # sum_j (E + j * e / c) / (C + j) over the c samples of a bin
+            area = error + (prev_error - prev_count * error / count) * (harmonic(end) - harmonic(prev_count))
+        elif placement == 'first':
+            split = prev_count + error
+            area = error + (prev_error - prev_count) * (harmonic(split) - harmonic(prev_count)) + \
+                   (prev_error + error) * (harmonic(end) - harmonic(split))
+        else:
+            split = end - error
+            area = prev_error * (harmonic(split) - harmonic(prev_count)) + error + \
+                   (prev_error - split) * (harmonic(end) - harmonic(split))
+        return area.sum() / self.nb_sample
+
+    def _ranking(self):
+        self._flush()
+        if self.sketch_bins == 0:
+            return utils.metrics._ranking_metrics_sorted(self.confidence, self.correct.astype(np.float64))
+
+        count, correct, _ = self._sketch_groups()
+        aurc = self._sketch_aurc()
+        r = 1 - self.nb_correct / self.nb_sample
+        eaurc = aurc - (r + (1 - r) * np.log(1 - r))
+        return (aurc, eaurc) + utils.metrics._curve_metrics(np.cumsum(correct), np.cumsum(count))
+
+    # AdaECE from the sorted runs, or from equal-mass bins snapped to the sketch bin edges
+    def _adaptive_ece(self):
+        if self.sketch_bins == 0:
+            ada_bin_idx = utils.calibration.get_adaptive_bin_index(self.confidence, self.bins)
+            ada_bin_stats = utils.calibration.get_bin_statistics(ada_bin_idx, self.confidence, self.correct,
+                                                                 self.bins)
+        else:
+            mass = (np.cumsum(self.sketch_count) - self.sketch_count / 2) / self.nb_sample
+            ada_bin_idx = np.minimum((mass * self.bins).astype(np.int64), self.bins - 1)
+            ada_bin_stats = [np.bincount(ada_bin_idx, weights=stat, minlength=self.bins)
+                             for stat in [self.sketch_count, self.sketch_conf_sum, self.sketch_correct]]
+        return utils.calibration.calibration_errors(*ada_bin_stats, self.nb_sample)[0]
+
+    # worst-case deviation of the sketch AUROC / AURC from the exact values, in the units of res
+    def error_bound(self):
+        self._flush()
+        if self.sketch_bins == 0:
+            return {'AUROC': 0., 'AURC': 0.}
+        count, correct, _ = self._sketch_groups()
+        nb_wrong = self.nb_sample - self.nb_correct
+        auroc = np.sum(correct * (count - correct)) / max(self.nb_correct * nb_wrong, 1) / 2
+        aurc = self._sketch_aurc()
+        aurc_gap = max(abs(self._sketch_aurc('first') - aurc), abs(self._sketch_aurc('last') - aurc))
+        return {'AUROC': auroc*100, 'AURC': aurc_gap*1000}
+
+    # same res dict as valid.validation
+    def compute(self):
+        self._flush()
+        ece, mce, rmsce = utils.calibration.calibration_errors(self.bin_count, self.bin_conf_sum, self.bin_acc_sum,
+                                                               self.nb_sample)
+        res = utils.metrics.get_res(self.nb_correct / self.nb_sample, self._ranking(), ece,
+                                    self.nll_sum / self.nb_sample, self.brier_sum / self.nb_sample)
+        if self.full_calibration:
+            res['AdaECE'] = self._adaptive_ece()*100
+            res['MCE'] = mce*100
+            res['RMSCE'] = rmsce*100
+            if self.cls_conf_sum is not None:
+                nb_cls = len(self.cls_conf_sum) // self.bins
+                res['CwECE'] = utils.calibration.classwise_calibration_error(self.cls_conf_sum, self.cls_acc_sum,
+                                                                             self.nb_sample, nb_cls)*100
+
+        return res
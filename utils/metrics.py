@@ -1,114 +1,227 @@
 import numpy as np
 import torch
-from sklearn import metrics
+import utils.calibration
+
+# AURC, EAURC, AUROC, AUPR Succ., AUPR, FPR from a single sort of the confidence
+def calc_ranking_metrics(confidence, correct):
+    confidence = np.asarray(confidence).ravel()
+    correctness = np.asarray(correct, dtype=np.float64).ravel()
+
+    # stable descending order: ties keep their original order, as sorted(..., reverse=True) does
+    order = np.argsort(-confidence, kind='stable')
+
+    return _ranking_metrics_sorted(confidence[order], correctness[order])
+
+# Ranking metrics of every column of an (N, K) confidence matrix, one argsort for all columns
+def calc_ranking_metrics_columns(confidence, correct):
+    confidence = np.asarray(confidence)
+    correctness = np.asarray(correct, dtype=np.float64).ravel()
+    order = np.argsort(-confidence, axis=0, kind='stable')
+    sort_confidence = np.take_along_axis(confidence, order, axis=0)
+
+    return np.array([_ranking_metrics_sorted(sort_confidence[:, k], correctness[order[:, k]])
+                     for k in range(confidence.shape[1])])
+
+# Ranking metrics from confidence / correctness sorted by descending confidence
+def _ranking_metrics_sorted(sort_confidence, sort_correctness):
+    nb_sample = len(sort_confidence)
+    cum_correct = np.cumsum(sort_correctness)
+    cum_error = np.arange(1, nb_sample + 1) - cum_correct
+
+    # aurc, eaurc over the risk-coverage curve
+    risk = cum_error / np.arange(1, nb_sample + 1)
+    aurc = risk.mean()
+    r = risk[-1]
+    eaurc = aurc - (r + (1 - r) * np.log(1 - r))
+
+    # one threshold per distinct confidence value (last index of each tied group),
+    # tps are the correct predictions ranked above the threshold
+    threshold_idx = np.r_[np.flatnonzero(np.diff(sort_confidence)), nb_sample - 1]
+    auroc, aupr_success, aupr_err, fpr_in_tpr_95 = _curve_metrics(cum_correct[threshold_idx], threshold_idx + 1)
+
+    return aurc, eaurc, auroc, aupr_success, aupr_err, fpr_in_tpr_95
+
+# AUROC, AUPR Succ., AUPR, FPR from the cumulative correct predictions / samples ranked above each threshold
+def _curve_metrics(tps, counts):
+    nb_sample = counts[-1]
+    fps = counts - tps
+
+    # auroc, fpr at 95% tpr (collinear points dropped as in sklearn's roc_curve)
+    tpr, fpr = np.r_[0, tps] / tps[-1], np.r_[0, fps] / fps[-1]
+    auroc = _trapezoid(fpr, tpr)
+    if len(fps) > 2:
+        optimal_idx = np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True]
+        roc_tps, roc_fps = np.r_[0, tps[optimal_idx]], np.r_[0, fps[optimal_idx]]
+    else:
+        roc_tps, roc_fps = np.r_[0, tps], np.r_[0, fps]
+    roc_tpr, roc_fpr = roc_tps / roc_tps[-1], roc_fps / roc_fps[-1]
+    fpr_in_tpr_95 = roc_fpr[np.argmin(np.abs(roc_tpr - 0.95))]
+
+    # aupr success: area under the precision-recall curve of the correct predictions
+    precision = tps / counts
+    recall = tps / tps[-1]
+    aupr_success = _trapezoid(np.r_[0, recall], np.r_[1, precision])
+
+    # aupr error: average precision of the wrong predictions, ranked by ascending confidence
+    cum_fps, cum_count = np.r_[0, fps[:-1]], np.r_[0, counts[:-1]]
+    err_tps = fps[-1] - cum_fps[::-1]
+    err_precision = err_tps / (nb_sample - cum_count[::-1])
+    err_recall = err_tps / fps[-1]
+    aupr_err = np.sum(np.diff(np.r_[0, err_recall]) * err_precision)
+
+    return auroc, aupr_success, aupr_err, fpr_in_tpr_95
 
 # AURC, EAURC
 def calc_aurc_eaurc(softmax, correct):
-    softmax = np.array(softmax)
-    correctness = np.array(correct)
-    softmax_max = np.max(softmax, 1)
-
-    sort_values = sorted(zip(softmax_max[:], correctness[:]), key=lambda x:x[0], reverse=True)
-    sort_softmax_max, sort_correctness = zip(*sort_values)
-    risk_li, coverage_li = coverage_risk(sort_softmax_max, sort_correctness)
-    aurc, eaurc = aurc_eaurc(risk_li)
+    softmax_max = np.max(np.asarray(softmax), 1)
+    aurc, eaurc = calc_ranking_metrics(softmax_max, correct)[:2]
 
     return aurc, eaurc
 
 # AUPR ERROR
 def calc_fpr_aupr(softmax, correct):
-    softmax = np.array(softmax)
-    correctness = np.array(correct)
-    softmax_max = np.max(softmax, 1)
-
-    fpr, tpr, thresholds = metrics.roc_curve(correctness, softmax_max)
-    auroc = metrics.auc(fpr, tpr)
-    idx_tpr_95 = np.argmin(np.abs(tpr - 0.95))
-    fpr_in_tpr_95 = fpr[idx_tpr_95]
-
-    precision, recall, thresholds = metrics.precision_recall_curve(correctness, softmax_max)
-    aupr_success = metrics.auc(recall, precision)
-    aupr_err = metrics.average_precision_score(-1 * correctness + 1, -1 * softmax_max)
-
+    softmax_max = np.max(np.asarray(softmax), 1)
+    auroc, aupr_success, aupr_err, fpr_in_tpr_95 = calc_ranking_metrics(softmax_max, correct)[2:]
 
     return auroc, aupr_success, aupr_err, fpr_in_tpr_95
 
+# Trapezoidal area under y(x)
+def _trapezoid(x, y):
+    return np.sum(np.diff(x) * (y[1:] + y[:-1])) / 2
+
 # ECE
 def calc_ece(softmax, label, bins=15):
-    bin_boundaries = torch.linspace(0, 1, bins + 1)
-    bin_lowers = bin_boundaries[:-1]
-    bin_uppers = bin_boundaries[1:]
+    softmax = np.asarray(softmax)
+    correctness = softmax.argmax(1) == np.asarray(label)
 
-    softmax = torch.tensor(softmax)
-    labels = torch.tensor(label)
-
-    softmax_max, predictions = torch.max(softmax, 1)
-    correctness = predictions.eq(labels.long())
-
-    ece = torch.zeros(1)
-
-    for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
-        in_bin = softmax_max.gt(bin_lower.item()) * softmax_max.le(bin_upper.item())
-        prop_in_bin = in_bin.float().mean()
-
-        if prop_in_bin.item() > 0.0:
-            accuracy_in_bin = correctness[in_bin].float().mean()
-            avg_confidence_in_bin = softmax_max[in_bin].mean()
-
-            ece += torch.abs(avg_confidence_in_bin - accuracy_in_bin) * prop_in_bin
-
-    return ece.item()
+    return utils.calibration.calc_ece(softmax.max(1), correctness, bins=bins)
 
 # NLL & Brier Score
-def calc_nll_brier(softmax, logit, label):
-    nb_cls = logit.shape[1]
-    label_onehot = np.eye(nb_cls)[label]
-    brier_score = np.mean(np.sum((softmax - label_onehot) ** 2, axis=1))
-
-    logit = torch.tensor(logit, dtype=torch.float)
-    label = torch.tensor(label, dtype=torch.int)
-    logsoftmax = torch.nn.LogSoftmax(dim=1)
-
-    log_softmax = logsoftmax(logit)
-    nll = calc_nll(log_softmax, label)
-
-
-    return nll.item(), brier_score
-
-# Calc NLL
-def calc_nll(log_softmax, label):
-    out = torch.zeros_like(label, dtype=torch.float)
-    for i in range(len(label)):
-        out[i] = log_softmax[i][label[i]]
-
-    return -out.sum()/len(out)
-
-# Calc coverage, risk
-def coverage_risk(confidence, correctness):
-    risk_list = []
-    coverage_list = []
-    risk = 0
-    for i in range(len(confidence)):
-        coverage = (i + 1) / len(confidence)
-        coverage_list.append(coverage)
-
-        if correctness[i] == 0:
-            risk += 1
-
-        risk_list.append(risk / (i + 1))
-
-    return risk_list, coverage_list
-
-# Calc aurc, eaurc
-def aurc_eaurc(risk_list):
-    r = risk_list[-1]
-    risk_coverage_curve_area = 0
-    optimal_risk_area = r + (1 - r) * np.log(1 - r)
-    for risk_value in risk_list:
-        risk_coverage_curve_area += risk_value * (1 / len(risk_list))
-
-    aurc = risk_coverage_curve_area
-    eaurc = risk_coverage_curve_area - optimal_risk_area
-
-    return aurc, eaurc
-
+def calc_nll_brier(softmax, logit, label, chunk_size=1024):
+    nll, brier = calc_nll_brier_terms(softmax, logit, label, chunk_size=chunk_size)
+
+    return nll.mean(), brier.mean()
+
+# Per-sample NLL and Brier terms, computed chunk by chunk without a one-hot matrix
+def calc_nll_brier_terms(softmax, logit, label, chunk_size=1024):
+    label = np.asarray(label, dtype=np.int64)
+    nll, brier = np.empty(len(label)), np.empty(len(label))
+
+    for start in range(0, len(label), chunk_size):
+        end = min(start + chunk_size, len(label))
+        rows, label_chunk = np.arange(end - start), label[start:end]
+
+        # nll = logsumexp(logit) - logit_y
+        logit_chunk = np.asarray(logit[start:end], dtype=np.float64)
+        logit_max = logit_chunk.max(1)
+        log_sum_exp = logit_max + np.log(np.exp(logit_chunk - logit_max[:, None]).sum(1))
+        nll[start:end] = log_sum_exp - logit_chunk[rows, label_chunk]
+
+        # brier = ||p - onehot(y)||^2 = ||p||^2 - 2 * p_y + 1
+        softmax_chunk = np.asarray(softmax[start:end], dtype=np.float64)
+        brier[start:end] = np.einsum('ij,ij->i', softmax_chunk, softmax_chunk) - 2 * softmax_chunk[rows, label_chunk] + 1
+
+    return nll, brier
+
+
+class Metric_Log(object):
+    '''
+    Streaming metric state for validation: per-sample scalars (max-prob, predicted class, target, NLL and Brier
+    terms) plus equal-width calibration histograms, updated batch by batch. Memory does not depend on nb_cls
+    except the optional (class, bin) histogram of classwise ECE.
+    '''
+
+    def __init__(self, bins=15, full_calibration=False):
+        self.bins = bins
+        self.full_calibration = full_calibration
+        self.log = {'confidence': [], 'pred': [], 'target': [], 'nll': [], 'brier': []}
+        self.bin_count, self.bin_conf_sum, self.bin_acc_sum = np.zeros(bins), np.zeros(bins), np.zeros(bins)
+        self.cls_conf_sum, self.cls_acc_sum = None, None
+
+    # batch update with per-sample scalars
+    def update(self, confidence, pred, target, nll, brier):
+        for key, value in zip(['confidence', 'pred', 'target', 'nll', 'brier'], [confidence, pred, target, nll, brier]):
+            self.log[key].append(np.asarray(value))
+
+        confidence = np.asarray(confidence, dtype=np.float64)
+        correct = np.asarray(pred) == np.asarray(target)
+        bin_idx = utils.calibration.get_bin_index(confidence, self.bins)
+        count, conf_sum, acc_sum = utils.calibration.get_bin_statistics(bin_idx, confidence, correct, self.bins)
+        self.bin_count += count
+        self.bin_conf_sum += conf_sum
+        self.bin_acc_sum += acc_sum
+
+    # (class, bin) histogram of classwise ECE, see utils.calibration.get_classwise_bin_statistics
+    def update_classwise(self, conf_sum, acc_sum):
+        if self.cls_conf_sum is None:
+            self.cls_conf_sum, self.cls_acc_sum = np.zeros(len(conf_sum)), np.zeros(len(acc_sum))
+        self.cls_conf_sum += conf_sum
+        self.cls_acc_sum += acc_sum
+
+    # concatenated per-sample scalars
+    def get_log(self):
+        return {key: np.concatenate(self.log[key]) for key in self.log}
+
+    # same res dict as valid.validation
+    def compute(self):
+        log = self.get_log()
+        correct = log['pred'] == log['target']
+        nb_sample = len(correct)
+
+        ranking = calc_ranking_metrics(log['confidence'], correct)
+        ece, mce, rmsce = utils.calibration.calibration_errors(self.bin_count, self.bin_conf_sum, self.bin_acc_sum,
+                                                               nb_sample)
+        res = get_res(correct.mean(), ranking, ece, log['nll'].mean(), log['brier'].mean())
+        if self.full_calibration:
+            confidence = log['confidence'].astype(np.float64)
+            ada_bin_idx = utils.calibration.get_adaptive_bin_index(confidence, self.bins)
+            ada_bin_stats = utils.calibration.get_bin_statistics(ada_bin_idx, confidence, correct, self.bins)
+            res['AdaECE'] = utils.calibration.calibration_errors(*ada_bin_stats, nb_sample)[0]*100
+            res['MCE'] = mce*100
+            res['RMSCE'] = rmsce*100
+            if self.cls_conf_sum is not None:
+                nb_cls = len(self.cls_conf_sum) // self.bins
+                res['CwECE'] = utils.calibration.classwise_calibration_error(self.cls_conf_sum, self.cls_acc_sum,
+                                                                             nb_sample, nb_cls)*100
+
+        return res
+
+# res dict of valid.validation, ranking = (aurc, eaurc, auroc, aupr_success, aupr, fpr)
+def get_res(acc, ranking, ece, nll, brier):
+    aurc, eaurc, auroc, aupr_success, aupr, fpr = ranking
+    return {
+        'Acc.': acc*100,
+        'FPR' : fpr*100,
+        'AUROC': auroc*100,
+        'AUPR': aupr*100,
+        'AURC': aurc*1000,
+        'EAURC': eaurc*1000,
+        'AUPR Succ.': aupr_success*100,
+        'ECE' : ece*100,
+        'NLL' : nll*10,
+        'Brier' : brier*100
+    }
+
+# res dict of every column of an (N, K) confidence score matrix, one per method
+# predictions are shared (Acc., NLL, Brier, CwECE); calibration is only measured for probability-valued scores
+def calc_multi_score_metrics(scores, score_names, probability, pred, target, nll, brier, full_calibration=False,
+                             cls_conf_sum=None, cls_acc_sum=None, bins=15):
+    correct = np.asarray(pred) == np.asarray(target)
+    nb_sample = len(correct)
+    ranking = calc_ranking_metrics_columns(scores, correct)
+    calibration = utils.calibration.calc_calibration_columns(scores, correct, bins=bins)
+
+    method_res = {}
+    for k, name in enumerate(score_names):
+        ece = calibration['ECE'][k] if probability[k] else np.nan
+        res = get_res(correct.mean(), ranking[k], ece, np.mean(nll), np.mean(brier))
+        if full_calibration:
+            for key in ['AdaECE', 'MCE', 'RMSCE']:
+                res[key] = calibration[key][k]*100 if probability[k] else np.nan
+            if cls_conf_sum is not None:
+                nb_cls = len(cls_conf_sum) // bins
+                res['CwECE'] = utils.calibration.classwise_calibration_error(cls_conf_sum, cls_acc_sum, nb_sample,
+                                                                             nb_cls)*100
+        method_res[name] = res
+
+    return method_res
@@ -0,0 +1,111 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+import utils.metrics
+import utils.prediction_store
+
+'''
+OOD detection from stored predictions (utils.prediction_store): the in-distribution (ID) test set, every OOD set and
+the set the feature scores are fitted on go through the backbone once, every score below is computed from the
+memory-mapped logits / penultimate features, so adding an OOD set or a score never re-runs the backbone.
+    MSP, Energy, MaxLogit: from the stored logit statistics, see utils.prediction_store.chunk_scores
+    Mahalanobis: negative min over the classes of the Mahalanobis distance to the class means, one covariance
+                 shared by the classes (Lee et al., 2018, without input pre-processing)
+    KNN: negative distance of the normalized feature to its k-th nearest normalized fit feature (Sun et al., 2022)
+ID samples are the positives: AUROC, AUPR-In, AUPR-Out (average precision of the ID / OOD samples) and FPR at 95% TPR,
+higher score means more in-distribution.
+'''
+
+OOD_SCORES = ['MSP', 'Energy', 'MaxLogit', 'Mahalanobis', 'KNN']
+FEATURE_SCORES = ['Mahalanobis', 'KNN']
+OOD_METRICS = ['AUROC', 'AUPR-In', 'AUPR-Out', 'FPR95']
+
+
+# AUROC, AUPR-In, AUPR-Out, FPR95 (in %) of ID against OOD scores, one sort of the pooled scores
+def ood_metrics(id_score, ood_score):
+    score = np.r_[np.asarray(id_score, dtype=np.float64), np.asarray(ood_score, dtype=np.float64)]
+    is_id = np.r_[np.ones(len(id_score)), np.zeros(len(ood_score))]
+    order = np.argsort(-score, kind='stable')
+    sort_score = score[order]
+
+    # one threshold per distinct score value, tps are the ID samples ranked above the threshold
+    threshold_idx = np.r_[np.flatnonzero(np.diff(sort_score)), len(score) - 1]
+    tps, counts = np.cumsum(is_id[order])[threshold_idx], threshold_idx + 1
+    auroc, _, aupr_out, fpr95 = utils.metrics._curve_metrics(tps, counts)
+    # average precision of the ID samples, the estimator of AUPR-Out (average precision of the OOD samples)
+    aupr_in = np.sum(np.diff(np.r_[0, tps]) / tps[-1] * tps / counts)
+    return {'AUROC': auroc*100, 'AUPR-In': aupr_in*100, 'AUPR-Out': aupr_out*100, 'FPR95': fpr95*100}
+
+
+class OOD_Scorer(object):
+    '''
+    fit_arrays: stored predictions (with features) of the set the feature scores are fitted on, usually the
+    training set under the test transform; its targets are the class labels
+    '''
+
+    def __init__(self, fit_arrays=None, knn_k=50, chunk_size=1024):
+        self.knn_k = knn_k
+        self.chunk_size = chunk_size
+        self.class_mean, self.whitening, self.bank = None, None, None
+        if fit_arrays is not None:
+            self.fit(fit_arrays)
+
+    def fit(self, arrays):
+        feature = torch.from_numpy(np.array(arrays['feature'], dtype=np.float64))
+        target = torch.from_numpy(np.array(arrays['target'], dtype=np.int64))
+        nb_cls = int(target.max()) + 1
+
+        # class means and the shared covariance, whitened once: distances become squared euclidean distances
+        count = torch.bincount(target, minlength=nb_cls).clamp(min=1).double()
+        class_mean = torch.zeros(nb_cls, feature.size(1), dtype=torch.float64).index_add_(0, target, feature)
+        class_mean = class_mean / count.view(-1, 1)
+        centered = feature - class_mean[target]
+        covariance = centered.t() @ centered / len(target)
+        eigval, eigvec = torch.linalg.eigh(covariance)
+        # pseudo-inverse: directions without variance are dropped
+        keep = eigval > eigval.max() * 1e-10
+        self.whitening = (eigvec[:, keep] / eigval[keep].sqrt()).float()
+        self.class_mean = (class_mean @ eigvec[:, keep] / eigval[keep].sqrt()).float()
+
+        self.bank = F.normalize(feature.float(), dim=1)
+        return self
+
+    def mahalanobis(self, feature):
+        z = feature @ self.whitening
+        distance = (z.pow(2).sum(1, keepdim=True) - 2 * z @ self.class_mean.t() +
+                    self.class_mean.pow(2).sum(1).view(1, -1))
+        return -distance.min(1)[0]
+
+    def knn(self, feature):
+        # k-th largest cosine similarity, distance of unit vectors sqrt(2 - 2 cos)
+        k = min(self.knn_k, self.bank.size(0))
+        cosine = (F.normalize(feature, dim=1) @ self.bank.t()).topk(k, dim=1)[0][:, -1]
+        return -(2 - 2 * cosine).clamp(min=0).sqrt()
+
+    # (N, K) scores of stored predictions, computed chunk by chunk
+    @torch.no_grad()
+    def scores(self, arrays, score_names):
+        if any(name in FEATURE_SCORES for name in score_names) and self.bank is None:
+            raise ValueError('Mahalanobis and KNN scores need a scorer fitted on stored features')
+        logit_names = [name for name in score_names if name not in FEATURE_SCORES]
+        nb_sample = len(arrays['target'])
+        scores = np.empty((nb_sample, len(score_names)))
+        for start in range(0, nb_sample, self.chunk_size):
+            end = min(start + self.chunk_size, nb_sample)
+            chunk = {}
+            if logit_names:
+                chunk.update(zip(logit_names, utils.prediction_store.chunk_scores(arrays, logit_names, start, end).T))
+            if any(name in FEATURE_SCORES for name in score_names):
+                feature = torch.from_numpy(np.array(arrays['feature'][start:end], dtype=np.float32))
+                if 'Mahalanobis' in score_names:
+                    chunk['Mahalanobis'] = self.mahalanobis(feature).numpy()
+                if 'KNN' in score_names:
+                    chunk['KNN'] = self.knn(feature).numpy()
+            scores[start:end] = np.stack([chunk[name] for name in score_names], axis=1)
+        return scores
+
+
+# {ood set: {score: ood_metrics}} from the ID scores and the scores of every OOD set
+def ood_results(id_scores, ood_scores, score_names):
+    return {ood_name: {name: ood_metrics(id_scores[:, k], scores[:, k]) for k, name in enumerate(score_names)}
+            for ood_name, scores in ood_scores.items()}
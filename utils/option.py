@@ -47,10 +47,30 @@ def get_args_parser():
     parser.add_argument('--t', default=1.0, type=float, help='When you set re-weighting type to [exp], you can set the temperature by changing t')
 
     parser.add_argument('--crl-weight', default=0.0, type=float, help='CRL loss weight')
+    parser.add_argument('--crl-pairs', default='roll', type=str, choices=['roll', 'all', 'sampled'],
+                        help='CRL ranking pairs: each sample with the next one, all pairs, or crl-nb-pair random ones')
+    parser.add_argument('--crl-nb-pair', default=4, type=int, help='Nb of random pairs per sample of sampled CRL pairs')
     parser.add_argument('--mixup-weight', default=0.0, type=float, help='Mixup loss weight')
+    parser.add_argument('--mixup-forward', default='separate', type=str, choices=['separate', 'fused', 'fused-split-bn'],
+                        help='Clean and mixup batches in separate forwards, or in one forward with joint / per-batch BN statistics')
     parser.add_argument('--gpu', default='9', type=str, help='GPU id to use')
+    parser.add_argument('--streaming-valid', action='store_true', default=False,
+                        help='whether keep only per-sample scalars during validation (memory independent of nb of classes)')
+    parser.add_argument('--device-reduce', action='store_true', default=False,
+                        help='whether reduce metrics on the compute device and copy them to the host once per pass')
+    parser.add_argument('--async-valid', action='store_true', default=False,
+                        help='whether validate a CPU snapshot of the weights in a background thread while training goes on')
 
 
+    ## Mixed precision
+    parser.add_argument('--amp', default='none', type=str, choices=['none', 'fp16', 'bf16'],
+                        help='Autocast the forward passes to fp16 (with loss scaling, CUDA) or bf16 (CUDA or CPU)')
+
+    ## SAM parameters
+    parser.add_argument('--sam-k', default=1, type=int,
+                        help='Compute the SAM ascent every k steps and reuse its direction in between (LookSAM), 1 for SAM')
+    parser.add_argument('--sam-alpha', default=0.7, type=float, help='Scale of the reused LookSAM direction')
+
     ## SWA parameters
     parser.add_argument('--swa-lr', default=0.05, type=float, help='swa learning rate')
     parser.add_argument('--swa-epoch-start', default=120, type=int, help='swa start epoch')
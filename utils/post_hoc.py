@@ -0,0 +1,155 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import utils.prediction_store
+
+'''
+Post-hoc calibration fitted on cached validation logits: temperature, vector (per-class scale + bias) and matrix
+(affine map of the logits) scaling, minimizing the NLL.
+The temperature is a 1-D convex problem in beta = 1 / T, solved by Newton steps with the exact derivatives
+    NLL'(beta) = mean(E_p[z] - z_y),  NLL''(beta) = mean(Var_p[z]),  p = softmax(beta * z)
+from one chunked pass over the (memory-mapped) logits per step; vector / matrix scaling use full-batch L-BFGS.
+'''
+
+
+class Post_Hoc_Calibration(nn.Module):
+    def __init__(self, nb_cls, method='temperature', init_temp=1.5):
+        super(Post_Hoc_Calibration, self).__init__()
+        self.method = method
+        if method == 'temperature':
+            # log-temperature keeps the temperature positive
+            self.log_temp = nn.Parameter(torch.tensor(float(np.log(init_temp))))
+        elif method == 'vector':
+            self.weight = nn.Parameter(torch.full((nb_cls,), 1 / init_temp))
+            self.bias = nn.Parameter(torch.zeros(nb_cls))
+        elif method == 'matrix':
+            self.weight = nn.Parameter(torch.eye(nb_cls) / init_temp)
+            self.bias = nn.Parameter(torch.zeros(nb_cls))
+        else:
+            raise ValueError(f'Unknown post-hoc calibration: {method}')
+
+    def forward(self, logit):
+        if self.method == 'temperature':
+            return logit / self.log_temp.exp()
+        elif self.method == 'vector':
+            return logit * self.weight + self.bias
+        return F.linear(logit, self.weight, self.bias)
+
+
+# NLL and its first / second derivatives w.r.t. beta = 1 / T, one pass over the logits
+def _temperature_terms(logit, target, beta, chunk_size=4096):
+    nll, grad, hess = 0., 0., 0.
+    for start in range(0, len(target), chunk_size):
+        end = min(start + chunk_size, len(target))
+        z = torch.from_numpy(np.array(logit[start:end], dtype=np.float32))
+        z_y = z.gather(1, torch.from_numpy(np.array(target[start:end], dtype=np.int64)).view(-1, 1)).squeeze(1)
+
+        lse = torch.logsumexp(z * beta, dim=1)
+        p = torch.exp(z * beta - lse.view(-1, 1))
+        mean_z = (p * z).sum(1)
+        nll += (lse - beta * z_y).sum(dtype=torch.float64).item()
+        grad += (mean_z - z_y).sum(dtype=torch.float64).item()
+        hess += ((p * z * z).sum(1) - mean_z ** 2).sum(dtype=torch.float64).item()
+    return nll / len(target), grad / len(target), hess / len(target)
+
+
+# Temperature by safeguarded Newton steps on beta = 1 / T, logits read chunk by chunk
+def fit_temperature(logit, target, init_temp=1.5, max_iter=100, tol=1e-6):
+    beta, prev_beta, prev_nll = 1 / init_temp, None, np.inf
+    for _ in range(int(max_iter)):
+        nll, grad, hess = _temperature_terms(logit, target, beta)
+        # the step overshot: back to the middle of the last step
+        if nll > prev_nll:
+            beta = (beta + prev_beta) / 2
+            continue
+        new_beta = beta - grad / max(hess, 1e-12)
+        new_beta = new_beta if new_beta > 0 else beta / 2
+        if abs(new_beta - beta) < tol * beta:
+            beta = new_beta
+            break
+        prev_beta, prev_nll, beta = beta, nll, new_beta
+
+    calibrator = Post_Hoc_Calibration(0, 'temperature', init_temp)
+    calibrator.log_temp.data.fill_(-np.log(beta))
+    return calibrator.eval()
+
+
+# Fit on (N, C) logits, no forward pass of the network
+# temperature: see fit_temperature, vector / matrix: full-batch L-BFGS on the logits loaded in memory
+def fit_post_hoc(logit, target, method='temperature', init_temp=1.5, lr=0.01, max_iter=100):
+    if method == 'temperature':
+        return fit_temperature(logit, target, init_temp, max_iter)
+
+    logit = torch.as_tensor(np.asarray(logit), dtype=torch.float32)
+    target = torch.as_tensor(np.asarray(target), dtype=torch.int64)
+    calibrator = Post_Hoc_Calibration(logit.size(1), method, init_temp)
+
+    # full batch, the strong-wolfe line search adapts the step
+    optimizer = torch.optim.LBFGS(calibrator.parameters(), lr=lr, max_iter=int(max_iter),
+                                  line_search_fn='strong_wolfe')
+
+    def closure():
+        optimizer.zero_grad()
+        loss = F.cross_entropy(calibrator(logit), target)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return calibrator.eval()
+
+
+# Network followed by a fitted calibration of its logits
+class Calibrated_Net(nn.Module):
+    def __init__(self, net, calibrator):
+        super(Calibrated_Net, self).__init__()
+        self.module = net
+        self.calibrator = calibrator
+
+    def forward(self, x, *args, **kwargs):
+        return self.calibrator(self.module(x, *args, **kwargs))
+
+
+# Read-only view of the stored logits (name='logit') or of their STATS (name='stats') through a calibrator:
+# every slice read by the chunked reductions is calibrated on the fly, nothing of size N x C is allocated
+class Calibrated_Array(object):
+    def __init__(self, arrays, calibrator, name='logit'):
+        self.arrays = arrays
+        self.calibrator = calibrator
+        self.name = name
+        nb_column = arrays['logit'].shape[1] if name == 'logit' else len(utils.prediction_store.STATS)
+        self.shape = (len(arrays['target']), nb_column)
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @torch.no_grad()
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            return self[index[0]][(slice(None),) + index[1:]]
+        logit = self.calibrator(torch.from_numpy(np.array(self.arrays['logit'][index], dtype=np.float32)))
+        if self.name == 'stats':
+            target = torch.from_numpy(np.array(self.arrays['target'][index]))
+            logit = utils.prediction_store.logit_stats(logit.view(-1, logit.size(-1)), target.view(-1))
+        return logit.numpy()
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+# Prediction store (utils.prediction_store) whose dense logits are calibrated when read, no forward pass
+class Calibrated_Store(object):
+    def __init__(self, store, calibrator):
+        self.store = store
+        self.calibrator = calibrator
+
+    def load_or_write(self, loader, net):
+        # the store holds the logits of the uncalibrated network
+        arrays = self.store.load_or_write(loader, net.module if isinstance(net, Calibrated_Net) else net)
+        if 'logit' not in arrays:
+            raise ValueError('Post-hoc calibration needs a store of dense logits (--cache-topk 0)')
+        calibrated = dict(arrays)
+        calibrated['logit'] = Calibrated_Array(arrays, self.calibrator, 'logit')
+        calibrated['stats'] = Calibrated_Array(arrays, self.calibrator, 'stats')
+        return calibrated
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import model.classifier
+
+'''
+Persistent prediction cache: logits (or top-k sparse logits), targets, per-sample softmax statistics and optional
+penultimate features of one checkpoint on one dataset, stored as memory-mapped .npy files.
+The directory is keyed by the checkpoint hash, a fingerprint of the dataset (file list + transform) and an optional
+tag of the inference mode (e.g. test-time augmentation).
+
+stats columns: logsumexp of the logits, logit of the target, squared norm of the softmax, negative entropy,
+so MSP, NLL, Brier and the scores of utils.confidence can be recomputed without the dense logits.
+'''
+
+STATS = ['lse', 'target_logit', 'sq_norm', 'neg_entropy']
+ARRAYS = ['target', 'stats', 'logit', 'topk_logit', 'topk_idx', 'feature']
+
+
+def hash_file(path, chunk_size=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# checkpoint hashes of this process, keyed by (path, size, mtime): a checkpoint is read once however many stores use it
+_checkpoint_hashes = {}
+
+
+def hash_checkpoint(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _checkpoint_hashes:
+        _checkpoint_hashes[key] = hash_file(path)
+    return _checkpoint_hashes[key]
+
+
+# Fingerprint of the samples (ImageFolder file list or the attributes of an array dataset) and the transform
+def dataset_fingerprint(dataset):
+    sha1 = hashlib.sha1()
+    sha1.update(type(dataset).__name__.encode())
+    sha1.update(str(len(dataset)).encode())
+    if isinstance(getattr(dataset, 'samples', None), list):
+        for path, label in dataset.samples:
+            sha1.update(f'{path}:{label}\n'.encode())
+    for attr in ['root', 'subset', 'severity']:
+        sha1.update(f'{attr}={getattr(dataset, attr, None)}\n'.encode())
+    sha1.update(repr(getattr(dataset, 'transform', None)).encode())
+    return sha1.hexdigest()
+
+
+# (B, 4) STATS columns of a batch of logits
+def logit_stats(logit, target):
+    log_softmax = F.log_softmax(logit, dim=1)
+    softmax = log_softmax.exp()
+    return torch.stack([torch.logsumexp(logit, dim=1),
+                        logit.gather(1, target.long().view(-1, 1)).squeeze(1),
+                        softmax.pow(2).sum(1),
+                        (softmax * log_softmax).sum(1)], dim=1)
+
+
+class Prediction_Store(object):
+    # checkpoint_hash: hash_checkpoint(checkpoint_path) computed by the caller (e.g. once for a pool of processes)
+    def __init__(self, root, checkpoint_path, dataset, topk=0, save_feature=False, tag='', checkpoint_hash=None):
+        checkpoint_hash = checkpoint_hash if checkpoint_hash is not None else hash_checkpoint(checkpoint_path)
+        self.key = f'{checkpoint_hash[:16]}_{dataset_fingerprint(dataset)[:16]}' + (f'_{tag}' if tag else '')
+        self.path = os.path.join(root, self.key)
+        self.nb_sample = len(dataset)
+        self.topk = topk
+        self.save_feature = save_feature
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def _meta_path(self):
+        return os.path.join(self.path, 'meta.json')
+
+    # a complete store with at least the requested content
+    def is_valid(self):
+        if not os.path.exists(self._meta_path()):
+            return False
+        with open(self._meta_path()) as f:
+            meta = json.load(f)
+        if meta['nb_sample'] != self.nb_sample or (self.save_feature and not meta['feature']):
+            return False
+        # dense logits serve any top-k request, a top-k store only serves the same or a smaller k
+        return meta['topk'] == 0 or 0 < self.topk <= meta['topk']
+
+    # inference over the (unshuffled) loader, written batch by batch to the memory-mapped files
+    @torch.no_grad()
+    def write(self, loader, net):
+        net.eval()
+        device = next(net.parameters()).device
+        os.makedirs(self.path, exist_ok=True)
+        for path in [self._meta_path()] + [self._file(name) for name in ARRAYS]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        feature_log, handle = [], None
+        if self.save_feature:
+            classifier, _ = model.classifier.get_classifier(net)
+            handle = classifier.register_forward_hook(lambda module, input, output: feature_log.append(input[0]))
+
+        files, start = None, 0
+        for image, target, _ in loader:
+            image, target = image.to(device, non_blocking=True), target.to(device, non_blocking=True)
+            logit = net(image).float()
+            end = start + logit.size(0)
+
+            arrays = {'target': target.long(), 'stats': logit_stats(logit, target)}
+            if self.topk > 0:
+                arrays['topk_logit'], arrays['topk_idx'] = logit.topk(min(self.topk, logit.size(1)), dim=1)
+                arrays['topk_idx'] = arrays['topk_idx'].int()
+            else:
+                arrays['logit'] = logit
+            if self.save_feature:
+                arrays['feature'] = feature_log.pop().float()
+
+            arrays = {name: array.cpu().numpy() for name, array in arrays.items()}
+            if files is None:
+                files = {name: np.lib.format.open_memmap(self._file(name), mode='w+', dtype=array.dtype,
+                                                         shape=(self.nb_sample,) + array.shape[1:])
+                         for name, array in arrays.items()}
+            for name, array in arrays.items():
+                files[name][start:end] = array
+            start = end
+
+        if handle is not None:
+            handle.remove()
+        for array in files.values():
+            array.flush()
+        with open(self._meta_path(), 'w') as f:
+            json.dump({'nb_sample': self.nb_sample, 'topk': self.topk, 'feature': self.save_feature,
+                       'nb_cls': int(files['logit'].shape[1]) if self.topk == 0 else None}, f)
+
+    # read-only memory maps of the stored arrays
+    def load(self):
+        arrays = {}
+        for name in ARRAYS:
+            if os.path.exists(self._file(name)):
+                arrays[name] = np.load(self._file(name), mmap_mode='r')
+        return arrays
+
+    def load_or_write(self, loader, net):
+        if not self.is_valid():
+            self.write(loader, net)
+        return self.load()
+
+
+# (top1 logit, top2 logit, predicted class) of a chunk of stored predictions
+def top2(arrays, start, end):
+    if 'logit' in arrays:
+        logit = np.asarray(arrays['logit'][start:end])
+        pred = logit.argmax(1)
+        top = -np.partition(-logit, 1, axis=1)[:, :2] if logit.shape[1] > 1 else np.repeat(logit, 2, axis=1)
+    else:
+        top, pred = np.asarray(arrays['topk_logit'][start:end]), np.asarray(arrays['topk_idx'][start:end, 0])
+    return top[:, 0].astype(np.float64), top[:, min(1, top.shape[1] - 1)].astype(np.float64), pred.astype(np.int64)
+
+
+# per-sample max-prob, predicted class, target, NLL and Brier terms of a chunk of stored predictions
+def reduce_chunk(arrays, start, end):
+    stats = np.asarray(arrays['stats'][start:end], dtype=np.float64)
+    target = np.asarray(arrays['target'][start:end])
+    top1, _, pred = top2(arrays, start, end)
+
+    confidence = np.exp(top1 - stats[:, 0])
+    nll = stats[:, 0] - stats[:, 1]
+    brier = stats[:, 2] - 2 * np.exp(stats[:, 1] - stats[:, 0]) + 1
+    return confidence, pred, target, nll, brier
+
+
+# (B, K) confidence scores (see utils.confidence) of a chunk of stored predictions
+def chunk_scores(arrays, score_names, start, end, weight=None):
+    stats = np.asarray(arrays['stats'][start:end], dtype=np.float64)
+    top1, top2_logit, _ = top2(arrays, start, end)
+    lse = stats[:, 0]
+
+    scores = []
+    for name in score_names:
+        if name == 'MSP':
+            scores.append(np.exp(top1 - lse))
+        elif name == 'MaxLogit':
+            scores.append(top1)
+        elif name == 'Energy':
+            scores.append(lse)
+        elif name == 'Entropy':
+            scores.append(stats[:, 3])
+        elif name == 'Margin':
+            scores.append(np.exp(top1 - lse) - np.exp(top2_logit - lse))
+        elif name == 'Cosine':
+            feature = np.asarray(arrays['feature'][start:end], dtype=np.float64)
+            feature = feature / np.maximum(np.linalg.norm(feature, axis=1, keepdims=True), 1e-12)
+            weight = np.asarray(weight, dtype=np.float64)
+            weight = weight / np.maximum(np.linalg.norm(weight, axis=1, keepdims=True), 1e-12)
+            scores.append((feature @ weight.T).max(1))
+    return np.stack(scores, axis=1)
@@ -1,4 +1,5 @@
 import torch
+import utils.amp
 
 
 class SAM(torch.optim.Optimizer):
@@ -25,17 +26,26 @@ class SAM(torch.optim.Optimizer):
 
         if zero_grad: self.zero_grad()
 
+    # scaler: AMP GradScaler of the scaled second gradients, it unscales them and skips the update on overflow
     @torch.no_grad()
-    def second_step(self, zero_grad=False):
+    def second_step(self, zero_grad=False, scaler=None):
         for group in self.param_groups:
             for p in group["params"]:
                 if p.grad is None: continue
                 p.data = self.state[p]["old_p"]  # get back to "w" from "w + e(w)"
 
-        self.base_optimizer.step()  # do the actual "sharpness-aware" update
+        # do the actual "sharpness-aware" update
+        if scaler is not None:
+            scaler.step(self.base_optimizer)
+        else:
+            self.base_optimizer.step()
 
         if zero_grad: self.zero_grad()
 
+    # every step computes the ascent, see LookSAM
+    def is_sharpness_step(self):
+        return True
+
     @torch.no_grad()
     def step(self, closure=None):
         assert closure is not None, "Sharpness Aware Minimization requires closure, but it was not provided"
@@ -59,4 +69,66 @@ class SAM(torch.optim.Optimizer):
 
     def load_state_dict(self, state_dict):
         super().load_state_dict(state_dict)
-        self.base_optimizer.param_groups = self.param_groups
\ No newline at end of file
+        self.base_optimizer.param_groups = self.param_groups
+
+class LookSAM(SAM):
+    '''
+    Towards Efficient and Scalable Sharpness-Aware Minimization
+    CVPR 2022
+    https://arxiv.org/abs/2203.02714
+    The ascent is computed every k steps only (first_step / second_step as SAM). The component of the SAM gradient
+    orthogonal to the plain gradient is stored, and every other step adds it back to the plain gradient (reuse_step),
+    so those steps cost one forward-backward as the base optimizer.
+    '''
+
+    def __init__(self, params, base_optimizer, rho=0.05, adaptive=False, k=5, alpha=0.7, **kwargs):
+        super(LookSAM, self).__init__(params, base_optimizer, rho=rho, adaptive=adaptive, **kwargs)
+        self.k = k
+        self.alpha = alpha
+        self.nb_step = 0
+
+    # whether the current step computes the ascent (first_step / second_step) or reuses it (reuse_step)
+    def is_sharpness_step(self):
+        return self.nb_step % self.k == 0 or not self._has_direction()
+
+    def _has_direction(self):
+        return any("g_v" in self.state[p] for group in self.param_groups for p in group["params"])
+
+    def _params_with_grad(self):
+        return [p for group in self.param_groups for p in group["params"] if p.grad is not None]
+
+    @torch.no_grad()
+    def first_step(self, zero_grad=False):
+        for p in self._params_with_grad():
+            self.state[p]["old_g"] = p.grad.clone()
+        super(LookSAM, self).first_step(zero_grad)
+
+    @torch.no_grad()
+    def second_step(self, zero_grad=False, scaler=None):
+        # g_v: SAM gradient minus its projection on the gradient at w, from unscaled gradients without overflow
+        overflow = False
+        if scaler is not None:
+            scaler.unscale_(self.base_optimizer)
+            overflow = utils.amp.found_inf(scaler, self.base_optimizer)
+        params = [p for p in self._params_with_grad() if "old_g" in self.state[p]]
+        dot = sum((p.grad * self.state[p]["old_g"]).sum() for p in params)
+        sq_norm = sum(self.state[p]["old_g"].pow(2).sum() for p in params)
+        for p in params:
+            old_g = self.state[p].pop("old_g")
+            if not overflow:
+                self.state[p]["g_v"] = p.grad - dot / (sq_norm + 1e-12) * old_g
+        self.nb_step += 1
+        super(LookSAM, self).second_step(zero_grad, scaler)
+
+    @torch.no_grad()
+    def reuse_step(self, zero_grad=False):
+        params = [p for p in self._params_with_grad() if "g_v" in self.state[p]]
+        grad_norm = torch.sqrt(sum(p.grad.pow(2).sum() for p in params))
+        g_v_norm = torch.sqrt(sum(self.state[p]["g_v"].pow(2).sum() for p in params))
+        scale = self.alpha * grad_norm / (g_v_norm + 1e-12)
+        for p in params:
+            p.grad.add_(self.state[p]["g_v"] * scale)
+        self.nb_step += 1
+        self.base_optimizer.step()
+
+        if zero_grad: self.zero_grad()
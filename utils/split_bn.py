@@ -0,0 +1,33 @@
+import contextlib
+import torch
+import torch.nn as nn
+
+'''
+Separate BN passes inside one forward: while the context is active, every BN layer in training mode normalizes each
+slice of the batch with its own statistics and updates its running statistics once per slice, in order, exactly as
+separate forwards of the slices would. The other layers still run once on the whole batch.
+'''
+
+
+def _split_forward(module, split_sizes):
+    forward = module.forward
+
+    def split_forward(x):
+        if not module.training:
+            return forward(x)
+        return torch.cat([forward(chunk) for chunk in x.split(split_sizes)])
+    return split_forward
+
+
+@contextlib.contextmanager
+def split_batch_norm(net, split_sizes, enabled=True):
+    bn_layers = [module for module in net.modules() if isinstance(module, nn.modules.batchnorm._BatchNorm)] \
+        if enabled else []
+    for module in bn_layers:
+        module.forward = _split_forward(module, split_sizes)
+    try:
+        yield net
+    finally:
+        # drop the instance attribute, back to the class forward
+        for module in bn_layers:
+            del module.forward
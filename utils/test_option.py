@@ -26,8 +26,71 @@ def get_args_parser():
 
     ## Temperature Scaling
     parser.add_argument('--init-temp', default=1.5, type=float, help='Initial temperature')
-    parser.add_argument('--lr-temp', default=0.01, type=float, help='Learning rate for learning temperature')
+    parser.add_argument('--lr-temp', default=0.01, type=float, help='Learning rate of the L-BFGS fit of vector / matrix scaling (temperature uses Newton steps)')
     parser.add_argument('--iters-temp', default=100, type=float, help='Max iterations for learning temperature')
+    parser.add_argument('--post-hoc', default='none', type=str, choices=['none', 'temperature', 'vector', 'matrix'],
+                        help='Post-hoc calibration fitted on the validation logits and applied to the test logits')
+
+    ## Test-time augmentation
+    parser.add_argument('--tta', default=[], type=str, nargs='*', choices=['flip', 'crop', 'scale'],
+                        help='Test-time augmentation views, forwarded as one stacked batch')
+    parser.add_argument('--tta-aggregate', default='softmax', type=str, choices=['softmax', 'logit'],
+                        help='Average the softmax or the logits of the views (Energy / MaxLogit need logit)')
+    parser.add_argument('--tta-chunk', default=1024, type=int, help='Max nb of augmented images per forward')
+
+    ## Monte-Carlo dropout
+    parser.add_argument('--mc-dropout', default=0, type=int,
+                        help='Nb of stochastic passes of MC dropout, forwarded as one replicated batch (0: disabled)')
+    parser.add_argument('--mc-droprate', default=0.5, type=float,
+                        help='Dropout rate on the penultimate features (ResNet18 and the head-only variant)')
+    parser.add_argument('--mc-head-only', action='store_true', default=False,
+                        help='whether sample dropout only in the classifier, on the features of one backbone pass')
+
+    ## Calibration
+    parser.add_argument('--full-calibration', action='store_true', default=False,
+                        help='whether report adaptive ECE, MCE, RMSCE and classwise ECE besides ECE, '
+                             'and write the reliability diagrams of the probability scores')
+    parser.add_argument('--streaming-valid', action='store_true', default=False,
+                        help='whether keep only per-sample scalars during evaluation (memory independent of nb of classes)')
+    parser.add_argument('--device-reduce', action='store_true', default=False,
+                        help='whether reduce metrics on the compute device and copy them to the host once per pass')
+
+    ## Confidence scores
+    parser.add_argument('--scores', default=['MSP'], type=str, nargs='+',
+                        choices=['MSP', 'MaxLogit', 'Energy', 'Entropy', 'Margin', 'Cosine'],
+                        help='Confidence scores to evaluate from the same forward pass')
+
+    ## Bootstrap
+    parser.add_argument('--nb-boot', default=0, type=int, help='Nb of bootstrap replicates for confidence intervals, 0 to disable')
+    parser.add_argument('--boot-alpha', default=0.05, type=float, help='Confidence intervals cover 1 - alpha')
+    parser.add_argument('--boot-worker', default=1, type=int, help='Nb of processes computing bootstrap blocks')
+
+    ## Prediction cache
+    parser.add_argument('--pred-cache-dir', default=None, type=str,
+                        help='Directory of the memory-mapped predictions per checkpoint, None to disable')
+    parser.add_argument('--cache-topk', default=0, type=int, help='Store only the top-k logits, 0 to store dense logits')
+    parser.add_argument('--cache-feature', action='store_true', default=False,
+                        help='whether store the penultimate features (required by the Cosine score)')
+
+    ## OOD detection
+    parser.add_argument('--ood-dir', default=[], type=str, nargs='*',
+                        help='ImageFolder directories of the OOD sets, evaluated against the test set')
+    parser.add_argument('--ood-scores', default=['MSP', 'Energy', 'MaxLogit', 'Mahalanobis', 'KNN'], type=str,
+                        nargs='+', choices=['MSP', 'Energy', 'MaxLogit', 'Mahalanobis', 'KNN'],
+                        help='OOD scores computed from the stored logits and penultimate features')
+    parser.add_argument('--ood-fit-dir', default=None, type=str,
+                        help='ImageFolder directory the Mahalanobis / KNN scores are fitted on, None for the train dir')
+    parser.add_argument('--knn-k', default=50, type=int, help='Nb of neighbours of the KNN score')
+
+    ## Ensemble
+    parser.add_argument('--ensemble', action='store_true', default=False,
+                        help='whether evaluate the nb_run checkpoints and their averaged-softmax ensemble in one data pass')
+
+    ## CIFAR-10-C grid
+    parser.add_argument('--cifar10c-worker', default=0, type=int,
+                        help='Nb of CPU processes evaluating the corruption x severity cells, 0 to run them in sequence')
+    parser.add_argument('--cifar10c-thread', default=0, type=int,
+                        help='Intra-op threads per CPU process, 0 to split the cores evenly between processes')
 
     ## dataset setting
     subparsers = parser.add_subparsers(title="dataset setting", dest="subcommand")
@@ -212,4 +275,15 @@ def get_args_parser():
     PlantImage.add_argument("--nb-cls", type=int, default=1908, help="number of classes in PlantImage")
     PlantImage.add_argument("--imb-factor", type=float, default=1.0, help="imbalance rate in PlantImage")
     
-    return parser.parse_args()
\ No newline at end of file
+    args = parser.parse_args()
+    if args.ensemble and args.ood_dir:
+        parser.error('--ensemble does not evaluate OOD detection, run --ood-dir without --ensemble')
+    # the ensemble evaluates the MSP of the uncalibrated checkpoints in one deterministic pass, in this process
+    ensemble_options = {'--post-hoc': args.post_hoc != 'none', '--scores': args.scores != ['MSP'],
+                        '--mc-dropout': args.mc_dropout > 0, '--tta': len(args.tta) > 0, '--nb-boot': args.nb_boot > 0,
+                        '--pred-cache-dir': args.pred_cache_dir is not None,
+                        '--cifar10c-worker': args.cifar10c_worker > 0}
+    ignored = [option for option, is_set in ensemble_options.items() if is_set]
+    if args.ensemble and ignored:
+        parser.error(f"--ensemble does not support {', '.join(ignored)}, run them without --ensemble")
+    return args
\ No newline at end of file
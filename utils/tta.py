@@ -0,0 +1,81 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+'''
+Batched test-time augmentation: every batch is expanded into its augmented views, stacked along the batch dimension
+and forwarded at once (in chunks of at most chunk_size images); the views of a sample are aggregated into one output
+that the existing metrics consume as logits.
+    crop: 4 corner crops, i.e. shifts of H / 8 pixels, zero-padded after normalization (the padding is the dataset
+          mean, not the black border of RandomCrop(padding=...) on the raw image)
+    scale: zoom by 0.9 and 1.1, center-cropped / zero-padded back to the input size
+    flip: horizontal flip of every other view
+'''
+
+TTA_VIEWS = ['flip', 'crop', 'scale']
+
+
+# Image shifted by (dy, dx) pixels, zero padding
+def shift(image, dy, dx):
+    h, w = image.shape[-2:]
+    pad = max(abs(dy), abs(dx))
+    padded = F.pad(image, [pad, pad, pad, pad])
+    return padded[..., pad - dy:pad - dy + h, pad - dx:pad - dx + w]
+
+
+# Image zoomed by factor around its center, same size as the input
+def zoom(image, factor):
+    h, w = image.shape[-2:]
+    size = [max(1, int(round(h * factor))), max(1, int(round(w * factor)))]
+    scaled = F.interpolate(image, size=size, mode='bilinear', align_corners=False)
+    if factor >= 1:
+        top, left = (size[0] - h) // 2, (size[1] - w) // 2
+        return scaled[..., top:top + h, left:left + w]
+    top, left = (h - size[0]) // 2, (w - size[1]) // 2
+    return F.pad(scaled, [left, w - size[1] - left, top, h - size[0] - top])
+
+
+# List of view functions, the identity first
+def get_view_functions(views, image_size):
+    base = [lambda x: x]
+    if 'crop' in views:
+        step = max(1, image_size // 8)
+        base += [lambda x, dy=dy, dx=dx: shift(x, dy, dx) for dy in [-step, step] for dx in [-step, step]]
+    if 'scale' in views:
+        base += [lambda x, factor=factor: zoom(x, factor) for factor in [0.9, 1.1]]
+    if 'flip' in views:
+        base += [lambda x, f=f: torch.flip(f(x), dims=[-1]) for f in base]
+    return base
+
+
+class TTA_Net(nn.Module):
+    '''
+    aggregate='softmax': log of the mean softmax over the views (its softmax is the averaged prediction; its
+                         logsumexp is 0, so it carries no Energy / MaxLogit of the views)
+    aggregate='logit': mean logits over the views
+    '''
+
+    def __init__(self, net, views, aggregate='softmax', chunk_size=1024):
+        super(TTA_Net, self).__init__()
+        self.module = net
+        self.views = views
+        self.aggregate = aggregate
+        self.chunk_size = chunk_size
+
+    def forward(self, x):
+        view_functions = get_view_functions(self.views, x.size(-1))
+        nb_view = len(view_functions)
+        # samples per forward, nb_view images each
+        step = max(1, self.chunk_size // nb_view)
+
+        outputs = []
+        for start in range(0, x.size(0), step):
+            chunk = x[start:start + step]
+            stacked = torch.cat([f(chunk) for f in view_functions])
+            output = self.module(stacked).float().view(nb_view, chunk.size(0), -1)
+            if self.aggregate == 'softmax':
+                outputs.append(torch.logsumexp(F.log_softmax(output, dim=2), dim=0) - np.log(nb_view))
+            else:
+                outputs.append(output.mean(0))
+        return torch.cat(outputs)
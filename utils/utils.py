@@ -62,16 +62,23 @@ def compute_statistics(values):
 
 
 
-def csv_writter(path, data_name, model_name, metrics, results):
+# method_results: {method: {metric: statistics}}, ci_results: {method: {model: {metric: (low, high)}}}
+def csv_writter(path, data_name, model_name, metrics, method_results, ci_results=None):
     with open(path, 'w', newline='',encoding='utf-8-sig') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow([data_name, model_name])
 
-        for method, res in [("MSP_results", results)]:
-            writer.writerow([method] + metrics)
+        for method, res in method_results.items():
+            writer.writerow([f"{method}_results"] + metrics)
             values = ["{:.2f}±{:.2f}".format(res[metric]["mean"], res[metric]["std"]) for metric in metrics]
             writer.writerow([''] + values)
 
+            # bootstrap confidence interval of each model
+            if ci_results is not None and method in ci_results:
+                for model_name, ci in ci_results[method].items():
+                    values = ["[{:.2f}, {:.2f}]".format(*ci[metric]) if metric in ci else '' for metric in metrics]
+                    writer.writerow([f'{model_name} CI'] + values)
+
 
 def save_cifar10c_results_to_csv(save_path, metrics, cor_results_all_models):
     csv_file_path = os.path.join(save_path, 'cifar10c_results.csv')
@@ -93,4 +100,29 @@ def save_cifar10c_results_to_csv(save_path, metrics, cor_results_all_models):
                     writer.writerow(values)
 
 
+# ood_results_all_models: {model: {ood set: {score: {metric: value}}}}
+def save_ood_results_to_csv(save_path, metrics, ood_results_all_models):
+    csv_file_path = os.path.join(save_path, 'ood_results.csv')
+
+    with open(csv_file_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Model", "OOD set", "Score"] + metrics)
+        for model_name, ood_results in ood_results_all_models.items():
+            for ood_name, score_results in ood_results.items():
+                for score, results in score_results.items():
+                    writer.writerow([model_name, ood_name, score] + [f"{results[metric]:.2f}" for metric in metrics])
+
+
+# diagrams_all_models: {model: {method: utils.calibration.reliability_diagram}}
+def save_reliability_diagrams_to_csv(save_path, diagrams_all_models):
+    csv_file_path = os.path.join(save_path, 'reliability_diagrams.csv')
 
+    with open(csv_file_path, 'w', newline='', encoding='utf-8-sig') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Model", "Method", "Bin lower", "Bin upper", "Count", "Accuracy", "Confidence"])
+        for model_name, method_diagram in diagrams_all_models.items():
+            for method, diagram in method_diagram.items():
+                for k in range(len(diagram['count'])):
+                    writer.writerow([model_name, method, f"{diagram['bin_lower'][k]:.4f}",
+                                     f"{diagram['bin_upper'][k]:.4f}", int(diagram['count'][k]),
+                                     f"{diagram['accuracy'][k]:.4f}", f"{diagram['confidence'][k]:.4f}"])
@@ -1,17 +1,35 @@
+import contextlib
+import copy
+import queue
+import threading
 import torch
 import torch.nn.functional as F
+import torch.optim.swa_utils
 import utils.metrics
+import utils.calibration
+import utils.confidence
+import model.classifier
+import utils.mc_dropout
+import utils.prediction_store
+import utils.post_hoc
+import utils.metric_state
 import numpy as np 
 
 @torch.no_grad()
-def validation(loader, net):
+def validation(loader, net, full_calibration=False, streaming=False, device_reduce=False, return_log=False,
+               store=None):
+    if store is not None:
+        return stored_validation(store.load_or_write(loader, net), full_calibration, return_log)
+    if streaming or device_reduce or return_log:
+        return streaming_validation(loader, net, full_calibration, device_reduce, return_log)
     net.eval()
+    device = get_device(net)
 
     val_log = {'softmax' : [], 'correct' : [], 'logit' : [], 'target':[]}
 
 
     for image, target, _ in loader:
-        image, target = image.cuda(), target.cuda()
+        image, target = image.to(device), target.to(device)
         output = net(image)
         softmax = F.softmax(output, dim=1)
         _, pred_cls = softmax.max(1)
@@ -28,12 +46,16 @@ def validation(loader, net):
     acc = 100. * val_log['correct'].mean()
 
     
-    # aurc, eaurc
-    aurc, eaurc = utils.metrics.calc_aurc_eaurc(val_log['softmax'], val_log['correct'])
-    # fpr, aupr
-    auroc, aupr_success, aupr, fpr = utils.metrics.calc_fpr_aupr(val_log['softmax'], val_log['correct'])
+    # aurc, eaurc, fpr, aupr (one sort of the max softmax)
+    aurc, eaurc, auroc, aupr_success, aupr, fpr = utils.metrics.calc_ranking_metrics(val_log['softmax'].max(1),
+                                                                                     val_log['correct'])
     # calibration measure ece , mce, rmsce
-    ece = utils.metrics.calc_ece(val_log['softmax'], val_log['target'], bins=15)
+    if full_calibration:
+        calibration, _ = utils.calibration.calc_calibration(val_log['softmax'].max(1), val_log['correct'],
+                                                            val_log['softmax'], val_log['target'], bins=15)
+        ece = calibration['ECE']
+    else:
+        ece = utils.metrics.calc_ece(val_log['softmax'], val_log['target'], bins=15)
     # brier, nll
     nll, brier = utils.metrics.calc_nll_brier(val_log['softmax'], val_log['logit'], val_log['target'])
 
@@ -50,11 +72,370 @@ def validation(loader, net):
         'NLL' : nll*10,
         'Brier' : brier*100
     }
+    if full_calibration:
+        for key in ['AdaECE', 'MCE', 'RMSCE', 'CwECE']:
+            res[key] = calibration[key]*100
     
 
     return res
 
 
+# Per-sample max-prob, predicted class, target, NLL and Brier terms packed in one (B, 5) tensor
+def reduce_batch(output, target):
+    log_softmax = F.log_softmax(output.float(), dim=1)
+    softmax = log_softmax.exp()
+    confidence, pred_cls = softmax.max(1)
 
+    target = target.long().view(-1, 1)
+    nll = -log_softmax.gather(1, target).squeeze(1)
+    brier = softmax.pow(2).sum(1) - 2 * softmax.gather(1, target).squeeze(1) + 1
 
+    packed = torch.stack([confidence, pred_cls.float(), target.squeeze(1).float(), nll, brier], dim=1)
+    return packed, softmax
 
+
+# Sum of probability and of onehot label per (class, bin), computed on the device of the softmax
+def classwise_bin_statistics(softmax, target, bins=15):
+    nb_cls = softmax.size(1)
+    bin_boundaries = torch.linspace(0, 1, bins + 1, device=softmax.device)
+    bin_idx = (torch.bucketize(softmax, bin_boundaries) - 1).clamp_(0, bins - 1)
+    flat_idx = (bin_idx + torch.arange(nb_cls, device=softmax.device) * bins).flatten()
+
+    conf_sum = torch.bincount(flat_idx, weights=softmax.flatten().double(), minlength=nb_cls * bins)
+    target = target.long().view(-1, 1)
+    acc_sum = torch.bincount((target * bins + bin_idx.gather(1, target)).flatten(), minlength=nb_cls * bins)
+    return conf_sum, acc_sum
+
+
+def get_device(net):
+    return next(net.parameters()).device
+
+
+# Validation with per-sample scalars only, memory independent of the number of classes
+# device_reduce: keep the packed scalars on the device and copy them to the host once per pass
+# return_log: also return the Metric_Log holding the per-sample scalars
+@torch.no_grad()
+def streaming_validation(loader, net, full_calibration=False, device_reduce=False, return_log=False):
+    metric_log = utils.metrics.Metric_Log(bins=15, full_calibration=full_calibration)
+    stream_scalars(loader, net, metric_log, full_calibration, device_reduce)
+
+    if return_log:
+        return metric_log.compute(), metric_log
+    return metric_log.compute()
+
+
+# Per-sample scalars of one pass fed to metric_log (utils.metrics.Metric_Log or utils.metric_state.Metric_State,
+# same update / update_classwise)
+@torch.no_grad()
+def stream_scalars(loader, net, metric_log, full_calibration=False, device_reduce=False):
+    net.eval()
+    device = get_device(net)
+    packed_log, cls_conf_sum, cls_acc_sum = [], 0, 0
+
+    for image, target, _ in loader:
+        image, target = image.to(device, non_blocking=True), target.to(device, non_blocking=True)
+        output = net(image)
+        packed, softmax = reduce_batch(output, target)
+        if full_calibration:
+            conf_sum, acc_sum = classwise_bin_statistics(softmax, target, bins=15)
+            cls_conf_sum, cls_acc_sum = cls_conf_sum + conf_sum, cls_acc_sum + acc_sum
+
+        if device_reduce:
+            packed_log.append(packed)
+        else:
+            packed = packed.cpu().numpy()
+            metric_log.update(packed[:, 0], packed[:, 1].astype(np.int64), packed[:, 2].astype(np.int64),
+                              packed[:, 3], packed[:, 4])
+
+    if device_reduce:
+        packed = torch.cat(packed_log).cpu().numpy()
+        metric_log.update(packed[:, 0], packed[:, 1].astype(np.int64), packed[:, 2].astype(np.int64),
+                          packed[:, 3], packed[:, 4])
+    if full_calibration:
+        metric_log.update_classwise(cls_conf_sum.cpu().numpy(), cls_acc_sum.cpu().numpy())
+    return metric_log
+
+
+# Validation of several models and of their ensemble (averaged softmax) from one pass over the data
+# returns the res of every model and the res of the ensemble
+@torch.no_grad()
+def ensemble_validation(loader, nets, full_calibration=False):
+    for net in nets:
+        net.eval()
+    device = get_device(nets[0])
+
+    metric_logs = [utils.metrics.Metric_Log(bins=15, full_calibration=full_calibration) for _ in range(len(nets) + 1)]
+    cls_sums = [(0, 0) for _ in range(len(nets) + 1)]
+
+    for image, target, _ in loader:
+        image, target = image.to(device, non_blocking=True), target.to(device, non_blocking=True)
+        log_softmax = torch.stack([F.log_softmax(net(image).float(), dim=1) for net in nets])
+        # log of the averaged softmax, its softmax is the ensemble prediction
+        ensemble_output = torch.logsumexp(log_softmax, dim=0) - np.log(len(nets))
+
+        for k, output in enumerate(list(log_softmax) + [ensemble_output]):
+            packed, softmax = reduce_batch(output, target)
+            if full_calibration:
+                conf_sum, acc_sum = classwise_bin_statistics(softmax, target, bins=15)
+                cls_sums[k] = (cls_sums[k][0] + conf_sum, cls_sums[k][1] + acc_sum)
+            packed = packed.cpu().numpy()
+            metric_logs[k].update(packed[:, 0], packed[:, 1].astype(np.int64), packed[:, 2].astype(np.int64),
+                                  packed[:, 3], packed[:, 4])
+
+    if full_calibration:
+        for metric_log, (cls_conf_sum, cls_acc_sum) in zip(metric_logs, cls_sums):
+            metric_log.update_classwise(cls_conf_sum.cpu().numpy(), cls_acc_sum.cpu().numpy())
+
+    res = [metric_log.compute() for metric_log in metric_logs]
+    return res[:-1], res[-1]
+
+
+# Validation of several confidence scores (see utils.confidence) from one forward pass
+# returns one res dict per score, return_log: also return the per-sample scores, predictions, NLL and Brier terms
+@torch.no_grad()
+def multi_score_validation(loader, net, score_names, full_calibration=False, return_log=False, store=None):
+    if store is not None:
+        return stored_multi_score_validation(store.load_or_write(loader, net), net, score_names, full_calibration,
+                                             return_log)
+    net.eval()
+    device = get_device(net)
+
+    # penultimate features are the input of the last classification layer
+    feature_log, weight, handle = [], None, None
+    if 'Cosine' in score_names:
+        classifier, weight = model.classifier.get_classifier(net)
+        handle = classifier.register_forward_hook(lambda module, input, output: feature_log.append(input[0]))
+
+    packed_log, score_log, cls_conf_sum, cls_acc_sum = [], [], 0, 0
+    for image, target, _ in loader:
+        image, target = image.to(device, non_blocking=True), target.to(device, non_blocking=True)
+        output = net(image)
+        packed, softmax = reduce_batch(output, target)
+        feature = feature_log.pop() if feature_log else None
+        score_log.append(utils.confidence.get_confidence_scores(output, score_names, feature, weight))
+        packed_log.append(packed)
+        if full_calibration:
+            conf_sum, acc_sum = classwise_bin_statistics(softmax, target, bins=15)
+            cls_conf_sum, cls_acc_sum = cls_conf_sum + conf_sum, cls_acc_sum + acc_sum
+
+    if handle is not None:
+        handle.remove()
+
+    packed = torch.cat(packed_log).cpu().numpy()
+    scores = torch.cat(score_log).cpu().numpy()
+    probability = [name in utils.confidence.PROBABILITY_SCORES for name in score_names]
+    if full_calibration:
+        cls_conf_sum, cls_acc_sum = cls_conf_sum.cpu().numpy(), cls_acc_sum.cpu().numpy()
+    else:
+        cls_conf_sum, cls_acc_sum = None, None
+
+    val_log = {'scores': scores, 'pred': packed[:, 1].astype(np.int64), 'target': packed[:, 2].astype(np.int64),
+               'nll': packed[:, 3], 'brier': packed[:, 4]}
+    method_res = utils.metrics.calc_multi_score_metrics(scores, score_names, probability, val_log['pred'],
+                                                        val_log['target'], val_log['nll'], val_log['brier'],
+                                                        full_calibration, cls_conf_sum, cls_acc_sum, bins=15)
+    if return_log:
+        return method_res, val_log
+    return method_res
+
+
+# Monte-Carlo dropout validation: T stochastic passes per batch, metrics of the mean softmax and one res dict per
+# utils.confidence.MC_SCORES; head_only: sample dropout on the penultimate features of one deterministic pass
+@torch.no_grad()
+def mc_dropout_validation(loader, net, nb_mc=20, droprate=0.5, head_only=False, full_calibration=False,
+                          return_log=False, chunk_size=2048):
+    device = get_device(net)
+    feature_log, handle = [], None
+    classifier = model.classifier.get_classifier(net)[0]
+    if head_only:
+        net.eval()
+        handle = classifier.register_forward_hook(lambda module, input, output: feature_log.append(input[0]))
+    elif utils.mc_dropout.enable_mc_dropout(net, droprate) == 0:
+        raise ValueError('The network has no dropout to sample, use the head-only variant')
+
+    packed_log, score_log, cls_conf_sum, cls_acc_sum = [], [], 0, 0
+    for image, target, _ in loader:
+        image, target = image.to(device, non_blocking=True), target.to(device, non_blocking=True)
+        if head_only:
+            net(image)
+            logit_samples = utils.mc_dropout.head_mc_logits(classifier, feature_log.pop(), nb_mc, droprate)
+            if isinstance(net, utils.post_hoc.Calibrated_Net):
+                logit_samples = net.calibrator(logit_samples)
+        else:
+            logit_samples = utils.mc_dropout.mc_logits(net, image, nb_mc, chunk_size)
+        output, scores = utils.confidence.mc_confidence_scores(logit_samples)
+        packed, softmax = reduce_batch(output, target)
+        score_log.append(scores)
+        packed_log.append(packed)
+        if full_calibration:
+            conf_sum, acc_sum = classwise_bin_statistics(softmax, target, bins=15)
+            cls_conf_sum, cls_acc_sum = cls_conf_sum + conf_sum, cls_acc_sum + acc_sum
+
+    if handle is not None:
+        handle.remove()
+    utils.mc_dropout.disable_mc_dropout(net)
+
+    packed = torch.cat(packed_log).cpu().numpy()
+    scores = torch.cat(score_log).cpu().numpy()
+    score_names = utils.confidence.MC_SCORES
+    probability = [name in utils.confidence.PROBABILITY_SCORES for name in score_names]
+    if full_calibration:
+        cls_conf_sum, cls_acc_sum = cls_conf_sum.cpu().numpy(), cls_acc_sum.cpu().numpy()
+    else:
+        cls_conf_sum, cls_acc_sum = None, None
+
+    val_log = {'scores': scores, 'pred': packed[:, 1].astype(np.int64), 'target': packed[:, 2].astype(np.int64),
+               'nll': packed[:, 3], 'brier': packed[:, 4]}
+    method_res = utils.metrics.calc_multi_score_metrics(scores, score_names, probability, val_log['pred'],
+                                                        val_log['target'], val_log['nll'], val_log['brier'],
+                                                        full_calibration, cls_conf_sum, cls_acc_sum, bins=15)
+    if return_log:
+        return method_res, val_log
+    return method_res
+
+
+# (class, bin) histogram of classwise ECE from stored dense logits, None for a top-k store
+def stored_classwise_statistics(arrays, chunk_size=1024, bins=15):
+    if 'logit' not in arrays:
+        return None, None
+    cls_conf_sum, cls_acc_sum = 0, 0
+    for start in range(0, len(arrays['target']), chunk_size):
+        end = min(start + chunk_size, len(arrays['target']))
+        softmax = F.softmax(torch.from_numpy(np.array(arrays['logit'][start:end])), dim=1).numpy()
+        _, conf_sum, acc_sum = utils.calibration.get_classwise_bin_statistics(softmax, arrays['target'][start:end],
+                                                                             bins)
+        cls_conf_sum, cls_acc_sum = cls_conf_sum + conf_sum, cls_acc_sum + acc_sum
+    return cls_conf_sum, cls_acc_sum
+
+
+# Validation from stored predictions (utils.prediction_store), no forward pass
+def stored_validation(arrays, full_calibration=False, return_log=False, chunk_size=65536):
+    metric_log = utils.metrics.Metric_Log(bins=15, full_calibration=full_calibration)
+    for start in range(0, len(arrays['target']), chunk_size):
+        end = min(start + chunk_size, len(arrays['target']))
+        metric_log.update(*utils.prediction_store.reduce_chunk(arrays, start, end))
+
+    if full_calibration:
+        cls_conf_sum, cls_acc_sum = stored_classwise_statistics(arrays)
+        if cls_conf_sum is not None:
+            metric_log.update_classwise(cls_conf_sum, cls_acc_sum)
+
+    res = metric_log.compute()
+    if full_calibration and 'CwECE' not in res:
+        res['CwECE'] = float('nan')
+    if return_log:
+        return res, metric_log
+    return res
+
+
+# (N, C) logits and targets of a loader, e.g. to fit a post-hoc calibration without a prediction store
+@torch.no_grad()
+def collect_logits(loader, net):
+    net.eval()
+    device = get_device(net)
+    logit_log, target_log = [], []
+    for image, target, _ in loader:
+        logit_log.append(net(image.to(device)).float().cpu())
+        target_log.append(target.long())
+
+    return torch.cat(logit_log).numpy(), torch.cat(target_log).numpy()
+
+
+# Mergeable metric state of one shard of the evaluation set, see utils.metric_state
+def validation_state(loader, net, full_calibration=False, device_reduce=False, sketch_bins=0):
+    state = utils.metric_state.Metric_State(bins=15, sketch_bins=sketch_bins, full_calibration=full_calibration)
+    return stream_scalars(loader, net, state, full_calibration, device_reduce)
+
+
+# Multi-score validation from stored predictions, net only provides the classifier weight of the Cosine score
+def stored_multi_score_validation(arrays, net, score_names, full_calibration=False, return_log=False,
+                                  chunk_size=65536):
+    weight = model.classifier.get_classifier(net)[1].detach().cpu().numpy() if 'Cosine' in score_names else None
+
+    scores, reduced = [], []
+    for start in range(0, len(arrays['target']), chunk_size):
+        end = min(start + chunk_size, len(arrays['target']))
+        scores.append(utils.prediction_store.chunk_scores(arrays, score_names, start, end, weight))
+        reduced.append(utils.prediction_store.reduce_chunk(arrays, start, end))
+    scores = np.concatenate(scores)
+    _, pred, target, nll, brier = [np.concatenate(value) for value in zip(*reduced)]
+
+    cls_conf_sum, cls_acc_sum = stored_classwise_statistics(arrays) if full_calibration else (None, None)
+    probability = [name in utils.confidence.PROBABILITY_SCORES for name in score_names]
+    val_log = {'scores': scores, 'pred': pred, 'target': target, 'nll': nll, 'brier': brier}
+    method_res = utils.metrics.calc_multi_score_metrics(scores, score_names, probability, pred, target, nll, brier,
+                                                        full_calibration, cls_conf_sum, cls_acc_sum, bins=15)
+    for res in method_res.values():
+        if full_calibration and 'CwECE' not in res:
+            res['CwECE'] = float('nan')
+    if return_log:
+        return method_res, val_log
+    return method_res
+
+
+class Async_Validation(object):
+    '''
+    Background validation: submit() snapshots the weights to the CPU and returns, a worker thread loads the snapshot
+    into its own copy of the network (optionally re-estimates the BN statistics with update_bn), runs validation and
+    calls on_result(epoch, res, net_val) in submission order. At most max_pending snapshots wait in the queue.
+    '''
+
+    def __init__(self, loader, on_result, full_calibration=False, streaming=False, device_reduce=False,
+                 max_pending=2):
+        self.loader = loader
+        self.on_result = on_result
+        self.kwargs = {'full_calibration': full_calibration, 'streaming': streaming, 'device_reduce': device_reduce}
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.nets, self.error = {}, None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # bn_loader: re-estimate the BN statistics of the snapshot on this loader before validation (SWA); it must not be
+    # the loader the training thread iterates, e.g. a DataLoader of its own over train_loader.dataset
+    def submit(self, epoch, net, bn_loader=None):
+        self._raise()
+        # one evaluation copy per submitted network (e.g. net, then swa_model), created in the training thread
+        if id(net) not in self.nets:
+            self.nets[id(net)] = copy.deepcopy(net)
+        snapshot = {key: value.detach().to('cpu', copy=True) for key, value in net.state_dict().items()}
+        self.queue.put((epoch, self.nets[id(net)], snapshot, bn_loader))
+
+    # wait for every submitted validation
+    def join(self):
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.join()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _raise(self):
+        if self.error is not None:
+            raise RuntimeError('Background validation failed') from self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            try:
+                if self.error is None:
+                    self._validate(*item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _validate(self, epoch, net_val, snapshot, bn_loader):
+        device = get_device(net_val)
+        stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+            net_val.load_state_dict(snapshot)
+            if bn_loader is not None:
+                torch.optim.swa_utils.update_bn(bn_loader, net_val, device=device)
+            res = validation(self.loader, net_val, **self.kwargs)
+        if stream is not None:
+            stream.synchronize()
+        self.on_result(epoch, res, net_val)